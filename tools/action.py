@@ -5,6 +5,7 @@ from abc import ABC
 from dataclasses import dataclass, field
 from typing import Callable
 
+import batch
 from utils import invoke
 
 
@@ -13,10 +14,19 @@ class Action(ABC):
     description: str = field(init=False)
     edits_cards: bool = field(init=False)
     ankiconnect_actions: set[str] = field(init=False)
+    # whether run() raises its errors, rather than reporting and skipping them
+    fail_on_error = True
 
     def run(self, **args):
         pass
 
+    def get_transform(self) -> batch.FieldTransform | None:
+        """
+        the transform that this action is equivalent to, if the action can be fused
+        with other transforms (see action_runner.fuse_actions())
+        """
+        return None
+
 
 @dataclass
 class UserAction(Action):
@@ -34,28 +44,13 @@ class SetField(Action):
     def __post_init__(self):
         self.description = f"Sets the field `{self.field_name}` -> `{self.value}`"
         self.edits_cards = True
-        self.ankiconnect_actions = {"findNotes", "updateNoteFields", "multi"}
+        self.ankiconnect_actions = {"findNotes", "notesInfo", "updateNoteFields", "multi"}
 
     def run(self, **args):
-        notes = invoke("findNotes", query=r'"note:JP Mining Note"')
-
-        # creates multi request
-        actions = []
-
-        for nid in notes:
-            action = {
-                "action": "updateNoteFields",
-                "params": {
-                    "note": {
-                        "id": nid,
-                        "fields": {self.field_name: self.value},
-                    }
-                },
-            }
+        return batch.set_field(self.field_name, self.value)
 
-            actions.append(action)
-
-        return invoke("multi", actions=actions)
+    def get_transform(self) -> batch.FieldTransform | None:
+        return batch.set_field_transform(self.field_name, self.value)
 
 
 @dataclass
@@ -205,19 +200,39 @@ class BatchUpdate(Action):
     batch_func: Callable[[], None]
     description: str
     ankiconnect_actions: set[str]
+    # the transforms ran by batch_func, if it runs multiple transforms that were fused
+    # together (see action_runner.fuse_actions())
+    transforms: list[batch.FieldTransform] = field(default_factory=list)
+    fail_on_error: bool = False
     edits_cards = True
-    fail_on_error = False
 
     def run(self, **args):
         if self.fail_on_error:
             self.batch_func()
         else:
+            notes_updated = batch.notes_updated
             try:
                 self.batch_func()
+            except OSError:
+                # lost connection to Anki: the update must not be counted as done
+                raise
             except Exception:
                 traceback.print_exc()
+                if batch.notes_updated != notes_updated:
+                    # the notes are streamed, so some were already updated: skipping the
+                    # error would leave the collection half updated
+                    print(
+                        "Batch update failed after some of the notes were updated. "
+                        "Please report this to the developer!"
+                    )
+                    raise
                 print("Batch update failed. Please report this to the developer! Skipping error...")
 
+    def get_transform(self) -> batch.FieldTransform | None:
+        if isinstance(self.batch_func, batch.FieldTransform):
+            return self.batch_func
+        return None
+
 
 @dataclass
 class NoteToUser(UserAction):
@@ -27,11 +27,30 @@ TODO:
 
 from __future__ import annotations
 
-import copy
+import json
+import bisect
+import math
+import time
+import functools
+import statistics
 import traceback
 
+from dataclasses import dataclass
+
+import batch
 import utils
-from action import Action, UserAction, RenameField, MoveField, AddField, DeleteField
+import tracing
+import ankiconnect
+from action import (
+    Action,
+    UserAction,
+    BatchUpdate,
+    RenameField,
+    MoveField,
+    AddField,
+    DeleteField,
+)
+from journal import Journal
 from note_changes import NOTE_CHANGES, Version, NoteChange
 
 from typing import Any
@@ -43,54 +62,145 @@ class FieldVerifierException(Exception):
         super().__init__(message + docs_link)
 
 
+class _FenwickTree:
+    """
+    counts of the occupied slots, with O(log n) prefix sums and k-th slot search
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, slot: int, value: int):
+        i = slot + 1
+        while i <= self.size:
+            self.tree[i] += value
+            i += i & -i
+
+    def prefix_sum(self, slot: int) -> int:
+        """
+        number of occupied slots before the given slot
+        """
+        total = 0
+        i = slot
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k: int) -> int:
+        """
+        the slot of the k-th (0-indexed) occupied slot
+        """
+        slot = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if slot + step <= self.size and self.tree[slot + step] <= k:
+                slot += step
+                k -= self.tree[slot]
+            step >>= 1
+        return slot
+
+
 class FieldEditSimulator:
     """
     class to absolutely make sure that the field editing logic is sound
 
+    The fields are stored in slots spaced SLOT_GAP apart, with a map of field name -> slot
+    and a fenwick tree over the occupied slots, so each rename, move, add and delete
+    is O(log n). The slots are only respaced once a field is inserted where there is no gap left.
+
     note:
         allows the user to set the fields by themselves, i.e:
         >>> simulator = FieldEditSimulator(...)
         >>> simulator.original_fields = ...
     """
 
+    SLOT_GAP = 32
+
     def __init__(self, original_fields: list[str]):
         self.original_fields = original_fields
-        self.simulated_fields = copy.deepcopy(self.original_fields)
+        self.simulated_fields = self.original_fields
+
+    @property
+    def simulated_fields(self) -> list[str]:
+        return [name for name in self._slots if name is not None]
+
+    @simulated_fields.setter
+    def simulated_fields(self, fields: list[str]):
+        # extra room for the fields that are added afterwards
+        self._slots: list[str | None] = [None] * ((len(fields) * 2 + 1) * self.SLOT_GAP)
+        self._tree = _FenwickTree(len(self._slots))
+        self._field_slots: dict[str, int] = {}
+        self._count = 0
+        for i, name in enumerate(fields):
+            self._occupy((i + 1) * self.SLOT_GAP, name)
+
+    def _occupy(self, slot: int, name: str):
+        self._slots[slot] = name
+        self._field_slots[name] = slot
+        self._tree.add(slot, 1)
+        self._count += 1
+
+    def _vacate(self, name: str):
+        slot = self._field_slots.pop(name)
+        self._slots[slot] = None
+        self._tree.add(slot, -1)
+        self._count -= 1
+
+    def _insert(self, index: int, name: str):
+        """
+        inserts the field at the index, with the same semantics as list.insert()
+        """
+        if index < 0:
+            index = max(0, self._count + index)
+        index = min(index, self._count)
+
+        before = self._tree.find(index - 1) if index > 0 else -1
+        after = self._tree.find(index) if index < self._count else len(self._slots)
+        if after - before < 2:
+            # no gap left: respaces all fields
+            fields = self.simulated_fields
+            fields.insert(index, name)
+            self.simulated_fields = fields
+            return
+        self._occupy((before + after) // 2, name)
+
+    def index(self, field_name: str) -> int:
+        return self._tree.prefix_sum(self._field_slots[field_name])
 
     def _rename_field(self, old_field_name: str, new_field_name: str):
-        assert old_field_name in self.simulated_fields
-        if new_field_name in self.simulated_fields:
+        assert old_field_name in self._field_slots
+        if new_field_name in self._field_slots:
             raise FieldVerifierException(
                 f"Cannot rename field {old_field_name} -> {new_field_name}: {new_field_name} field already exists"
             )
 
-        i = self.simulated_fields.index(old_field_name)
-        self.simulated_fields[i] = new_field_name
+        slot = self._field_slots.pop(old_field_name)
+        self._field_slots[new_field_name] = slot
+        self._slots[slot] = new_field_name
 
     def _move_field(self, field_name: str, index: int):
-        TEMP_FIELD = "TEMP_FIELD_NAME"
-        assert field_name in self.simulated_fields
+        assert field_name in self._field_slots
 
-        self.simulated_fields.remove(field_name)
-        self.simulated_fields.insert(index, TEMP_FIELD)
-        i = self.simulated_fields.index(TEMP_FIELD)
-        self.simulated_fields[i] = field_name
+        self._vacate(field_name)
+        self._insert(index, field_name)
 
     def _add_field(self, field_name: str, index: int):
-        if field_name not in self.simulated_fields:
-            self.simulated_fields.append(field_name)
+        if field_name not in self._field_slots:
+            self._insert(self._count, field_name)
 
         if index != -1:
             self._move_field(field_name, index)
 
     def _delete_field(self, field_name: str):
-        assert field_name in self.simulated_fields
-        self.simulated_fields.remove(field_name)
+        assert field_name in self._field_slots
+        self._vacate(field_name)
 
     def simulate(self, actions: list[Action], reset: bool = True):
         # reset simulated fields
         if reset:
-            self.simulated_fields = copy.deepcopy(self.original_fields)
+            self.simulated_fields = self.original_fields
 
         for action in actions:
             if isinstance(action, RenameField):
@@ -105,6 +215,20 @@ class FieldEditSimulator:
             elif isinstance(action, DeleteField):
                 self._delete_field(action.field_name)
 
+    def simulate_history(
+        self, note_changes: list[NoteChange] = NOTE_CHANGES
+    ) -> dict[Version, list[str]]:
+        """
+        replays the actions of every version (oldest first) in a single pass, starting
+        from the current fields, and returns the fields after each version.
+        The fields between any two versions can then be checked without replaying them again.
+        """
+        history = {}
+        for data in sorted(note_changes, key=lambda data: data.version):
+            self.simulate(data.actions, reset=False)
+            history[data.version] = self.simulated_fields
+        return history
+
 
 class Verifier:
     def __init__(
@@ -129,14 +253,14 @@ class Verifier:
         that are the same
         """
 
-        # extends the list to the longest length
+        # extends the list to the longest length (without modifying the given lists)
         max_len = max(len(list1), len(list2))
-        for l in (list1, list2):
-            l += ["" * (max_len - len(l))]
+        list1 = list1 + [""] * (max_len - len(list1))
+        list2 = list2 + [""] * (max_len - len(list2))
 
         # gets max length for each item in both lists
-        max1 = max(len(x) for x in list1)
-        max2 = max(len(x) for x in list1)
+        max1 = max(len(x) for x in [title1, *list1])
+        max2 = max(len(x) for x in [title2, *list2])
 
         str_format = "{:<" + str(max1) + "} {:<" + str(max2) + "}"
 
@@ -206,15 +330,22 @@ class Verifier:
 
         # simulator.verify(new_fields=new_fields)
 
-    def verify_api_reflect(self, actions: list[Action]):
-        # test actions from ankiconnect
+    def get_api_reflect_call(self, actions: list[Action]) -> tuple[str, dict[str, Any]]:
         ankiconnect_actions = set().union(
             *[action.ankiconnect_actions for action in actions]
         )
+        return "apiReflect", {"scopes": ["actions"], "actions": list(ankiconnect_actions)}
 
-        api_actions = utils.invoke(
-            "apiReflect", scopes=["actions"], actions=list(ankiconnect_actions)
-        )["actions"]
+    def verify_api_reflect(self, actions: list[Action], reflected: dict[str, Any] | None = None):
+        """
+        `reflected` is the result of the apiReflect call, if it was already sent
+        """
+        # test actions from ankiconnect
+        action_name, params = self.get_api_reflect_call(actions)
+        ankiconnect_actions = params["actions"]
+        if reflected is None:
+            reflected = utils.invoke(action_name, **params)
+        api_actions = reflected["actions"]
 
         if len(ankiconnect_actions) != len(api_actions):
             print("Anki-Connect is missing the following actions:")
@@ -234,8 +365,16 @@ class Verifier:
         - changes to fields are correct through the simulator
         """
 
+        # the reads are independent, and sent at the same time
+        calls = [self.get_api_reflect_call(actions)]
+        if self.anki_fields is None:
+            calls.append(("modelFieldNames", {"modelName": "JP Mining Note"}))
+        reflected, *anki_fields = ankiconnect.invoke_concurrently(calls)
+        if anki_fields:
+            self.anki_fields = anki_fields[0]
+
         self.verify_initial_fields()
-        self.verify_api_reflect(actions)
+        self.verify_api_reflect(actions, reflected)
         self.verify_simulator(actions)
 
     def verify_post(self):
@@ -266,6 +405,452 @@ class Verifier:
                 )
 
 
+def schema_action_fields(action: Action) -> set[str] | None:
+    """
+    the fields whose values are affected by a field (schema) action,
+    or None if the action isn't a field action
+    """
+    if isinstance(action, RenameField):
+        return {action.old_field_name, action.new_field_name}
+    if isinstance(action, MoveField):
+        return set()  # only changes the order
+    if isinstance(action, (AddField, DeleteField)):
+        return {action.field_name}
+    return None
+
+
+def run_fused_transforms(actions: list[Action]):
+    """
+    runs the transforms of the fused actions in as few passes as possible.
+
+    If the pass fails before any note was written, the transforms are ran again one at
+    a time, so that each failing transform is reported and skipped on its own, or raised
+    if its action fails on errors (as if they weren't fused).
+    Failures after notes were written are raised (see BatchUpdate.run()).
+    """
+    transforms = [a.get_transform() for a in actions]
+    notes_updated = batch.notes_updated
+    try:
+        batch.run_transforms(transforms)
+        return
+    except OSError:
+        raise
+    except Exception:
+        if batch.notes_updated != notes_updated:
+            raise
+        print("Combined batch update failed, running each update separately...")
+
+    for action, transform in zip(actions, transforms):
+        BatchUpdate(
+            batch_func=transform,
+            description=action.description,
+            ankiconnect_actions=set(),
+            fail_on_error=action.fail_on_error,
+        ).run()
+
+
+def fuse_actions(actions: list[Action]) -> list[Action]:
+    """
+    combines the batch updates that can be expressed as transforms into as few
+    passes over the notes as possible.
+
+    Transforms are moved past field actions that don't affect any field that the transforms
+    use, and past user actions. Any other action that edits the cards keeps its place.
+    """
+    result: list[Action] = []
+    pending: list[Action] = []  # actions with transforms that haven't been added yet
+
+    def transform_fields(action: Action) -> set[str]:
+        transform = action.get_transform()
+        assert transform is not None
+        return {*transform.reads, *transform.writes, *transform.query_fields()}
+
+    def flush():
+        if len(pending) == 1:
+            result.append(pending[0])
+        elif pending:
+            transforms = [a.get_transform() for a in pending]
+            result.append(
+                BatchUpdate(
+                    batch_func=functools.partial(run_fused_transforms, list(pending)),
+                    description="\n".join(a.description for a in pending),
+                    ankiconnect_actions=set().union(*(a.ankiconnect_actions for a in pending)),
+                    transforms=transforms,
+                    fail_on_error=any(a.fail_on_error for a in pending),
+                )
+            )
+        pending.clear()
+
+    for action in actions:
+        if action.get_transform() is not None:
+            pending.append(action)
+            continue
+
+        if pending and action.edits_cards:
+            fields = schema_action_fields(action)
+            if fields is None or fields & set().union(*map(transform_fields, pending)):
+                flush()
+
+        result.append(action)
+
+    flush()
+    return result
+
+
+FIELD_ACTIONS = (RenameField, MoveField, AddField, DeleteField)
+
+
+def _track_fields(fields: list[str], actions: list[Action]) -> list[tuple[str, str | None]]:
+    """
+    simulates the field actions, keeping track of which original field each resulting
+    field comes from: (name, original name), or (name, None) for added fields
+    """
+    tracked: list[tuple[str, str | None]] = [(f, f) for f in fields]
+
+    def index(name: str) -> int:
+        return [n for n, _ in tracked].index(name)
+
+    def move(name: str, i: int):
+        entry = tracked.pop(index(name))
+        tracked.insert(i, entry)
+
+    for action in actions:
+        if isinstance(action, RenameField):
+            tracked[index(action.old_field_name)] = (
+                action.new_field_name,
+                tracked[index(action.old_field_name)][1],
+            )
+        elif isinstance(action, MoveField):
+            move(action.field_name, action.index)
+        elif isinstance(action, AddField):
+            if action.field_name not in [n for n, _ in tracked]:
+                tracked.append((action.field_name, None))
+            if action.index != -1:
+                move(action.field_name, action.index)
+        elif isinstance(action, DeleteField):
+            tracked.pop(index(action.field_name))
+    return tracked
+
+
+def _longest_increasing_subsequence(values: list[int]) -> set[int]:
+    """
+    indices of a longest strictly increasing subsequence of the values
+    """
+    tails: list[int] = []  # index of the smallest tail of each subsequence length
+    previous: list[int | None] = []
+    for i, v in enumerate(values):
+        lo = bisect.bisect_left([values[t] for t in tails], v)
+        previous.append(tails[lo - 1] if lo > 0 else None)
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(i)
+        i = previous[i]
+    return result
+
+
+def _minimal_field_actions(fields: list[str], actions: list[Action]) -> list[Action] | None:
+    """
+    the shortest list of field actions found that has the same result as the given actions,
+    or None if it couldn't be found (i.e. fields that swap names)
+
+    The actions are ordered as deletes, renames, then adds and moves. The fields that are
+    already in the right relative order (the longest increasing subsequence) are never moved.
+    """
+    final = _track_fields(fields, actions)
+    final_names = {original: name for name, original in final if original is not None}
+
+    result: list[Action] = [DeleteField(f) for f in fields if f not in final_names]
+    current = [f for f in fields if f in final_names]
+
+    # a field can only be renamed once its new name is free
+    used = set(current)
+    pending = [f for f in current if final_names[f] != f]
+    while pending:
+        free = [f for f in pending if final_names[f] not in used]
+        if not free:
+            return None
+        for f in free:
+            used.remove(f)
+            used.add(final_names[f])
+            result.append(RenameField(f, final_names[f]))
+        pending = [f for f in pending if f not in free]
+
+    target = [name for name, _ in final]
+    simulated = [final_names[f] for f in current]
+    target_index = {name: i for i, name in enumerate(target)}
+    lis = _longest_increasing_subsequence([target_index[name] for name in simulated])
+    settled = {simulated[i] for i in lis}
+
+    # every field before the current one in the target is settled by now,
+    # so placing each field after its predecessor gives the target order
+    for i, name in enumerate(target):
+        if name in settled:
+            continue
+        if name in simulated:
+            simulated.remove(name)
+        index = simulated.index(target[i - 1]) + 1 if i > 0 else 0
+        simulated.insert(index, name)
+        if final[i][1] is None:
+            result.append(AddField(name, index))
+        else:
+            result.append(MoveField(name, index))
+        settled.add(name)
+
+    return result
+
+
+def _optimize_field_actions_run(fields: list[str], actions: list[Action]) -> list[Action]:
+    """
+    the minimal equivalent of a run of consecutive field actions, if it was verified to have
+    the same result as the original actions, otherwise the original actions
+    """
+    optimized = _minimal_field_actions(fields, actions)
+    if optimized is None or len(optimized) >= len(actions):
+        return actions
+
+    try:
+        original_sim = FieldEditSimulator(fields)
+        original_sim.simulate(actions)
+        optimized_sim = FieldEditSimulator(fields)
+        optimized_sim.simulate(optimized)
+    except (AssertionError, FieldVerifierException):
+        return actions
+
+    # must also keep the contents of the same fields, not only the same names
+    if (
+        original_sim.simulated_fields != optimized_sim.simulated_fields
+        or _track_fields(fields, actions) != _track_fields(fields, optimized)
+    ):
+        return actions
+    return optimized
+
+
+def optimize_field_actions(actions: list[Action], original_fields: list[str]) -> list[Action]:
+    """
+    collapses each run of field (schema) actions into the minimal equivalent sequence,
+    i.e. adding then moving a field becomes a single add at the final index, chains of
+    moves or renames become one move or rename, and adding then deleting a field is removed.
+
+    Any other action that edits the cards (i.e. batch updates) ends the run, as it may
+    depend on the intermediate fields. Actions that don't edit the cards don't end the run.
+    """
+    result: list[Action] = []
+    run: list[Action] = []
+    fields = list(original_fields)  # the fields at the start of the run
+
+    def flush():
+        nonlocal fields
+        if run:
+            result.extend(_optimize_field_actions_run(fields, run))
+            simulator = FieldEditSimulator(fields)
+            simulator.simulate(run)
+            fields = simulator.simulated_fields
+        run.clear()
+
+    for action in actions:
+        if isinstance(action, FIELD_ACTIONS):
+            run.append(action)
+            continue
+        if action.edits_cards:
+            flush()
+        result.append(action)
+
+    flush()
+    return result
+
+
+def get_action_transforms(action: Action) -> list[batch.FieldTransform] | None:
+    """
+    the transforms ran by the action (including fused batch updates), if any
+    """
+    transform = action.get_transform()
+    if transform is not None:
+        return [transform]
+    if isinstance(action, BatchUpdate) and action.transforms:
+        return action.transforms
+    return None
+
+
+@dataclass
+class PlannedStep:
+    description: str
+    notes: int | None  # number of notes searched by the step, if applicable
+    calls: int
+    bytes_sent: int
+    bytes_received: int
+    seconds: float
+    exact: bool = True  # false if the step could not be fully estimated
+
+
+class ActionPlanner:
+    """
+    estimates the number of AnkiConnect calls, transferred bytes and duration of actions,
+    using only read-only requests.
+
+    The duration is based on the latency measured while planning, and the time Anki
+    takes to write a note (UPDATE_SECONDS_PER_NOTE), which can't be measured without
+    modifying the collection.
+    """
+
+    SAMPLE_SIZE = 20  # notes fetched to estimate the transferred bytes per note
+    UPDATE_SECONDS_PER_NOTE = 0.002  # rough cost for Anki to modify a single note
+    DEFAULT_SECONDS_PER_BYTE = 1 / 20_000_000
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.latencies: list[float] = []
+        self.sample_calls = 0
+        self.sample_seconds = 0.0
+        self.sample_bytes = 0
+        self._total_notes: int | None = None
+
+    def invoke(self, action: str, **params):
+        start = time.perf_counter()
+        result = utils.invoke(action, **params)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def latency(self) -> float:
+        return statistics.median(self.latencies) if self.latencies else 0.0
+
+    def seconds_per_byte(self) -> float:
+        transfer_time = self.sample_seconds - self.latency() * self.sample_calls
+        if self.sample_bytes and transfer_time > 0:
+            return transfer_time / self.sample_bytes
+        return self.DEFAULT_SECONDS_PER_BYTE
+
+    def total_notes(self) -> int:
+        if self._total_notes is None:
+            self._total_notes = len(self.invoke("findNotes", query=batch.JPMN_QUERY))
+        return self._total_notes
+
+    def sample_notes_info(self, notes: list[int]) -> list[dict[str, Any]]:
+        if not notes:
+            return []
+        sample = notes[:: max(1, len(notes) // self.SAMPLE_SIZE)][: self.SAMPLE_SIZE]
+        start = time.perf_counter()
+        infos = utils.invoke("notesInfo", notes=sample)
+        self.sample_calls += 1
+        self.sample_seconds += time.perf_counter() - start
+        self.sample_bytes += len(json.dumps(infos))
+        return infos
+
+    def plan_transforms(self, description: str, transforms: list[batch.FieldTransform]) -> PlannedStep:
+        calls = 0
+        notes = 0
+        bytes_sent = 0
+        bytes_received = 0
+        updated = 0.0
+        exact = True
+
+        for group in batch.group_transforms(transforms):
+            try:
+                matched = [set(self.invoke("findNotes", query=t.query)) for t in group]
+            except Exception:
+                # i.e. searches a field that is added by a previous action
+                matched = [set() for _ in group]
+                exact = False
+            group_notes = sorted(set().union(*matched))
+            chunks = math.ceil(len(group_notes) / self.chunk_size)
+            calls += len(group) + chunks  # findNotes + notesInfo
+
+            # the transforms are pure, so they are ran on a sample of the notes
+            # to estimate how many notes are updated
+            infos = self.sample_notes_info(group_notes)
+            sample_updates = 0
+            sample_sent = 0
+            for info in infos:
+                fields = {name: f["value"] for name, f in info["fields"].items()}
+                written = {}
+                try:
+                    for transform, m in zip(group, matched):
+                        if info["noteId"] in m:
+                            written.update(transform.apply(fields) or {})
+                            fields.update(written)
+                except KeyError:
+                    # reads a field that is added by a previous action
+                    written = {name: "" for t in group for name in t.writes}
+                    exact = False
+                action = batch.diff_update_action(info, written) if written else None
+                if action is not None:
+                    sample_updates += 1
+                    sample_sent += len(json.dumps(action))
+
+            if infos:
+                fraction = sample_updates / len(infos)
+                group_updated = len(group_notes) * fraction
+                bytes_received += len(group_notes) * self.sample_bytes_per_note(infos)
+                if sample_updates:
+                    bytes_sent += int(group_updated * sample_sent / sample_updates)
+                updated += group_updated
+                calls += math.ceil(group_updated / self.chunk_size)  # multi
+            notes += len(group_notes)
+
+        seconds = (
+            calls * self.latency()
+            + (bytes_sent + bytes_received) * self.seconds_per_byte()
+            + updated * self.UPDATE_SECONDS_PER_NOTE
+        )
+        return PlannedStep(
+            description, notes, calls, bytes_sent, int(bytes_received), seconds, exact
+        )
+
+    def sample_bytes_per_note(self, infos: list[dict[str, Any]]) -> float:
+        return len(json.dumps(infos)) / len(infos)
+
+    def plan_action(self, action: Action) -> PlannedStep | None:
+        if not action.edits_cards:
+            return None
+
+        transforms = get_action_transforms(action)
+        if transforms is not None:
+            return self.plan_transforms(action.description, transforms)
+
+        fields = schema_action_fields(action)
+        if fields is not None:
+            # changing the fields of a note type modifies every note of the note type
+            seconds = self.latency() + self.total_notes() * self.UPDATE_SECONDS_PER_NOTE
+            return PlannedStep(action.description, None, 1, 0, 0, seconds)
+
+        # arbitrary batch function: can't be estimated without running it
+        return PlannedStep(action.description, None, 0, 0, 0, 0.0, exact=False)
+
+    def plan(self, actions: list[Action]) -> list[PlannedStep]:
+        steps = [self.plan_action(a) for a in fuse_actions(actions)]
+        return [s for s in steps if s is not None]
+
+
+def format_plan(steps: list[PlannedStep]) -> str:
+    def size(n: int) -> str:
+        return f"{n / 1_000_000:.1f} MB" if n >= 100_000 else f"{n / 1000:.1f} KB"
+
+    lines = [f"    {'notes':>7} {'calls':>6} {'sent':>9} {'received':>9} {'time (s)':>9}  action"]
+    for s in steps:
+        notes = "-" if s.notes is None else str(s.notes)
+        description = s.description.replace("\n", "; ")
+        if not s.exact:
+            description += " (estimate incomplete)"
+        lines.append(
+            f"    {notes:>7} {s.calls:>6} {size(s.bytes_sent):>9} {size(s.bytes_received):>9} "
+            f"{s.seconds:>9.1f}  {description}"
+        )
+
+    calls = sum(s.calls for s in steps)
+    transferred = sum(s.bytes_sent + s.bytes_received for s in steps)
+    seconds = sum(s.seconds for s in steps)
+    lines.append(
+        f"Estimated total: {calls} AnkiConnect calls, {size(transferred)} transferred, "
+        f"~{seconds:.0f} seconds"
+    )
+    return "\n".join(lines)
+
+
 class ActionRunner:
     def __init__(
         self,
@@ -273,11 +858,14 @@ class ActionRunner:
         new_ver: Version,
         in_order=True,
         note_changes=NOTE_CHANGES,
+        journal: Journal | None = None,
     ):
         """
         applies changes specified in the range (current_ver, new_ver]
 
         - verifies field changes by default
+        - if a journal is given, the actions already completed in the journal are skipped,
+          and the fields are verified as they were left by these actions
         """
 
         self.changes: list[NoteChange] = []
@@ -288,6 +876,8 @@ class ActionRunner:
         self.new_fields: None | list[str] = None
         self.in_order: bool = in_order
         self.verifier: Verifier | None = None
+        self.journal = journal
+        self._actions: list[Action] | None = None
 
         self.action_args = {"in_order": in_order}
 
@@ -320,10 +910,18 @@ class ActionRunner:
             return
 
         if self.new_fields is not None:
-            self.verifier = Verifier(
-                self.original_fields, self.new_fields, in_order=self.in_order
-            )
+            fields = self.original_fields
             actions = sum((c.actions for c in self.changes), start=[])
+            if journal is not None and journal.completed_actions:
+                # resumed: the completed field actions were already applied in Anki
+                completed = journal.completed_actions
+                actions = self.get_actions()
+                simulator = FieldEditSimulator(original_fields=fields)
+                simulator.simulate([a for i, a in enumerate(actions) if i in completed])
+                fields = simulator.simulated_fields
+                actions = [a for i, a in enumerate(actions) if i not in completed]
+
+            self.verifier = Verifier(fields, self.new_fields, in_order=self.in_order)
             self.verifier.verify(actions)
 
         # sees if actions edits the cards
@@ -338,6 +936,7 @@ class ActionRunner:
 
     def clear(self):
         self.changes.clear()
+        self._actions = None
 
     def indent(self, desc: str, indent: str = "    ", start: str = "  - ") -> str:
         return start + desc.replace("\n", "\n" + indent)
@@ -440,10 +1039,54 @@ class ActionRunner:
             return False
         return True
 
+    def get_actions(self) -> list[Action]:
+        """
+        the actions of all changes, as they are ran: batch updates are fused,
+        and field actions are collapsed into the minimal equivalent sequence
+        """
+        if self._actions is None:
+            self._actions = self._get_actions()
+        return self._actions
+
+    def _get_actions(self) -> list[Action]:
+        actions = sum((data.actions for data in self.changes), start=[])
+        fused = fuse_actions(actions)
+        if self.original_fields is None:
+            return fused
+
+        optimized = optimize_field_actions(fused, self.original_fields)
+        count = sum(isinstance(a, FIELD_ACTIONS) for a in fused)
+        optimized_count = sum(isinstance(a, FIELD_ACTIONS) for a in optimized)
+        if optimized_count < count:
+            print(f"Combined {count} field changes into {optimized_count}.")
+        return optimized
+
     def run(self):
-        for data in self.changes:
-            for action in data.actions:
-                action.run(**self.action_args)
+        """
+        if a journal was given, completed actions (and chunks of notes within batch updates)
+        are recorded, and the actions already completed in the journal are skipped
+        """
+        with tracing.span("action_runner.run"):
+            self._run(self.journal)
+
+    def _run(self, journal: Journal | None):
+        batch.journal = journal
+        try:
+            for i, action in enumerate(self.get_actions()):
+                if journal is not None:
+                    if i in journal.completed_actions:
+                        print(f"Skipping completed action: {action.description}")
+                        continue
+                    journal.context = f"{i}:"
+
+                span_name = f"action.{type(action).__name__}"
+                with tracing.span(span_name, index=i, description=action.description):
+                    action.run(**self.action_args)
+
+                if journal is not None:
+                    journal.record_action(i)
+        finally:
+            batch.journal = None
 
         if self.new_fields is not None and self.verifier is not None:
             try:
@@ -452,6 +1095,21 @@ class ActionRunner:
                 traceback.print_exc()
                 print("Post-field check failed, skipping error...")
 
+    def plan(self) -> list[PlannedStep]:
+        """
+        estimates the cost of run(), without modifying anything
+        """
+        actions = self.get_actions()
+        if self.journal is not None:
+            actions = [a for i, a in enumerate(actions) if i not in self.journal.completed_actions]
+        with tracing.span("action_runner.plan"):
+            return ActionPlanner(batch.chunk_size).plan(actions)
+
+    def print_plan(self):
+        print(self.get_actions_desc())
+        print()
+        print(format_plan(self.plan()))
+
     def post_message(self):
         if self.requires_user_action:
             print()
@@ -0,0 +1,527 @@
+from __future__ import annotations
+
+"""
+thin AnkiConnect client that keeps its http connections alive between calls
+(when the server allows it), and an asyncio client to send independent calls at the same time
+
+https://github.com/FooSoft/anki-connect#python
+"""
+
+import os
+import json
+import time
+import atexit
+import asyncio
+import select
+import threading
+import http.client
+import urllib.parse
+
+import tracing
+
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+
+DEFAULT_URL = "http://localhost:8765"
+ANKICONNECT_VERSION = 6
+
+# error returned by AnkiConnect for actions it doesn't have (i.e. in older versions)
+UNSUPPORTED_ACTION_ERROR = "unsupported action"
+
+# calls sent at the same time by the async client. AnkiConnect itself handles one request
+# at a time, so this mostly overlaps the time spent in transit and in the tools
+DEFAULT_MAX_CONCURRENCY = 8
+
+# actions that don't modify the collection, so they can safely be sent again if the
+# connection failed while waiting for the response. Identical calls of these that are
+# in flight at the same time are also only sent once by the async client
+READ_ONLY_ACTIONS = frozenset(
+    {
+        "version",
+        "getActiveProfile",
+        "apiReflect",
+        "deckNames",
+        "modelNames",
+        "modelFieldNames",
+        "modelTemplates",
+        "modelStyling",
+        "findNotes",
+        "notesInfo",
+        "notesModTime",
+        "getMediaFilesNames",
+        "retrieveMediaFile",
+    }
+)
+
+# connection errors that can occur when the server has silently closed an idle
+# keep-alive connection. The request is retried once on a fresh connection if it could
+# not have reached AnkiConnect (or if the action is read-only, see READ_ONLY_ACTIONS).
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+
+# taken from https://github.com/FooSoft/anki-connect#python
+def request(action: str, **params):
+    return {"action": action, "params": params, "version": ANKICONNECT_VERSION}
+
+
+def is_dropped(conn: http.client.HTTPConnection) -> bool:
+    """
+    whether the idle connection was closed by the server. An idle connection has nothing
+    to read, unless the server closed it (or sent something unexpected).
+    """
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def parse_response(response) -> object:
+    if len(response) != 2:
+        raise Exception("response has an unexpected number of fields")
+    if "error" not in response:
+        raise Exception("response is missing required error field")
+    if "result" not in response:
+        raise Exception("response is missing required result field")
+    if response["error"] is not None:
+        raise Exception(response["error"])
+    return response["result"]
+
+
+@dataclass
+class ActionStats:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+
+class AnkiConnectClient:
+    """
+    reusable AnkiConnect client
+
+    - connections are pooled and kept alive if the server says so, so repeated calls
+      do not pay the tcp setup cost each time. AnkiConnect itself closes the connection
+      after each response, so each call uses a new connection (and is never sent twice)
+    - safe to share between threads: each call borrows its own connection from the pool
+    - records the number of calls and time spent for each action
+      (also as spans of the current trace, see tracing.py)
+    """
+
+    def __init__(self, url: str = DEFAULT_URL, timeout: float | None = None):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 8765
+        self.path = parsed.path or "/"
+        self.timeout = timeout
+
+        self.stats: dict[str, ActionStats] = {}
+        self._stats_lock = threading.Lock()
+        self._idle: list[http.client.HTTPConnection] = []
+        self._pool_lock = threading.Lock()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        """
+        returns (connection, whether the connection was reused from the pool)
+        """
+        with self._pool_lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if not is_dropped(conn):
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def _release(self, conn: http.client.HTTPConnection):
+        with self._pool_lock:
+            self._idle.append(conn)
+
+    def _post(
+        self,
+        body: bytes | Callable[[], Iterable[bytes]],
+        length: int | None = None,
+        retry: bool = False,
+    ) -> bytes:
+        """
+        the body is either the full request, or a function that generates the request
+        in pieces (called again if the request has to be retried).
+
+        If a pooled connection turns out to be closed, the request is sent again on
+        a new connection only if sending it failed (so AnkiConnect never received all of it),
+        or if `retry` is set. Otherwise AnkiConnect may have already run the action.
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        }
+        if length is not None:
+            headers["Content-Length"] = str(length)
+
+        def send(conn):
+            conn.request("POST", self.path, body() if callable(body) else body, headers)
+
+        conn, reused = self._acquire()
+        try:
+            try:
+                send(conn)
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                conn.close()
+                conn, reused = self._connect(), False
+                send(conn)
+
+            try:
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not (reused and retry):
+                    raise
+                conn.close()
+                conn, reused = self._connect(), False
+                send(conn)
+                response = conn.getresponse()
+
+            data = response.read()
+            if response.status != 200:
+                raise Exception(f"AnkiConnect returned HTTP {response.status}: {data[:200]!r}")
+        except BaseException:
+            conn.close()
+            raise
+
+        # AnkiConnect closes the connection after each response, without saying so.
+        # Connections are therefore only reused if the server explicitly keeps them alive
+        keep_alive = (response.getheader("Connection") or "").lower() == "keep-alive"
+        if keep_alive and not response.will_close:
+            self._release(conn)
+        else:
+            conn.close()
+        return data
+
+    def record(self, action: str, seconds: float, bytes_sent: int, bytes_received: int):
+        with self._stats_lock:
+            stats = self.stats.setdefault(action, ActionStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+        tracing.tracer.add_span(
+            f"ankiconnect.{action}",
+            time.perf_counter() - seconds,
+            seconds,
+            bytes_sent=bytes_sent,
+            bytes_received=bytes_received,
+        )
+        tracing.count("ankiconnect.calls")
+        tracing.count("ankiconnect.bytes_sent", bytes_sent)
+        tracing.count("ankiconnect.bytes_received", bytes_received)
+
+    def invoke(self, action: str, **params):
+        body = json.dumps(request(action, **params)).encode("utf-8")
+
+        start = time.perf_counter()
+        data = self._post(body, retry=action in READ_ONLY_ACTIONS)
+        self.record(action, time.perf_counter() - start, len(body), len(data))
+
+        return parse_response(json.loads(data))
+
+    def invoke_stream(self, action: str, body: Callable[[], Iterable[bytes]], length: int):
+        """
+        same as invoke(), except the request body is generated in pieces of bytes
+        (i.e. while reading a file), so the whole request never has to be held in memory.
+        `length` must be the total size of the generated body.
+        """
+        start = time.perf_counter()
+        data = self._post(body, length)
+        self.record(action, time.perf_counter() - start, length, len(data))
+
+        return parse_response(json.loads(data))
+
+    def is_local(self) -> bool:
+        """
+        whether AnkiConnect runs on this computer, and can therefore read local files
+        """
+        return self.host in ("localhost", "127.0.0.1", "::1")
+
+    def close(self):
+        with self._pool_lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
+
+    def total_calls(self) -> int:
+        return sum(s.calls for s in self.stats.values())
+
+    def report(self) -> str:
+        """
+        returns a table of the number of calls and latency per action
+        """
+        lines = [f"AnkiConnect calls ({self.url}):"]
+        lines.append(f"    {'action':<24} {'calls':>7} {'total (s)':>10} {'avg (ms)':>9}")
+        for action, s in sorted(self.stats.items(), key=lambda x: -x[1].seconds):
+            avg_ms = s.seconds / s.calls * 1000
+            lines.append(f"    {action:<24} {s.calls:>7} {s.seconds:>10.3f} {avg_ms:>9.1f}")
+        return "\n".join(lines)
+
+
+class AsyncAnkiConnectClient:
+    """
+    asyncio version of AnkiConnectClient, for sending independent calls at the same time
+
+    - at most `max_concurrency` requests are sent at a time, each on its own connection
+      (reused only if the server keeps it alive)
+    - identical read-only calls (see READ_ONLY_ACTIONS) that are in flight at the same time
+      share a single request
+    - the calls are recorded in the stats of `stats_client` (if given),
+      so that they are included in its report and the trace
+
+    The client (and its connections) can only be used within one event loop:
+
+        async with AsyncAnkiConnectClient(url) as client:
+            fields, styling = await asyncio.gather(
+                client.invoke("modelFieldNames", modelName=model_name),
+                client.invoke("modelStyling", modelName=model_name),
+            )
+    """
+
+    def __init__(
+        self,
+        url: str = DEFAULT_URL,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        timeout: float | None = None,
+        stats_client: AnkiConnectClient | None = None,
+    ):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 8765
+        self.path = parsed.path or "/"
+        self.timeout = timeout
+        self.stats_client = stats_client
+
+        self.coalesced = 0  # calls that were answered by another identical call
+        self._semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._in_flight: dict[str, asyncio.Future[bytes]] = {}
+
+    async def __aenter__(self) -> AsyncAnkiConnectClient:
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def _write_request(self, writer: asyncio.StreamWriter, body: bytes):
+        head = (
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _read_response(self, reader: asyncio.StreamReader) -> tuple[bytes, bool]:
+        """
+        returns (response body, whether the connection can be reused)
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected("AnkiConnect closed the connection")
+        version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "identity").lower() != "identity":
+            raise Exception(f"unsupported transfer encoding: {headers['transfer-encoding']}")
+        if "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+            # only reused if explicitly kept alive, as in AnkiConnectClient._post()
+            keep_alive = headers.get("connection", "").lower() == "keep-alive"
+        else:
+            # the body ends when the connection is closed
+            data = await reader.read()
+            keep_alive = False
+
+        if status != "200":
+            raise Exception(f"AnkiConnect returned HTTP {status}: {data[:200]!r}")
+        return data, keep_alive
+
+    async def _acquire(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """
+        returns (reader, writer, whether the connection was reused from the pool)
+        """
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not (reader.at_eof() or writer.is_closing()):
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return reader, writer, False
+
+    async def _post(self, body: bytes, retry: bool = False) -> bytes:
+        """
+        same retry policy as AnkiConnectClient._post(): if a pooled connection turns out
+        to be closed, the request is only sent again if sending it failed, or if `retry` is set
+        """
+        reader, writer, reused = await self._acquire()
+        stale_errors = (*STALE_CONNECTION_ERRORS, asyncio.IncompleteReadError)
+        try:
+            try:
+                await self._write_request(writer, body)
+            except stale_errors:
+                if not reused:
+                    raise
+                writer.close()
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                reused = False
+                await self._write_request(writer, body)
+
+            try:
+                data, keep_alive = await self._read_response(reader)
+            except stale_errors:
+                if not (reused and retry):
+                    raise
+                writer.close()
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                reused = False
+                await self._write_request(writer, body)
+                data, keep_alive = await self._read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return data
+
+    async def _send(self, action: str, body: bytes) -> bytes:
+        async with self._semaphore:
+            start = time.perf_counter()
+            data = await asyncio.wait_for(
+                self._post(body, retry=action in READ_ONLY_ACTIONS), self.timeout
+            )
+            if self.stats_client is not None:
+                self.stats_client.record(
+                    action, time.perf_counter() - start, len(body), len(data)
+                )
+            return data
+
+    async def invoke(self, action: str, **params):
+        body = json.dumps(request(action, **params)).encode("utf-8")
+        if action not in READ_ONLY_ACTIONS:
+            return parse_response(json.loads(await self._send(action, body)))
+
+        key = json.dumps(request(action, **params), sort_keys=True)
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._send(action, body))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            tracing.count("ankiconnect.coalesced")
+
+        # shielded, so that one cancelled caller doesn't cancel the request for the others.
+        # Each caller parses the response, so the results can be modified independently
+        data = await asyncio.shield(future)
+        return parse_response(json.loads(data))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+_clients: dict[str, AnkiConnectClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_url() -> str:
+    """
+    the url can be overridden with the ANKICONNECT_URL environment variable
+    (i.e. if AnkiConnect is bound to a different port)
+    """
+    return os.environ.get("ANKICONNECT_URL", DEFAULT_URL)
+
+
+def get_client() -> AnkiConnectClient:
+    """
+    returns the shared client for the current url, creating it on first use
+    """
+    url = get_url()
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = AnkiConnectClient(url)
+            _clients[url] = client
+    return client
+
+
+def invoke(action: str, **params):
+    return get_client().invoke(action, **params)
+
+
+def invoke_concurrently(
+    calls: Iterable[tuple[str, dict[str, Any]]],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    return_exceptions: bool = False,
+) -> list[Any]:
+    """
+    sync wrapper around AsyncAnkiConnectClient: sends the (action, params) calls
+    at the same time, and returns their results in the same order.
+
+    If return_exceptions is set, failed calls return their exception instead of
+    raising the first error (same as asyncio.gather()).
+    Must not be called from a running event loop.
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+    client = get_client()
+
+    async def invoke_all():
+        async with AsyncAnkiConnectClient(
+            client.url, max_concurrency, client.timeout, stats_client=client
+        ) as async_client:
+            return await asyncio.gather(
+                *(async_client.invoke(action, **params) for action, params in calls),
+                return_exceptions=return_exceptions,
+            )
+
+    return asyncio.run(invoke_all())
+
+
+@atexit.register
+def _report_on_exit():
+    for client in _clients.values():
+        if client.total_calls():
+            print(client.report())
+        client.close()
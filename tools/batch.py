@@ -1,10 +1,19 @@
 # import json
 # import urllib.request
 
+from __future__ import annotations
+
 import re
 import argparse
+import functools
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator
 
-from utils import invoke
+import freq_parser
+import tracing
+from utils import invoke, request
+from note_mirror import NoteMirror, get_note_mirror
+from journal import Journal, open_journal
 
 # def request(action, **params):
 #    return {"action": action, "params": params, "version": 6}
@@ -30,10 +39,27 @@ from utils import invoke
 
 # removes all no pitch accent data fields
 
-rx_END_DIV = re.compile(r'</div>$')
-rx_FREQ_INNER2 = re.compile(r'<span class="frequencies__dictionary-inner2">(.*?)</span>')
 rx_FURIGANA = re.compile(r" ?([^ >]+?)\[(.+?)\]");
+# rx_FURIGANA for multiple readings joined by READING_SEPARATOR, that never matches across readings
+READING_SEPARATOR = "\x00"
+rx_FURIGANA_JOINED = re.compile(r" ?([^ >\x00]+?)\[([^\n\x00]+?)\]")
 rx_INTEGER_ONLY = re.compile(r'^-?\d+$')
+rx_QUERY_FIELD = re.compile(r'(\w[\w-]*):')
+
+# number of notes sent per `notesInfo` / `multi` request.
+# Smaller chunks keep Anki responsive and cap memory usage, at the cost of more requests.
+DEFAULT_CHUNK_SIZE = 500
+chunk_size = DEFAULT_CHUNK_SIZE
+
+# local copy of the notes, used by iter_notes_info() if set (see note_mirror.py)
+mirror: NoteMirror | None = None
+
+# records the written chunks, so an interrupted run can be resumed (see journal.py)
+journal: Journal | None = None
+
+# total number of notes updated by update_notes(), so a failed batch update can tell
+# whether it already changed some of the notes (see action.BatchUpdate)
+notes_updated = 0
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -58,303 +84,484 @@ def get_args():
         help="empties a specific field of all JPMN notes",
     )
 
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="number of notes that are read or updated per AnkiConnect request",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continues the previous run of the same function, if it was interrupted",
+    )
+
+    parser.add_argument(
+        "--no-mirror",
+        action="store_true",
+        help="always fetches notes from Anki, instead of only fetching the notes "
+        "that changed since the last run",
+    )
+
+    tracing.add_args(parser)
 
     return parser.parse_args()
 
 
-def clear_pitch_accent_data():
+def _chunks(iterable: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def update_note_fields_action(note_id: int, fields: dict[str, str]) -> dict[str, Any]:
+    # versioned, so that AnkiConnect reports the error of each action within `multi`
+    return request("updateNoteFields", note={"id": note_id, "fields": fields})
+
+
+def diff_update_action(
+    info: dict[str, Any], fields: dict[str, str]
+) -> dict[str, Any] | None:
     """
-    removes all `No pitch accent data` fields
+    the update action for only the fields whose values differ from the note info,
+    or None if the note is already up to date
     """
+    changed = {
+        name: value
+        for name, value in fields.items()
+        if name not in info["fields"] or info["fields"][name]["value"] != value
+    }
+    if not changed:
+        return None
+    return update_note_fields_action(info["noteId"], changed)
 
-    notes = invoke(
-        "findNotes", query=r'"note:JP Mining Note" "PAGraphs:*No pitch accent data*"'
-    )
 
-    # creates multi request
-    actions = []
+def iter_notes_info(notes: list[int], size: int | None = None) -> Iterator[dict[str, Any]]:
+    """
+    streams `notesInfo` for the given note ids, one chunk at a time
+    """
+    if mirror is not None:
+        yield from mirror.notes_info(notes, size or chunk_size)
+        return
 
-    for nid in notes:
-        action = {
-            "action": "updateNoteFields",
-            "params": {"note": {"id": nid, "fields": {"PAGraphs": ""}}},
-        }
+    for chunk in _chunks(notes, size or chunk_size):
+        yield from invoke("notesInfo", notes=chunk)
 
-        actions.append(action)
 
-    notes = invoke("multi", actions=actions)
+def update_notes(
+    actions: Iterable[dict[str, Any] | None],
+    total: int | None = None,
+    size: int | None = None,
+    step: str | None = None,
+) -> int:
+    """
+    sends the (lazily generated) actions with `multi` in chunks, reporting progress
+    along the way. None actions are notes that are already up to date
+    (see diff_update_action()), and are only counted.
 
+    If a step name is given, each sent chunk is recorded in the journal under that step.
 
-def add_downstep_inner_span_tag():
-    """
-    adds the inner span tag to all pitch accents
+    Returns the number of actions that were sent.
     """
+    global notes_updated
 
-    # notes = invoke("findNotes", query=r'"note:JP Mining Note" -WordPitch: added:3')
-    notes = invoke("findNotes", query=r'"note:JP Mining Note" -WordPitch:')
-    notes_info = invoke("notesInfo", notes=notes)
+    sent = 0
+    skipped = 0
+    total_str = "" if total is None else f"/{total}"
 
-    # creates multi request
-    actions = []
+    def count_skipped(actions):
+        nonlocal skipped
+        for action in actions:
+            if action is None:
+                skipped += 1
+            else:
+                yield action
+
+    for chunk in _chunks(count_skipped(actions), size or chunk_size):
+        results = invoke("multi", actions=chunk)
+        note_ids = [a["params"]["note"]["id"] for a in chunk]
+        if mirror is not None:
+            mirror.invalidate(note_ids)
+
+        # a failed action doesn't fail the `multi` request, but is reported in its result
+        errors = {
+            note_id: result["error"]
+            for note_id, result in zip(note_ids, results or [])
+            if isinstance(result, dict) and result.get("error") is not None
+        }
+        updated = [note_id for note_id in note_ids if note_id not in errors]
+        if journal is not None and step is not None:
+            journal.record_chunk(step, updated)
+        sent += len(updated)
+        notes_updated += len(updated)
+        tracing.count("batch.notes_updated", len(updated))
 
-    for info in notes_info:
+        if errors:
+            if sent:
+                print()
+            note_id, error = next(iter(errors.items()))
+            raise Exception(f"Failed to update {len(errors)} notes (note {note_id}: {error})")
+        print(f"Updated {sent}{total_str} notes...", end="\r", flush=True)
 
-        field_val = info["fields"]["WordPitch"]["value"]
+    if sent:
+        print()
+    if skipped:
+        tracing.count("batch.notes_skipped", skipped)
+        print(f"Skipped {skipped} notes that were already up to date.")
+    return sent
 
-        SPAN_DOWNSTEP_EMPTY = '<span class="downstep" style="">ꜜ</span>'
-        SPAN_DOWNSTEP_ARROW = '<span class="downstep">ꜜ</span>'
-        SPAN_DOWNSTEP_UCODE = '<span class="downstep">&#42780;</span>'
-        SPAN_DOWNSTEP_INNER = (
-            '<span class="downstep"><span class="downstep-inner">&#42780;</span></span>'
-        )
 
-        # skips if the downstep-inner class is already found: nothing has to be done
-        if "downstep-inner" in field_val:
-            continue
+JPMN_QUERY = r'"note:JP Mining Note"'
+
+
+@dataclass(frozen=True)
+class FieldTransform:
+    """
+    a declarative batch update, that is applied to every note matched by `query`.
+
+    `func` receives the values of the `reads` fields of a single note, and returns
+    the new values of (some of) the `writes` fields, or None if nothing has to be done.
+    It must not have any side effects, so that multiple transforms can be run
+    in a single pass over the notes (see run_transforms()).
+    """
 
-        # cleaning up ig
-        field_val = field_val.replace(SPAN_DOWNSTEP_EMPTY, SPAN_DOWNSTEP_UCODE)
-        field_val = field_val.replace(SPAN_DOWNSTEP_ARROW, SPAN_DOWNSTEP_UCODE)
-
-        # count1 = field_val.count('<span class="downstep">ꜜ</span>')
-        # count2 = field_val.count("ꜜ")
-        # if count1 != count2:
-        #    print(info["fields"]["Key"]["value"], field_val, count1, count2)
-        span_ucode_count = field_val.count(SPAN_DOWNSTEP_UCODE)
-        previous_count = field_val.count("&#42780;")
-        assert span_ucode_count == previous_count, (
-            info["fields"]["Key"]["value"],
-            field_val,
-            span_ucode_count,
-            previous_count,
+    name: str
+    query: str
+    reads: tuple[str, ...]
+    writes: tuple[str, ...]
+    func: Callable[[dict[str, str]], dict[str, str] | None]
+    # optional version of `func` that transforms a list of notes at once
+    func_many: Callable[[list[dict[str, str]]], list[dict[str, str] | None]] | None = None
+    # whether the new values of the changed notes are listed after the pass
+    report_changes: bool = False
+
+    def query_fields(self) -> set[str]:
+        """
+        names that could be fields searched by the query (overestimated, i.e. `note`)
+        """
+        return set(rx_QUERY_FIELD.findall(self.query))
+
+    def apply(self, fields: dict[str, str]) -> dict[str, str] | None:
+        result = self.func({name: fields[name] for name in self.reads})
+        if result:
+            assert set(result) <= set(self.writes), (self.name, result)
+        return result
+
+    def apply_many(self, notes_fields: list[dict[str, str]]) -> list[dict[str, str] | None]:
+        if self.func_many is None:
+            return [self.apply(fields) for fields in notes_fields]
+
+        results = self.func_many(
+            [{name: fields[name] for name in self.reads} for fields in notes_fields]
         )
+        assert len(results) == len(notes_fields), self.name
+        for result in results:
+            if result:
+                assert set(result) <= set(self.writes), (self.name, result)
+        return results
+
+    def __call__(self):
+        """
+        runs only this transform, so it can be used as a batch function (`-f`)
+        """
+        return run_transforms([self])
+
+
+# all named transforms, so they can be run together by name
+TRANSFORMS: dict[str, FieldTransform] = {}
+
+
+def field_transform(
+    query: str,
+    reads: Iterable[str],
+    writes: Iterable[str],
+    name: str | None = None,
+    func_many: Callable | None = None,
+    report_changes: bool = False,
+) -> Callable[[Callable], FieldTransform]:
+    """
+    registers the decorated per-note function as a transform
+    """
 
-        field_val = field_val.replace(SPAN_DOWNSTEP_UCODE, SPAN_DOWNSTEP_INNER)
-        new_count = field_val.count("&#42780;")
-        assert previous_count == new_count
-
-        # print(info["fields"]["Key"]["value"], field_val)
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {
-                        "WordPitch": field_val,
-                    },
-                }
-            },
-        }
+    def decorator(func):
+        transform = FieldTransform(
+            name=name or func.__name__,
+            query=query,
+            reads=tuple(reads),
+            writes=tuple(writes),
+            func=func,
+            func_many=func_many,
+            report_changes=report_changes,
+        )
+        TRANSFORMS[transform.name] = transform
+        return transform
 
-        actions.append(action)
+    return decorator
 
-    notes = invoke("multi", actions=actions)
 
+def group_transforms(transforms: list[FieldTransform]) -> list[list[FieldTransform]]:
+    """
+    splits the transforms into groups that can be run in a single pass.
 
-def set_pasilence_field():
+    The notes of every transform in a group are searched before any of them are
+    updated, so a transform whose query depends on a field written by a previous
+    transform has to start a new group.
     """
-    sets the `PASilence` field to `[sound:_silence.wav`]
+    groups: list[list[FieldTransform]] = []
+    written: set[str] = set()
+    for transform in transforms:
+        if not groups or transform.query_fields() & written:
+            groups.append([])
+            written = set()
+        groups[-1].append(transform)
+        written.update(transform.writes)
+    return groups
+
+
+def _apply_transforms(
+    transforms: list[FieldTransform], notes: list[tuple[dict[str, str], list[int]]]
+) -> list[tuple[dict[str, str], list[int]]]:
     """
+    applies the transforms to a chunk of notes, given as (field values, indices of the
+    transforms that apply to the note).
 
-    notes = invoke("findNotes", query=r'"note:JP Mining Note"')
+    Returns (written fields, indices of the transforms that changed the note) per note.
+    """
+    written: list[dict[str, str]] = [{} for _ in notes]
+    changed: list[list[int]] = [[] for _ in notes]
 
-    # creates multi request
-    actions = []
+    # the transforms are applied in order, each one seeing the previous results
+    for i, transform in enumerate(transforms):
+        selected = [j for j, (_, indices) in enumerate(notes) if i in indices]
+        if not selected:
+            continue
 
-    for nid in notes:
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": nid,
-                    "fields": {"PASilence": "[sound:_silence.wav]"},
-                }
-            },
-        }
+        results = transform.apply_many([notes[j][0] for j in selected])
+        for j, result in zip(selected, results):
+            if result:
+                notes[j][0].update(result)
+                written[j].update(result)
+                changed[j].append(i)
+
+    return list(zip(written, changed))
+
+
+def _run_transform_group(transforms: list[FieldTransform]) -> int:
+    matched = [set(invoke("findNotes", query=t.query)) for t in transforms]
+    notes = sorted(set().union(*matched))
+    changed = [0] * len(transforms)
+    reported: list[list[str]] = [[] for _ in transforms]  # see FieldTransform.report_changes
+
+    step = ",".join(t.name for t in transforms)
+    if journal is not None and journal.completed_notes(step):
+        # resumed: the transforms must not be applied twice
+        completed = journal.completed_notes(step)
+        notes = [nid for nid in notes if nid not in completed]
+        print(f"Skipping {len(completed)} notes that were updated before the interruption.")
+
+    def get_chunks():
+        for chunk in _chunks(iter_notes_info(notes), chunk_size):
+            yield chunk, [
+                (
+                    {name: field["value"] for name, field in info["fields"].items()},
+                    [i for i, m in enumerate(matched) if info["noteId"] in m],
+                )
+                for info in chunk
+            ]
 
-        actions.append(action)
+    def get_actions(chunk_results):
+        for infos, results in chunk_results:
+            for info, (written, changed_indices) in zip(infos, results):
+                for i in changed_indices:
+                    changed[i] += 1
+                    if transforms[i].report_changes:
+                        writes = transforms[i].writes
+                        values = [written[name] for name in writes if name in written]
+                        reported[i].append(f"{info['noteId']}: {', '.join(values)}")
+                yield diff_update_action(info, written) if written else None
 
-    notes = invoke("multi", actions=actions)
+    apply = functools.partial(_apply_transforms, transforms)
 
+    chunk_results = ((infos, apply(payload)) for infos, payload in get_chunks())
+    sent = update_notes(get_actions(chunk_results), total=len(notes), step=step)
 
-def rename_vn_freq():
-    """
-    renames `VN Freq` -> `VN Freq Percent` in FrequenciesStylized
+    for transform, count, lines in zip(transforms, changed, reported):
+        print(f" - {transform.name}: {count} notes")
+        for line in lines:
+            print(f"     {line}")
+    return sent
+
+
+def run_transforms(transforms: list[FieldTransform]) -> int:
     """
+    runs the transforms with a single read and a single (chunked) write of the notes
+    for each group of independent transforms, rather than once per transform.
 
-    notes = invoke(
-        "findNotes",
-        query=r'"FrequenciesStylized:*>VN Freq<*" OR "FrequenciesStylized:*data-details=\"VN Freq\"*"',
+    Returns the number of notes that were updated.
+    """
+    sent = 0
+    for group in group_transforms(transforms):
+        names = ", ".join(t.name for t in group)
+        print(f"Running {names}...")
+        with tracing.span("batch.transforms", transforms=names):
+            sent += _run_transform_group(group)
+    return sent
+
+
+def _constant_fields(values: dict[str, str], _: dict[str, str]) -> dict[str, str]:
+    return values
+
+
+def set_field_transform(field_name: str, value: str, query: str = JPMN_QUERY) -> FieldTransform:
+    return FieldTransform(
+        name=f"set_field({field_name!r}, {value!r})",
+        query=query,
+        reads=(),
+        writes=(field_name,),
+        func=functools.partial(_constant_fields, {field_name: value}),
     )
-    notes_info = invoke("notesInfo", notes=notes)
-
-    actions = []
-    for info in notes_info:
-
-        field_val = info["fields"]["FrequenciesStylized"]["value"]
-        field_val = field_val.replace(">VN Freq<", ">VN Freq Percent<")
-        field_val = field_val.replace('"VN Freq"', '"VN Freq Percent"')
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {
-                        "FrequenciesStylized": field_val,
-                    },
-                }
-            },
-        }
 
-        actions.append(action)
 
-    notes = invoke("multi", actions=actions)
+def set_field(field_name: str, value: str, query: str = JPMN_QUERY) -> int:
+    """
+    sets the field of every note matched by the query to the given value
+    """
+    return run_transforms([set_field_transform(field_name, value, query)])
 
 
-def add_sort_freq_legacy():
+def clear_pitch_accent_data():
     """
-    Batch adds sort frequencies based off of the legacy frequency html
-
-    DO NOT USE THIS for any version of the card below 0.10.2.0.
+    removes all `No pitch accent data` fields
     """
 
-    # pip3 install beautifulsoup4
-    from bs4 import BeautifulSoup
+    set_field(
+        "PAGraphs",
+        "",
+        query=r'"note:JP Mining Note" "PAGraphs:*No pitch accent data*"',
+    )
 
-    def parse_str(html_str, ignored):
-        soup = BeautifulSoup(html_str, "html.parser")
 
-        assert soup.div is not None
+SPAN_DOWNSTEP_EMPTY = '<span class="downstep" style="">ꜜ</span>'
+SPAN_DOWNSTEP_ARROW = '<span class="downstep">ꜜ</span>'
+SPAN_DOWNSTEP_UCODE = '<span class="downstep">&#42780;</span>'
+SPAN_DOWNSTEP_INNER = (
+    '<span class="downstep"><span class="downstep-inner">&#42780;</span></span>'
+)
 
-        freqs = []
-        for x in soup.div.children:
-            if x["data-details"] not in ignored:
-                freq = int(
-                    "".join(c for c in str(x.div.span.get_text()) if c.isdigit())
-                )
-                freqs.append(freq)
-
-        if freqs:
-            return min(freqs)
-
-        #return None
-        return 0
-
-    ignored = ["VN Freq Percent"]
-
-    notes = invoke("findNotes", query=r"-FrequenciesStylized:")
-    notes_info = invoke("notesInfo", notes=notes)
-
-    actions = []
-    for info in notes_info:
-        field_val = info["fields"]["FrequenciesStylized"]["value"]
-        # print("parsing", info["fields"]["Key"]["value"])
-
-        min_freq = parse_str(field_val, ignored)
-        if min_freq is not None:
-            action = {
-                "action": "updateNoteFields",
-                "params": {
-                    "note": {
-                        "id": info["noteId"],
-                        "fields": {
-                            "FrequencySort": str(min_freq),
-                        },
-                    }
-                },
-            }
 
-            actions.append(action)
+# @field_transform(query=r'"note:JP Mining Note" -WordPitch: added:3', ...)
+@field_transform(
+    query=r'"note:JP Mining Note" -WordPitch:',
+    reads=("WordPitch", "Key"),
+    writes=("WordPitch",),
+)
+def add_downstep_inner_span_tag(fields):
+    """
+    adds the inner span tag to all pitch accents
+    """
 
-    # print(actions)
-    notes = invoke("multi", actions=actions)
+    field_val = fields["WordPitch"]
+
+    # skips if the downstep-inner class is already found: nothing has to be done
+    if "downstep-inner" in field_val:
+        return None
+
+    # cleaning up ig
+    field_val = field_val.replace(SPAN_DOWNSTEP_EMPTY, SPAN_DOWNSTEP_UCODE)
+    field_val = field_val.replace(SPAN_DOWNSTEP_ARROW, SPAN_DOWNSTEP_UCODE)
+
+    # count1 = field_val.count('<span class="downstep">ꜜ</span>')
+    # count2 = field_val.count("ꜜ")
+    # if count1 != count2:
+    #    print(fields["Key"], field_val, count1, count2)
+    span_ucode_count = field_val.count(SPAN_DOWNSTEP_UCODE)
+    previous_count = field_val.count("&#42780;")
+    assert span_ucode_count == previous_count, (
+        fields["Key"],
+        field_val,
+        span_ucode_count,
+        previous_count,
+    )
 
+    field_val = field_val.replace(SPAN_DOWNSTEP_UCODE, SPAN_DOWNSTEP_INNER)
+    new_count = field_val.count("&#42780;")
+    assert previous_count == new_count
 
-def fill_field(field_name):
+    # print(fields["Key"], field_val)
 
-    notes = invoke("findNotes", query=r'"note:JP Mining Note"')
+    return {"WordPitch": field_val}
 
-    # creates multi request
-    actions = []
 
-    for nid in notes:
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": nid,
-                    "fields": {field_name: "1"},
-                }
-            },
-        }
+def set_pasilence_field():
+    """
+    sets the `PASilence` field to `[sound:_silence.wav`]
+    """
 
-        actions.append(action)
+    set_field("PASilence", "[sound:_silence.wav]")
 
-    notes = invoke("multi", actions=actions)
 
+@field_transform(
+    query=r'"FrequenciesStylized:*>VN Freq<*" OR "FrequenciesStylized:*data-details=\"VN Freq\"*"',
+    reads=("FrequenciesStylized",),
+    writes=("FrequenciesStylized",),
+)
+def rename_vn_freq(fields):
+    """
+    renames `VN Freq` -> `VN Freq Percent` in FrequenciesStylized
+    """
 
-def empty_field(field_name):
+    field_val = fields["FrequenciesStylized"]
+    field_val = field_val.replace(">VN Freq<", ">VN Freq Percent<")
+    field_val = field_val.replace('"VN Freq"', '"VN Freq Percent"')
+    return {"FrequenciesStylized": field_val}
 
-    notes = invoke("findNotes", query=r'"note:JP Mining Note"')
 
-    # creates multi request
-    actions = []
+LEGACY_FREQ_IGNORED = ["VN Freq Percent"]
 
-    for nid in notes:
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": nid,
-                    "fields": {field_name: ""},
-                }
-            },
-        }
 
-        actions.append(action)
+@field_transform(
+    query=r"-FrequenciesStylized:",
+    reads=("FrequenciesStylized",),
+    writes=("FrequencySort",),
+)
+def add_sort_freq_legacy(fields):
+    """
+    Batch adds sort frequencies based off of the legacy frequency html
 
-    notes = invoke("multi", actions=actions)
+    DO NOT USE THIS for any version of the card below 0.10.2.0.
+    """
 
+    min_freq = freq_parser.min_frequency(fields["FrequenciesStylized"], LEGACY_FREQ_IGNORED)
+    return {"FrequencySort": str(min_freq)}
 
-def _standardize_frequencies_styling(freq):
-    # updating legacy freq styling 0.10.1.0 -> 0.10.2.0:
-    # example of legacy freq styling (0.10.1.0):
-    # r"""<div class="frequencies"><div class="frequencies__group" data-details="Anime &amp; Jdrama Freq:"><div class="frequencies__number"><span class="frequencies__number-inner">6155</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">Anime &amp; Jdrama Freq:</span></span></div></div><div class="frequencies__group" data-details="Innocent Ranked"><div class="frequencies__number"><span class="frequencies__number-inner">3863</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">Innocent Ranked</span></span></div></div><div class="frequencies__group" data-details="JPDB"><div class="frequencies__number"><span class="frequencies__number-inner">8418</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">JPDB</span></span></div></div><div class="frequencies__group" data-details="JPDB"><div class="frequencies__number"><span class="frequencies__number-inner">37625㋕</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">JPDB</span></span></div></div><div class="frequencies__group" data-details="VN Freq Percent"><div class="frequencies__number"><span class="frequencies__number-inner">92.7</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">VN Freq Percent</span></span></div></div></div>"""
 
-    DIV_FREQ = '<div class="frequencies">'
-    if DIV_FREQ in freq:
-        freq = freq.replace(DIV_FREQ, "")
-        freq = rx_END_DIV.sub("", freq)
+def fill_field(field_name):
+    set_field(field_name, "1")
 
-    freq = rx_FREQ_INNER2.sub(r'\1', freq, count=0)
-    return freq
 
+def empty_field(field_name):
+    set_field(field_name, "")
 
-def standardize_frequencies_styling():
-    query = r'"FrequenciesStylized:*<div class=\"frequencies\">*" OR "FrequenciesStylized:*<span class=\"frequencies__dictionary-inner2\">*"'
 
-    notes = invoke("findNotes", query=query)
-    notes_info = invoke("notesInfo", notes=notes)
-
-    actions = []
-    for info in notes_info:
-        field_val = info["fields"]["FrequenciesStylized"]["value"]
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {"FrequenciesStylized": _standardize_frequencies_styling(field_val)},
-                }
-            },
-        }
+def _standardize_frequencies_styling(freq):
+    return freq_parser.standardize_legacy_html(freq)
 
-        actions.append(action)
 
-    notes = invoke("multi", actions=actions)
+@field_transform(
+    query=r'"FrequenciesStylized:*<div class=\"frequencies\">*" OR "FrequenciesStylized:*<span class=\"frequencies__dictionary-inner2\">*"',
+    reads=("FrequenciesStylized",),
+    writes=("FrequenciesStylized",),
+)
+def standardize_frequencies_styling(fields):
+    return {
+        "FrequenciesStylized": _standardize_frequencies_styling(fields["FrequenciesStylized"])
+    }
 
 
 def _get_kana_from_plain_reading(plain_reading):
@@ -364,151 +571,106 @@ def _get_kana_from_plain_reading(plain_reading):
 
     return result
 
+# taken directly from jaconv's source code
+# separate function instead of using `jaconv` for the sake of fewer dependencies
+# for end users
+# NOTE: doesn't convert long katakana marks unfortunately
+HIRAGANA = ('ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすず'
+            'せぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴ'
+            'ふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろわ'
+            'をんーゎゐゑゕゖゔゝゞ・「」。、')
+FULL_KANA = ('ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソ'
+             'ゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペ'
+             'ホボポマミムメモャヤュユョヨラリルレロワヲンーヮヰヱヵヶヴ'
+             'ヽヾ・「」。、')
+K2H_TABLE = dict(zip(map(ord, FULL_KANA), HIRAGANA))
+
+
+@functools.lru_cache(maxsize=None)
+def _kata2hira_table(ignore: frozenset[str]) -> dict[int, Any]:
+    table: dict[int, Any] = dict(K2H_TABLE)
+    for character in map(ord, ignore):
+        table[character] = character
+    return table
+
+
 def _kata2hira(text: str, ignore: str = "") -> str:
-    # taken directly from jaconv's source code
-    # separate function instead of using `jaconv` for the sake of fewer dependencies
-    # for end users
-    # NOTE: doesn't convert long katakana marks unfortunately
-
-    def _to_dict(_from, _to):
-        return dict(zip(_from, _to))
-    def _to_ord_list(chars):
-        return list(map(ord, chars))
-
-    HIRAGANA = list('ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすず'
-                    'せぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴ'
-                    'ふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろわ'
-                    'をんーゎゐゑゕゖゔゝゞ・「」。、')
-    FULL_KANA = list('ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソ'
-                     'ゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペ'
-                     'ホボポマミムメモャヤュユョヨラリルレロワヲンーヮヰヱヵヶヴ'
-                     'ヽヾ・「」。、')
-    FULL_KANA_ORD = _to_ord_list(FULL_KANA)
-    K2H_TABLE = _to_dict(FULL_KANA_ORD, HIRAGANA)
-
-    def _exclude_ignorechar(ignore, conv_map):
-        for character in map(ord, ignore):
-            conv_map[character] = character
-        return conv_map
-
-    def _convert(text, conv_map):
-        return text.translate(conv_map)
-
-    _conv_map = _exclude_ignorechar(ignore, K2H_TABLE.copy())
-    return _convert(text, _conv_map)
-
-
-def fill_word_reading_hiragana_field():
-    #print(_get_kana_from_plain_reading("成[な]り 立[た]つ"))
+    return text.translate(_kata2hira_table(frozenset(ignore)))
 
-    query = r'"note:JP Mining Note" -WordReading:'
-    print("Querying notes...")
-    notes = invoke("findNotes", query=query)
-    print("Getting notes info...")
-    notes_info = invoke("notesInfo", notes=notes)
-
-    print("Converting kanji reading -> hiragana reading...")
-    actions = []
-    for info in notes_info:
-        field_val = info["fields"]["WordReading"]["value"]
-        reading = _get_kana_from_plain_reading(field_val)
-        # standardizes all katakana -> hiragana
-        hiragana = _kata2hira(reading)
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {"WordReadingHiragana": hiragana},
-                }
-            },
-        }
 
-        actions.append(action)
-        #print(field_val, hiragana)
+def readings_to_hiragana(readings: list[str], ignore: str = "") -> list[str]:
+    """
+    same as `_kata2hira(_get_kana_from_plain_reading(x), ignore)` for each reading,
+    but all readings are converted with one regex substitution and one translation
+    """
+    if any(READING_SEPARATOR in r for r in readings):
+        return [_kata2hira(_get_kana_from_plain_reading(r), ignore) for r in readings]
 
-    print("Updating notes...")
-    notes = invoke("multi", actions=actions)
+    joined = READING_SEPARATOR.join(readings).replace("&nbsp;", " ")
+    joined = rx_FURIGANA_JOINED.sub(r'\2', joined)
+    joined = _kata2hira(joined, ignore)
+    return [r.strip() for r in joined.split(READING_SEPARATOR)]
 
 
+def _fill_word_reading_hiragana_many(notes):
+    hiragana = readings_to_hiragana([fields["WordReading"] for fields in notes])
+    return [{"WordReadingHiragana": h} for h in hiragana]
 
 
-def _quick_fix_convert_kana_only_reading(query):
-    print("Querying notes...")
-    notes = invoke("findNotes", query=query)
-    print("Getting notes info...")
-    notes_info = invoke("notesInfo", notes=notes)
-
-    print("Converting WordReading -> Word[WordReading]")
-    actions = []
-    for info in notes_info:
-        word_field = info["fields"]["Word"]["value"]
-        word_reading_field = info["fields"]["WordReading"]["value"]
-        result = f"{word_field}[{word_reading_field}]"
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {"WordReading": result},
-                }
-            },
-        }
+@field_transform(
+    query=r'"note:JP Mining Note" -WordReading:',
+    reads=("WordReading",),
+    writes=("WordReadingHiragana",),
+    func_many=_fill_word_reading_hiragana_many,
+)
+def fill_word_reading_hiragana_field(fields):
+    #print(_get_kana_from_plain_reading("成[な]り 立[た]つ"))
+
+    reading = _get_kana_from_plain_reading(fields["WordReading"])
+    # standardizes all katakana -> hiragana
+    hiragana = _kata2hira(reading)
+    #print(fields["WordReading"], hiragana)
+
+    return {"WordReadingHiragana": hiragana}
 
-        actions.append(action)
-        print(result)
 
-    print("Updating notes...")
-    notes = invoke("multi", actions=actions)
+def _convert_kana_only_reading(fields):
+    return {"WordReading": f"{fields['Word']}[{fields['WordReading']}]"}
 
 
-def quick_fix_convert_kana_only_reading_with_tag():
-    query = r'"note:JP Mining Note" tag:kanaonlyreading'
-    _quick_fix_convert_kana_only_reading(query)
+quick_fix_convert_kana_only_reading_with_tag = field_transform(
+    query=r'"note:JP Mining Note" tag:kanaonlyreading',
+    reads=("Word", "WordReading"),
+    writes=("WordReading",),
+    name="quick_fix_convert_kana_only_reading_with_tag",
+    report_changes=True,
+)(_convert_kana_only_reading)
 
-def quick_fix_convert_kana_only_reading_all_notes():
-    query = r'"note:JP Mining Note"'
-    _quick_fix_convert_kana_only_reading(query)
+quick_fix_convert_kana_only_reading_all_notes = field_transform(
+    query=r'"note:JP Mining Note"',
+    reads=("Word", "WordReading"),
+    writes=("WordReading",),
+    name="quick_fix_convert_kana_only_reading_all_notes",
+    report_changes=True,
+)(_convert_kana_only_reading)
 
 
 
-def separate_pa_override_field():
+@field_transform(
+    query=r'"note:JP Mining Note" -PAOverride:',
+    reads=("PAOverride",),
+    writes=("PAOverride", "PAOverrideText"),
+)
+def separate_pa_override_field(fields):
     # if the PAOverride field is exactly a digit, then keep in PAOverride.
     # Otherwise, move to PAOverrideText
 
-    query = r'"note:JP Mining Note" -PAOverride:'
-    print("Querying notes...")
-    notes = invoke("findNotes", query=query)
-    print("Getting notes info...")
-    notes_info = invoke("notesInfo", notes=notes)
-
-    print("Separating PAOverride field...")
-    actions = []
-    for info in notes_info:
-        field_val = info["fields"]["PAOverride"]["value"]
-
-        if not rx_INTEGER_ONLY.match(field_val.strip()):
-
-            action = {
-                "action": "updateNoteFields",
-                "params": {
-                    "note": {
-                        "id": info["noteId"],
-                        "fields": {
-                            "PAOverride": "",
-                            "PAOverrideText": field_val
-                        },
-                    }
-                },
-            }
-
-            actions.append(action)
-            #print(info["fields"]["Key"]["value"], field_val)
+    field_val = fields["PAOverride"]
 
-    print("Updating notes...")
-    notes = invoke("multi", actions=actions)
+    if not rx_INTEGER_ONLY.match(field_val.strip()):
+        return {"PAOverride": "", "PAOverrideText": field_val}
+        #print(fields["Key"], field_val)
+    return None
 
 
 def combine_backup_xelieu():
@@ -522,87 +684,99 @@ def combine_backup_xelieu():
     query = r'"note:Mining Format" Glossary:'
     print("Querying monolingual notes...")
     notes = invoke("findNotes", query=query)
-    print("Getting notes info...")
-    notes_info = invoke("notesInfo", notes=notes)
 
-    print("Combining monolingual & bilingual fields...")
     bilingual_fields = ["JMDict", "Kenkyusha"]
     monolingual_fields = ["Shinjirin", "Oukoku", "Daijisen", "Meikyou", "Jitsuyou", "Shinmeikai"]
 
     def combine_defs(defs):
         return "<ol>" + "".join(f"<li>{x}</li>" for x in defs) + "</ol>"
 
-    actions = []
-    for info in notes_info:
-        glossary_sel_txt = info["fields"]["Glossary-Selected"]["value"]
-        bilingual_def_txt = info["fields"]["Glossary"]["value"]
-
-        bilingual_defs = [info["fields"][x]["value"].strip() for x in bilingual_fields]
-        bilingual_defs = [x for x in bilingual_defs if x] # filters out all empty fields
-
-        monolingual_defs = [info["fields"][x]["value"].strip() for x in monolingual_fields]
-        monolingual_defs = [x for x in monolingual_defs if x] # filters out all empty fields
-
-        if glossary_sel_txt: # almost always bilingual according to bilingual_def_txt
-            primary_def_txt = glossary_sel_txt
-            secondary_def_txt = bilingual_def_txt
-            extra_defs_txt = combine_defs(monolingual_defs)
-
-        elif bilingual_def_txt:
-            primary_def_txt = bilingual_def_txt
-            secondary_def_txt = ""
-            extra_defs_txt = combine_defs(monolingual_defs)
-
-        else:
-            primary_def_txt = monolingual_defs[0] if monolingual_defs else ""
-            secondary_def_txt = combine_defs(bilingual_defs)
-            extra_defs = monolingual_defs[1:]
-            if len(extra_defs) == 0:
-                extra_defs_txt = ""
+    def get_actions():
+        for info in iter_notes_info(notes):
+            glossary_sel_txt = info["fields"]["Glossary-Selected"]["value"]
+            bilingual_def_txt = info["fields"]["Glossary"]["value"]
+
+            bilingual_defs = [info["fields"][x]["value"].strip() for x in bilingual_fields]
+            bilingual_defs = [x for x in bilingual_defs if x] # filters out all empty fields
+
+            monolingual_defs = [info["fields"][x]["value"].strip() for x in monolingual_fields]
+            monolingual_defs = [x for x in monolingual_defs if x] # filters out all empty fields
+
+            if glossary_sel_txt: # almost always bilingual according to bilingual_def_txt
+                primary_def_txt = glossary_sel_txt
+                secondary_def_txt = bilingual_def_txt
+                extra_defs_txt = combine_defs(monolingual_defs)
+
+            elif bilingual_def_txt:
+                primary_def_txt = bilingual_def_txt
+                secondary_def_txt = ""
+                extra_defs_txt = combine_defs(monolingual_defs)
+
             else:
-                extra_defs_txt = "<ol>" + "".join(f"<li>{x}</li>" for x in extra_defs) + "</ol>"
-
-
-        action = {
-            "action": "updateNoteFields",
-            "params": {
-                "note": {
-                    "id": info["noteId"],
-                    "fields": {
-                        "PrimaryDefinition": primary_def_txt,
-                        "SecondaryDefinition": secondary_def_txt,
-                        "ExtraDefinitions": extra_defs_txt
-                    },
-                }
-            },
-        }
+                primary_def_txt = monolingual_defs[0] if monolingual_defs else ""
+                secondary_def_txt = combine_defs(bilingual_defs)
+                extra_defs = monolingual_defs[1:]
+                if len(extra_defs) == 0:
+                    extra_defs_txt = ""
+                else:
+                    extra_defs_txt = "<ol>" + "".join(f"<li>{x}</li>" for x in extra_defs) + "</ol>"
+
+            yield update_note_fields_action(
+                info["noteId"],
+                {
+                    "PrimaryDefinition": primary_def_txt,
+                    "SecondaryDefinition": secondary_def_txt,
+                    "ExtraDefinitions": extra_defs_txt
+                },
+            )
 
-        actions.append(action)
+    # the actions cannot be streamed here: the notes must be read before the user
+    # switches profiles
+    print("Combining monolingual & bilingual fields...")
+    actions = list(get_actions())
 
     user_input = input(f"Will update {len(actions)} notes. Type 'yes' once you switched to JPMN deck.\n> ")
     if user_input != "yes":
         print("Input was not 'yes', exiting...")
         return
-    notes = invoke("multi", actions=actions)
+    update_notes(actions, total=len(actions))
 
 
+def main():
+    global chunk_size, mirror, journal
 
+    args = get_args()
+    chunk_size = args.chunk_size
+    if not args.no_mirror:
+        mirror = get_note_mirror()
+    journal = open_journal(
+        "batch",
+        {
+            "function": args.function,
+            "fill_field": args.fill_field,
+            "empty_field": args.empty_field,
+        },
+        resume=args.resume,
+    )
 
+    with tracing.run("batch", args):
+        if args.function:
+            assert args.function in globals(), f"function {args.function} does not exist"
+            func = globals()[args.function]
+            print(f"executing {args.function}")
+            func()
 
-def main():
-    args = get_args()
+        elif args.fill_field:
+            fill_field(args.fill_field)
 
-    if args.function:
-        assert args.function in globals(), f"function {args.function} does not exist"
-        func = globals()[args.function]
-        print(f"executing {args.function}")
-        func()
+        elif args.empty_field:
+            empty_field(args.empty_field)
 
-    elif args.fill_field:
-        fill_field(args.fill_field)
+    journal.finish()
 
-    elif args.empty_field:
-        empty_field(args.empty_field)
+    if mirror is not None:
+        print(mirror.report())
+        mirror.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,426 @@
+from __future__ import annotations
+
+"""
+performance suite of the tools, ran against fake_ankiconnect.py (Anki is not required)
+
+Each case is timed a few times at each size (number of notes, or media files),
+and the results are written as json. The results can be compared against a previous run
+(the baseline), so that regressions show up as numbers:
+
+    python3 benchmark.py --save-baseline           # on the main branch
+    python3 benchmark.py                           # on a change: compares against the baseline
+    python3 benchmark.py -k batch --sizes 1000 100000 --latency 0.002
+"""
+
+import io
+import os
+import json
+import shutil
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+
+from dataclasses import dataclass, asdict
+from typing import Any, Callable
+
+import batch
+import utils
+import install
+import tracing
+import ankiconnect
+from action_runner import ActionRunner
+from fake_ankiconnect import FakeAnkiConnect, FakeCollection
+from generate_collection import generate_collection
+from note_changes import NOTE_CHANGES, Version
+
+
+BENCHMARK_FOLDER = "benchmark"
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_REPEAT = 3
+REGRESSION_THRESHOLD = 1.2  # slower than the baseline by this ratio is reported as a regression
+MEDIA_FILE_SIZE = 32 * 1024
+
+
+@dataclass
+class BenchmarkContext:
+    size: int | None
+    folder: str  # temporary folder for the case's files
+    latency: float
+    note_latency: float
+
+    def serve(self, collection: FakeCollection) -> FakeAnkiConnect:
+        """
+        starts a fake AnkiConnect that the tools use for the rest of the case
+        """
+        server = FakeAnkiConnect(
+            collection, latency=self.latency, note_latency=self.note_latency
+        ).start()
+        os.environ["ANKICONNECT_URL"] = server.url
+        return server
+
+
+# setup(context) -> (the function to time, cleanup function)
+Setup = Callable[[BenchmarkContext], tuple[Callable[[], Any], Callable[[], None]]]
+
+
+@dataclass
+class BenchmarkCase:
+    name: str
+    setup: Setup
+    sizes: list[int] | None  # None if the case doesn't depend on the size
+    unit: str = "notes"
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    size: int | None
+    times: list[float]
+    error: str | None = None
+
+    @property
+    def key(self) -> str:
+        return self.name if self.size is None else f"{self.name}[{self.size}]"
+
+    @property
+    def best(self) -> float:
+        return min(self.times) if self.times else float("nan")
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.times) if self.times else float("nan")
+
+
+BENCHMARKS: dict[str, BenchmarkCase] = {}
+
+
+def benchmark_case(name: str, sizes: list[int] | None = DEFAULT_SIZES, unit: str = "notes"):
+    """
+    registers a setup function as a benchmark case
+    """
+
+    def decorator(setup: Setup) -> Setup:
+        BENCHMARKS[name] = BenchmarkCase(name, setup, sizes, unit)
+        return setup
+
+    return decorator
+
+
+# make
+
+
+def _make_setup(context: BenchmarkContext, cold: bool):
+    import make
+
+    parser = argparse.ArgumentParser()
+    utils.add_args(parser)
+    make.add_args(parser)
+    build_folder = os.path.join(context.folder, "build")
+    args = parser.parse_args(["-f", build_folder] + (["--full-rebuild"] if cold else []))
+    if not cold:
+        make.main(args)  # the warm build only regenerates what changed
+
+    def run():
+        if cold:
+            # also removes the jinja bytecode cache
+            shutil.rmtree(build_folder, ignore_errors=True)
+        return make.main(args)
+
+    return run, lambda: None
+
+
+@benchmark_case("make.cold", sizes=None)
+def make_cold(context: BenchmarkContext):
+    return _make_setup(context, cold=True)
+
+
+@benchmark_case("make.warm", sizes=None)
+def make_warm(context: BenchmarkContext):
+    return _make_setup(context, cold=False)
+
+
+# batch
+
+
+def _transform_version(transform: batch.FieldTransform) -> Version | None:
+    """
+    the newest version whose fields include all the fields used by the transform
+    """
+    used = {*transform.reads, *transform.writes}
+    for data in NOTE_CHANGES:
+        if used <= set(data.fields):
+            return data.version
+    return None
+
+
+def _batch_setup(transform: batch.FieldTransform):
+    def setup(context: BenchmarkContext):
+        version = _transform_version(transform)
+        assert version is not None, f"no version has the fields used by {transform.name}"
+        assert context.size is not None
+
+        collection = generate_collection(context.size, version=version, legacy_fraction=0.5)
+        server = context.serve(collection.copy())
+        batch.mirror = None
+        batch.journal = None
+
+        def run():
+            server.collection = collection.copy()
+            return batch.run_transforms([transform])
+
+        return run, server.stop
+
+    return setup
+
+
+for _transform in batch.TRANSFORMS.values():
+    benchmark_case(f"batch.{_transform.name}")(_batch_setup(_transform))
+
+
+# action runner
+
+
+def _action_runner_setup(context: BenchmarkContext, execute: bool):
+    assert context.size is not None
+    first, last = NOTE_CHANGES[-1].version, NOTE_CHANGES[0].version
+    collection = generate_collection(context.size, version=first, legacy_fraction=0.5)
+    server = context.serve(collection.copy())
+    batch.mirror = None
+    batch.journal = None
+
+    def run():
+        server.collection = collection.copy()
+        runner = ActionRunner(first, last)
+        if execute:
+            return runner.run()
+        return runner.plan()
+
+    return run, server.stop
+
+
+@benchmark_case("action_runner.plan")
+def action_runner_plan(context: BenchmarkContext):
+    return _action_runner_setup(context, execute=False)
+
+
+@benchmark_case("action_runner.run")
+def action_runner_run(context: BenchmarkContext):
+    return _action_runner_setup(context, execute=True)
+
+
+# media
+
+
+@benchmark_case("install.media", sizes=[10, 100], unit="files")
+def install_media(context: BenchmarkContext):
+    assert context.size is not None
+    media_folder = os.path.join(context.folder, "media")
+    os.makedirs(media_folder, exist_ok=True)
+    file_names = [f"_jpmn-benchmark-{i}.bin" for i in range(context.size)]
+    for i, name in enumerate(file_names):
+        with open(os.path.join(media_folder, name), "wb") as f:
+            f.write(bytes([i % 256]) * MEDIA_FILE_SIZE)
+
+    server = context.serve(FakeCollection.empty_jpmn())
+
+    def run():
+        server.collection = FakeCollection.empty_jpmn()
+        installer = install.MediaInstaller(media_folder, media_folder, "", manifest=None)
+        installer.fetch_media_files(file_names)
+        installer.install_from_list(file_names, force=True)
+
+    return run, server.stop
+
+
+def run_case(
+    case: BenchmarkCase,
+    size: int | None,
+    repeat: int = DEFAULT_REPEAT,
+    latency: float = 0.0,
+    note_latency: float = 0.0,
+) -> BenchmarkResult:
+    """
+    times the case, with everything it prints hidden. Errors are recorded in the result
+    (i.e. make requires sass), rather than stopping the other cases.
+    """
+    result = BenchmarkResult(case.name, size, [])
+    previous_url = os.environ.get("ANKICONNECT_URL")
+    # the runs would otherwise overwrite the traces of the actual runs of the tools
+    tracing.tracer.enabled = False
+
+    with tempfile.TemporaryDirectory() as folder:
+        context = BenchmarkContext(size, folder, latency, note_latency)
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                func, cleanup = case.setup(context)
+                try:
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        func()
+                        result.times.append(time.perf_counter() - start)
+                finally:
+                    cleanup()
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+        finally:
+            tracing.tracer.enabled = True
+            if previous_url is None:
+                os.environ.pop("ANKICONNECT_URL", None)
+            else:
+                os.environ["ANKICONNECT_URL"] = previous_url
+            # the clients of the stopped servers are no longer needed
+            with ankiconnect._clients_lock:
+                for client in ankiconnect._clients.values():
+                    client.close()
+                ankiconnect._clients.clear()
+
+    return result
+
+
+def run_benchmarks(
+    names: list[str] | None = None,
+    sizes: list[int] | None = None,
+    repeat: int = DEFAULT_REPEAT,
+    latency: float = 0.0,
+    note_latency: float = 0.0,
+) -> list[BenchmarkResult]:
+    """
+    runs the cases whose names contain any of the given names (all cases by default)
+    """
+    results = []
+    for case in BENCHMARKS.values():
+        if names and not any(n in case.name for n in names):
+            continue
+        case_sizes = case.sizes
+        if sizes is not None and case.unit == "notes" and case.sizes is not None:
+            case_sizes = sizes
+        for size in case_sizes or [None]:
+            result = run_case(case, size, repeat, latency, note_latency)
+            print(format_result(result))
+            results.append(result)
+    return results
+
+
+def format_result(result: BenchmarkResult, baseline: dict[str, Any] | None = None) -> str:
+    if result.error is not None:
+        return f"    {result.key:<60} error: {result.error}"
+    line = f"    {result.key:<60} {result.best * 1000:>10.1f} ms (median {result.median * 1000:.1f} ms)"
+    if baseline is not None and result.key in baseline:
+        ratio = result.best / baseline[result.key]["best"]
+        line += f" {ratio:>6.2f}x"
+        if ratio > REGRESSION_THRESHOLD:
+            line += "  <-- regression"
+    return line
+
+
+def results_to_json(results: list[BenchmarkResult]) -> dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": {
+            r.key: {**asdict(r), "best": r.best, "median": r.median}
+            for r in results
+            if r.error is None
+        },
+    }
+
+
+def compare(results: list[BenchmarkResult], baseline: dict[str, Any]) -> list[str]:
+    """
+    prints the results relative to the baseline, and returns the cases that regressed
+    """
+    print("Compared to the baseline:")
+    regressions = []
+    for result in results:
+        print(format_result(result, baseline["results"]))
+        previous = baseline["results"].get(result.key)
+        if result.error is None and previous is not None:
+            if result.best / previous["best"] > REGRESSION_THRESHOLD:
+                regressions.append(result.key)
+    return regressions
+
+
+def get_args():
+    folder = os.path.join(utils.get_cache_folder(), BENCHMARK_FOLDER)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-k",
+        "--cases",
+        type=str,
+        nargs="*",
+        default=None,
+        help="only runs the cases whose names contain any of these (i.e. `batch make.warm`)",
+    )
+    parser.add_argument("--list", action="store_true", help="lists the cases and exits")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="collection sizes (or number of media files) to run the cases at",
+    )
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds added to every AnkiConnect request",
+    )
+    parser.add_argument(
+        "--note-latency",
+        type=float,
+        default=0.0,
+        help="seconds added per note read or written by AnkiConnect",
+    )
+    parser.add_argument("-o", "--output", type=str, default=os.path.join(folder, "latest.json"))
+    parser.add_argument("--baseline", type=str, default=os.path.join(folder, "baseline.json"))
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="stores the results as the baseline, instead of comparing against it",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exits with an error if any case regressed (i.e. for CI)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.list:
+        for case in BENCHMARKS.values():
+            print(f"{case.name:<60} {case.unit}: {case.sizes}")
+        return
+
+    results = run_benchmarks(
+        args.cases, args.sizes, args.repeat, args.latency, args.note_latency
+    )
+    data = results_to_json(results)
+
+    paths = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for path in paths:
+        utils.gen_dirs(path)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        print(f"Wrote the results to {os.path.relpath(path)}")
+
+    if args.save_baseline or not os.path.isfile(args.baseline):
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline)
+    if regressions:
+        print(f"{len(regressions)} cases are slower than the baseline: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
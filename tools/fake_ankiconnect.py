@@ -0,0 +1,620 @@
+from __future__ import annotations
+
+"""
+in-memory stand-in for AnkiConnect, to test and benchmark the tools without a running Anki
+
+The server implements the actions used by the tools over a FakeCollection, and can add
+a delay to every request (and every note read or written) to imitate a real collection.
+The tools use it when ANKICONNECT_URL points to it:
+
+    python3 fake_ankiconnect.py --notes 10000 --port 8766 --latency 0.005
+    ANKICONNECT_URL=http://localhost:8766 python3 batch.py -f ...
+
+Within python (i.e. in tests):
+
+    with FakeAnkiConnect(FakeCollection.synthetic(1000)) as server:
+        client = AnkiConnectClient(server.url)
+"""
+
+import re
+import copy
+import json
+import time
+import base64
+import random
+import fnmatch
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+import ankiconnect
+from note_changes import NOTE_CHANGES
+
+
+MODEL_NAME = "JP Mining Note"
+PROFILE = "User 1"
+FIRST_NOTE_ID = 1_600_000_000_000  # note ids are the creation time in ms
+
+rx_QUERY_TOKEN = re.compile(r'(-?)((?:[^\s"]|"(?:[^"\\]|\\.)*")+)')
+
+
+class FakeCollectionError(Exception):
+    pass
+
+
+def glob_to_regex(pattern: str) -> re.Pattern:
+    """
+    Anki's search wildcards: `*` matches anything, `_` matches a single character,
+    and both can be escaped with a backslash
+    """
+    result = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            result.append(re.escape(pattern[i + 1]))
+            i += 1
+        elif c == "*":
+            result.append(".*")
+        elif c == "_":
+            result.append(".")
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return re.compile("".join(result), re.DOTALL | re.IGNORECASE)
+
+
+class FakeCollection:
+    """
+    models (fields, templates and css), notes and media files, with the same structure
+    as returned by AnkiConnect
+    """
+
+    def __init__(
+        self,
+        models: dict[str, dict[str, Any]] | None = None,
+        notes: dict[int, dict[str, Any]] | None = None,
+        media: dict[str, bytes] | None = None,
+        profile: str = PROFILE,
+    ):
+        # {name: {"fields": [...], "templates": {card: {"Front": ..., "Back": ...}}, "css": ...}}
+        self.models = models or {}
+        # {id: {"modelName": ..., "fields": {name: value}, "tags": [...], "mod": ...}}
+        self.notes = notes or {}
+        self.media = media or {}
+        self.profile = profile
+        self.lock = threading.RLock()
+
+    @classmethod
+    def empty_jpmn(cls, version: str | None = None) -> FakeCollection:
+        """
+        a collection with only the JP Mining Note model, at the latest version of NOTE_CHANGES
+        """
+        if version is None:
+            version = ".".join(map(str, NOTE_CHANGES[0].version.ints))
+        front = f"<!-- JP Mining Note: Version {version} -->\n{{{{Word}}}}"
+        return cls(
+            models={
+                MODEL_NAME: {
+                    "fields": list(NOTE_CHANGES[0].fields),
+                    "templates": {"Mining Card": {"Front": front, "Back": front}},
+                    "css": "",
+                }
+            }
+        )
+
+    @classmethod
+    def synthetic(cls, num_notes: int, seed: int = 0) -> FakeCollection:
+        """
+        a collection of JP Mining Notes with a few simple fields filled in
+        """
+        rng = random.Random(seed)
+        collection = cls.empty_jpmn()
+        kana = [chr(c) for c in range(ord("ぁ"), ord("ゖ"))]
+        for i in range(num_notes):
+            reading = "".join(rng.choices(kana, k=rng.randint(1, 5)))
+            collection.add_note(
+                MODEL_NAME,
+                {"Key": f"{reading}{i}", "Word": reading, "WordReading": reading},
+                note_id=FIRST_NOTE_ID + i,
+            )
+        return collection
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> FakeCollection:
+        return cls(
+            models=data["models"],
+            notes={int(nid): note for nid, note in data["notes"].items()},
+            media={name: base64.b64decode(b64) for name, b64 in data.get("media", {}).items()},
+            profile=data.get("profile", PROFILE),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> FakeCollection:
+        with open(path, encoding="utf-8") as f:
+            return cls.from_json(json.load(f))
+
+    def to_json(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "profile": self.profile,
+                "models": self.models,
+                "notes": {str(nid): note for nid, note in self.notes.items()},
+                "media": {
+                    name: base64.b64encode(data).decode("ascii") for name, data in self.media.items()
+                },
+            }
+
+    def copy(self) -> FakeCollection:
+        with self.lock:
+            return FakeCollection(
+                copy.deepcopy(self.models), copy.deepcopy(self.notes), dict(self.media), self.profile
+            )
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False)
+
+    def add_note(
+        self,
+        model_name: str,
+        fields: dict[str, str],
+        tags: list[str] | None = None,
+        note_id: int | None = None,
+    ) -> int:
+        with self.lock:
+            if note_id is None:
+                note_id = max(self.notes, default=FIRST_NOTE_ID - 1) + 1
+            model_fields = self.model(model_name)["fields"]
+            self.notes[note_id] = {
+                "modelName": model_name,
+                "fields": {name: fields.get(name, "") for name in model_fields},
+                "tags": list(tags or []),
+                "mod": 0,
+            }
+            return note_id
+
+    def model(self, model_name: str) -> dict[str, Any]:
+        if model_name not in self.models:
+            raise FakeCollectionError(f"model was not found: {model_name}")
+        return self.models[model_name]
+
+    def note(self, note_id: int) -> dict[str, Any]:
+        if note_id not in self.notes:
+            raise FakeCollectionError(f"note was not found: {note_id}")
+        return self.notes[note_id]
+
+    def touch(self, note: dict[str, Any]):
+        note["mod"] += 1
+
+    # search
+
+    def _term_matcher(self, term: str) -> Callable[[int, dict[str, Any]], bool]:
+        if term.startswith('"') and term.endswith('"') and len(term) > 1:
+            term = term[1:-1]
+        term = term.replace('\\"', '"')
+
+        key, sep, value = term.partition(":")
+        if not sep:
+            rx = glob_to_regex(f"*{term}*")
+            return lambda nid, note: any(rx.fullmatch(v) for v in note["fields"].values())
+
+        key = key.strip('"').lower()
+        value = value.strip('"')
+        if key == "note":
+            rx = glob_to_regex(value)
+            return lambda nid, note: bool(rx.fullmatch(note["modelName"]))
+        if key == "tag":
+            rx = glob_to_regex(value)
+            return lambda nid, note: any(rx.fullmatch(t) for t in note["tags"])
+        if key == "added":
+            cutoff = (time.time() - int(value) * 86400) * 1000
+            return lambda nid, note: nid >= cutoff
+        if key in ("deck", "card", "is", "prop", "rated"):
+            raise FakeCollectionError(f"unsupported search: {term}")
+
+        rx = glob_to_regex(value)
+
+        def match_field(nid, note):
+            for name, field_value in note["fields"].items():
+                if name.lower() == key:
+                    return bool(rx.fullmatch(field_value))
+            return False
+
+        return match_field
+
+    def find_notes(self, query: str) -> list[int]:
+        """
+        supports note:, tag:, added:, field: and plain text searches, with negation (-)
+        and OR (which has a lower precedence than the implicit AND), but not parentheses
+        """
+        groups: list[list[tuple[bool, Callable]]] = [[]]
+        for negate, term in rx_QUERY_TOKEN.findall(query):
+            if term.upper() == "OR" and not negate:
+                groups.append([])
+            elif term in ("(", ")") or term.startswith("(") or term.endswith(")"):
+                raise FakeCollectionError(f"unsupported search: {query}")
+            else:
+                groups[-1].append((bool(negate), self._term_matcher(term)))
+
+        with self.lock:
+            return [
+                nid
+                for nid, note in self.notes.items()
+                if any(
+                    all(matcher(nid, note) != negate for negate, matcher in group)
+                    for group in groups
+                )
+            ]
+
+    def _update_note_fields(self, model_name: str, fields: list[str], mapping: dict[str, str]):
+        """
+        changes the fields of the model's notes to the given fields, where mapping is
+        {new name: old name} for the renamed fields
+        """
+        for note in self.notes.values():
+            if note["modelName"] == model_name:
+                values = note["fields"]
+                note["fields"] = {name: values.get(mapping.get(name, name), "") for name in fields}
+                self.touch(note)
+
+
+class FakeAnkiConnect:
+    """
+    serves a FakeCollection with the AnkiConnect api (version 6)
+
+    - latency: seconds added to every request (once per `multi`, not per action within it)
+    - note_latency: seconds added per note read or written, as Anki takes longer to handle
+      larger requests
+    - keep_alive: keeps the connection open after each response. AnkiConnect closes it,
+      so this is only useful to compare against a server that doesn't
+    """
+
+    def __init__(
+        self,
+        collection: FakeCollection,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        note_latency: float = 0.0,
+        keep_alive: bool = False,
+    ):
+        self.collection = collection
+        self.latency = latency
+        self.note_latency = note_latency
+        self.keep_alive = keep_alive
+        self.calls: dict[str, int] = {}
+        self.multi_calls: dict[str, int] = {}  # actions sent within `multi`
+        self._calls_lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self  # type: ignore
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> FakeAnkiConnect:
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> FakeAnkiConnect:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, data: dict[str, Any]) -> dict[str, Any]:
+        """
+        the response to a request, with the same format as AnkiConnect
+        """
+        action = data.get("action", "")
+        with self._calls_lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        return self._dispatch(data)
+
+    def _dispatch(self, data: dict[str, Any]) -> dict[str, Any]:
+        action = data.get("action", "")
+        try:
+            func = getattr(self, f"action_{action}", None)
+            if func is None:
+                raise FakeCollectionError(f"unsupported action: {action}")
+            result = func(**data.get("params", {}))
+        except Exception as e:
+            return {"result": None, "error": str(e)}
+        return {"result": result, "error": None}
+
+    def _delay_notes(self, count: int):
+        if self.note_latency:
+            time.sleep(self.note_latency * count)
+
+    # misc
+
+    def action_version(self):
+        return ankiconnect.ANKICONNECT_VERSION
+
+    def action_getActiveProfile(self):
+        return self.collection.profile
+
+    def action_apiReflect(self, scopes: list[str], actions: list[str] | None = None):
+        supported = [n[len("action_"):] for n in dir(self) if n.startswith("action_")]
+        if actions is not None:
+            supported = [a for a in supported if a in actions]
+        return {"scopes": [s for s in scopes if s == "actions"], "actions": supported}
+
+    def action_multi(self, actions: list[dict[str, Any]]):
+        with self._calls_lock:
+            for a in actions:
+                name = a.get("action", "")
+                self.multi_calls[name] = self.multi_calls.get(name, 0) + 1
+        # part of a single request, so the latency was already added once
+        return [self._dispatch(a) for a in actions]
+
+    def action_importPackage(self, path: str):
+        return True
+
+    def action_exportPackage(self, deck: str, path: str, includeSched: bool = False):
+        return True
+
+    def action_guiBrowse(self, query: str):
+        return self.collection.find_notes(query)
+
+    # models
+
+    def action_modelNames(self):
+        return list(self.collection.models)
+
+    def action_modelFieldNames(self, modelName: str):
+        return list(self.collection.model(modelName)["fields"])
+
+    def action_modelTemplates(self, modelName: str):
+        return self.collection.model(modelName)["templates"]
+
+    def action_modelStyling(self, modelName: str):
+        return {"css": self.collection.model(modelName)["css"]}
+
+    def action_updateModelTemplates(self, model: dict[str, Any]):
+        with self.collection.lock:
+            templates = self.collection.model(model["name"])["templates"]
+            for name, sides in model["templates"].items():
+                if name not in templates:
+                    raise FakeCollectionError(f"template was not found: {name}")
+                templates[name].update(sides)
+
+    def action_updateModelStyling(self, model: dict[str, Any]):
+        with self.collection.lock:
+            self.collection.model(model["name"])["css"] = model["css"]
+
+    def action_modelFieldRename(self, modelName: str, oldFieldName: str, newFieldName: str):
+        with self.collection.lock:
+            fields = self.collection.model(modelName)["fields"]
+            if oldFieldName not in fields:
+                raise FakeCollectionError(f"field was not found: {oldFieldName}")
+            if newFieldName in fields:
+                raise FakeCollectionError(f"field already exists: {newFieldName}")
+            fields[fields.index(oldFieldName)] = newFieldName
+            self.collection._update_note_fields(modelName, fields, {newFieldName: oldFieldName})
+
+    def action_modelFieldReposition(self, modelName: str, fieldName: str, index: int):
+        with self.collection.lock:
+            fields = self.collection.model(modelName)["fields"]
+            if fieldName not in fields:
+                raise FakeCollectionError(f"field was not found: {fieldName}")
+            fields.remove(fieldName)
+            fields.insert(index, fieldName)
+            self.collection._update_note_fields(modelName, fields, {})
+
+    def action_modelFieldAdd(self, modelName: str, fieldName: str, index: int | None = None):
+        with self.collection.lock:
+            fields = self.collection.model(modelName)["fields"]
+            if fieldName in fields:
+                raise FakeCollectionError(f"field already exists: {fieldName}")
+            fields.insert(len(fields) if index is None else index, fieldName)
+            self.collection._update_note_fields(modelName, fields, {})
+
+    def action_modelFieldRemove(self, modelName: str, fieldName: str):
+        with self.collection.lock:
+            fields = self.collection.model(modelName)["fields"]
+            if fieldName not in fields:
+                raise FakeCollectionError(f"field was not found: {fieldName}")
+            fields.remove(fieldName)
+            self.collection._update_note_fields(modelName, fields, {})
+
+    # notes
+
+    def action_findNotes(self, query: str):
+        return self.collection.find_notes(query)
+
+    def action_notesInfo(self, notes: list[int]):
+        self._delay_notes(len(notes))
+        with self.collection.lock:
+            result = []
+            for nid in notes:
+                note = self.collection.notes.get(nid)
+                if note is None:
+                    result.append({})
+                    continue
+                result.append(
+                    {
+                        "noteId": nid,
+                        "modelName": note["modelName"],
+                        "tags": list(note["tags"]),
+                        "fields": {
+                            name: {"value": value, "order": i}
+                            for i, (name, value) in enumerate(note["fields"].items())
+                        },
+                        "mod": note["mod"],
+                        "cards": [],
+                    }
+                )
+            return result
+
+    def action_notesModTime(self, notes: list[int]):
+        with self.collection.lock:
+            return [
+                {"noteId": nid, "mod": self.collection.note(nid)["mod"]} for nid in notes
+            ]
+
+    def action_updateNoteFields(self, note: dict[str, Any]):
+        self._delay_notes(1)
+        with self.collection.lock:
+            stored = self.collection.note(note["id"])
+            for name, value in note["fields"].items():
+                if name in stored["fields"]:
+                    stored["fields"][name] = value
+            self.collection.touch(stored)
+
+    def action_addTags(self, notes: list[int], tags: str):
+        with self.collection.lock:
+            for nid in notes:
+                note = self.collection.note(nid)
+                note["tags"].extend(t for t in tags.split() if t not in note["tags"])
+                self.collection.touch(note)
+
+    def action_deleteNotes(self, notes: list[int]):
+        with self.collection.lock:
+            for nid in notes:
+                self.collection.notes.pop(nid, None)
+
+    # media
+
+    def action_storeMediaFile(
+        self,
+        filename: str,
+        data: str | None = None,
+        path: str | None = None,
+        deleteExisting: bool = True,
+    ):
+        if data is not None:
+            contents = base64.b64decode(data)
+        elif path is not None:
+            with open(path, "rb") as f:
+                contents = f.read()
+        else:
+            raise FakeCollectionError("storeMediaFile requires data or path")
+        with self.collection.lock:
+            self.collection.media[filename] = contents
+        return filename
+
+    def action_retrieveMediaFile(self, filename: str):
+        with self.collection.lock:
+            contents = self.collection.media.get(filename)
+        if contents is None:
+            return False
+        return base64.b64encode(contents).decode("ascii")
+
+    def action_getMediaFilesNames(self, pattern: str = "*"):
+        with self.collection.lock:
+            return [name for name in self.collection.media if fnmatch.fnmatchcase(name, pattern)]
+
+    def action_deleteMediaFile(self, filename: str):
+        with self.collection.lock:
+            self.collection.media.pop(filename, None)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # sends the headers and body together, otherwise each response waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        fake: FakeAnkiConnect = self.server.fake  # type: ignore
+        try:
+            data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            response = fake.handle(data)
+        except ValueError as e:
+            response = {"result": None, "error": f"invalid request: {e}"}
+
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if fake.keep_alive:
+            self.send_header("Connection", "keep-alive")
+        else:
+            # like AnkiConnect, which closes the connection after each response
+            # without a `Connection: close` header
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument(
+        "--notes",
+        type=int,
+        default=1000,
+        help="number of notes in the synthetic collection",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--collection",
+        type=str,
+        default=None,
+        help="json file of the collection to serve, instead of a synthetic collection",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds added to every request",
+    )
+    parser.add_argument(
+        "--note-latency",
+        type=float,
+        default=0.0,
+        help="seconds added per note read or written",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        action="store_true",
+        help="keeps connections open between requests (AnkiConnect closes them)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.collection is not None:
+        collection = FakeCollection.load(args.collection)
+    else:
+        collection = FakeCollection.synthetic(args.notes, seed=args.seed)
+
+    server = FakeAnkiConnect(
+        collection,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        note_latency=args.note_latency,
+        keep_alive=args.keep_alive,
+    )
+    print(f"Serving {len(collection.notes)} notes on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
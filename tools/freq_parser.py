@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+"""
+parses the html of the FrequenciesStylized field
+
+This replaces BeautifulSoup for the batch updates: the field is always generated by
+the Yomichan templates, so the groups can be found with a single compiled regex.
+If the html doesn't have the expected structure (i.e. was edited by hand),
+the html is parsed with html.parser instead.
+
+Run this file to benchmark the parser against BeautifulSoup (if installed):
+
+    python3 freq_parser.py
+"""
+
+import re
+import html
+import timeit
+
+from dataclasses import dataclass
+from html.parser import HTMLParser
+
+
+rx_END_DIV = re.compile(r"</div>$")
+rx_FREQ_INNER2 = re.compile(r'<span class="frequencies__dictionary-inner2">(.*?)</span>')
+rx_FREQ_GROUP = re.compile(
+    r'<div class="frequencies__group" data-details="([^"]*)">'
+    r'<div class="frequencies__number"><span class="frequencies__number-inner">([^<]*)</span>'
+)
+rx_NOT_DIGIT = re.compile(r"\D+")
+
+FREQ_GROUP_CLASS = "frequencies__group"
+DIV_FREQ = '<div class="frequencies">'
+
+# elements without an end tag, which must not be counted in the parser's depth
+VOID_ELEMENTS = frozenset(
+    "area base br col embed hr img input link meta source track wbr".split()
+)
+
+# example of legacy freq styling (0.10.1.0)
+EXAMPLE_LEGACY_HTML = r"""<div class="frequencies"><div class="frequencies__group" data-details="Anime &amp; Jdrama Freq:"><div class="frequencies__number"><span class="frequencies__number-inner">6155</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">Anime &amp; Jdrama Freq:</span></span></div></div><div class="frequencies__group" data-details="Innocent Ranked"><div class="frequencies__number"><span class="frequencies__number-inner">3863</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">Innocent Ranked</span></span></div></div><div class="frequencies__group" data-details="JPDB"><div class="frequencies__number"><span class="frequencies__number-inner">8418</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">JPDB</span></span></div></div><div class="frequencies__group" data-details="JPDB"><div class="frequencies__number"><span class="frequencies__number-inner">37625㋕</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">JPDB</span></span></div></div><div class="frequencies__group" data-details="VN Freq Percent"><div class="frequencies__number"><span class="frequencies__number-inner">92.7</span></div><div class="frequencies__dictionary"><span class="frequencies__dictionary-inner"><span class="frequencies__dictionary-inner2">VN Freq Percent</span></span></div></div></div>"""
+
+
+@dataclass(frozen=True)
+class Frequency:
+    details: str  # dictionary name, i.e. "JPDB"
+    number: str  # displayed text, i.e. "37625㋕"
+
+    def value(self) -> int:
+        """
+        the displayed number with all non-digits removed
+        """
+        return int(rx_NOT_DIGIT.sub("", self.number))
+
+
+class _FrequencyHTMLParser(HTMLParser):
+    """
+    finds the frequency groups, and the text of the first span
+    within the first div of each group
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.frequencies: list[Frequency] = []
+
+        self._depth = 0
+        self._group_depth: int | None = None  # depth of the current group
+        self._details = ""
+        self._number_div_depth: int | None = None
+        self._number_span_depth: int | None = None
+        self._number: list[str] | None = None
+        self._found_number = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+        self._depth += 1
+        attrs = dict(attrs)
+
+        if self._group_depth is None:
+            if tag == "div" and FREQ_GROUP_CLASS in (attrs.get("class") or "").split():
+                self._group_depth = self._depth
+                self._details = attrs.get("data-details") or ""
+                self._found_number = False
+            return
+
+        if self._found_number:
+            return
+        if self._number_div_depth is None:
+            if tag == "div":
+                self._number_div_depth = self._depth
+        elif self._number_span_depth is None and tag == "span":
+            self._number_span_depth = self._depth
+            self._number = []
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+        if self._depth == self._number_span_depth:
+            self._number_span_depth = None
+            self._found_number = True
+        if self._depth == self._number_div_depth:
+            self._number_div_depth = None
+            self._found_number = True
+
+        if self._depth == self._group_depth:
+            number = "".join(self._number) if self._number is not None else ""
+            self.frequencies.append(Frequency(self._details, number))
+            self._group_depth = None
+            self._number = None
+        self._depth -= 1
+
+    def handle_data(self, data):
+        if self._number is not None and self._number_span_depth is not None:
+            self._number.append(data)
+
+
+def parse_frequencies_slow(html_str: str) -> list[Frequency]:
+    """
+    parse_frequencies() with html.parser, for any html
+    """
+    parser = _FrequencyHTMLParser()
+    parser.feed(html_str)
+    parser.close()
+    return parser.frequencies
+
+
+def parse_frequencies(html_str: str) -> list[Frequency]:
+    """
+    all frequency groups, in order, for both the legacy and current styling
+    """
+    matches = rx_FREQ_GROUP.findall(html_str)
+    if len(matches) != html_str.count(FREQ_GROUP_CLASS):
+        # not generated by the templates
+        return parse_frequencies_slow(html_str)
+    return [Frequency(html.unescape(d), html.unescape(n)) for d, n in matches]
+
+
+def min_frequency(html_str: str, ignored: list[str]) -> int:
+    """
+    the smallest frequency number, ignoring the given dictionaries, or 0 if there
+    are no frequencies
+    """
+    assert FREQ_GROUP_CLASS in html_str or DIV_FREQ in html_str, html_str
+
+    freqs = [f.value() for f in parse_frequencies(html_str) if f.details not in ignored]
+    if freqs:
+        return min(freqs)
+    return 0
+
+
+def standardize_legacy_html(freq: str) -> str:
+    """
+    updating legacy freq styling 0.10.1.0 -> 0.10.2.0 (see EXAMPLE_LEGACY_HTML)
+    """
+    if DIV_FREQ in freq:
+        freq = freq.replace(DIV_FREQ, "")
+        freq = rx_END_DIV.sub("", freq)
+
+    freq = rx_FREQ_INNER2.sub(r"\1", freq, count=0)
+    return freq
+
+
+def _min_frequency_bs4(html_str: str, ignored: list[str]) -> int:
+    """
+    the original BeautifulSoup implementation, only kept for the benchmark
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_str, "html.parser")
+    assert soup.div is not None
+
+    freqs = []
+    for x in soup.div.children:
+        if x["data-details"] not in ignored:
+            freqs.append(int("".join(c for c in str(x.div.span.get_text()) if c.isdigit())))
+    return min(freqs) if freqs else 0
+
+
+def benchmark(number: int = 2000):
+    ignored = ["VN Freq Percent"]
+    funcs = {
+        "compiled regex": lambda: min_frequency(EXAMPLE_LEGACY_HTML, ignored),
+        "html.parser": lambda: min(
+            f.value()
+            for f in parse_frequencies_slow(EXAMPLE_LEGACY_HTML)
+            if f.details not in ignored
+        ),
+    }
+    try:
+        import bs4  # noqa: F401
+
+        funcs["BeautifulSoup"] = lambda: _min_frequency_bs4(EXAMPLE_LEGACY_HTML, ignored)
+    except ImportError:
+        print("(BeautifulSoup is not installed, skipping)")
+
+    results = {}
+    for name, func in funcs.items():
+        assert func() == 3863, name
+        results[name] = timeit.timeit(func, number=number) / number
+
+    slowest = max(results.values())
+    for name, seconds in results.items():
+        print(f"{name:<16} {seconds * 1e6:>9.1f} us/note {slowest / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,475 @@
+from __future__ import annotations
+
+"""
+deterministic generator of realistic JP Mining Note collections, to test and benchmark
+the tools at production scale
+
+The notes are generated with the fields of any version in NOTE_CHANGES (the latest by default),
+and are the same for the same seed. The collection can be written as:
+- a json fixture for fake_ankiconnect.py (written while the notes are generated,
+  so even 1M notes don't have to fit in memory)
+- an .apkg file, if the `anki` python package is installed
+
+    python3 generate_collection.py --notes 100000 --seed 0 -o build/collection.json
+    python3 fake_ankiconnect.py --collection build/collection.json
+"""
+
+import os
+import html
+import json
+import tempfile
+import random
+import argparse
+
+from typing import Any, Iterator
+
+import utils
+from batch import (
+    SPAN_DOWNSTEP_INNER,
+    SPAN_DOWNSTEP_ARROW,
+    SPAN_DOWNSTEP_EMPTY,
+    SPAN_DOWNSTEP_UCODE,
+)
+from fake_ankiconnect import FakeCollection, FIRST_NOTE_ID, MODEL_NAME
+from note_changes import NOTE_CHANGES, Version, NoteChange
+
+
+# (text, reading) segments of each word, where reading is None for kana
+NOUNS = [
+    [("自然", "しぜん")],
+    [("人生", "じんせい")],
+    [("弱点", "じゃくてん")],
+    [("道具", "どうぐ")],
+    [("身長", "しんちょう")],
+    [("偽者", "にせもの")],
+    [("勢", "いきお"), ("い", None)],
+    [("毒", "どく")],
+    [("皿", "さら")],
+    [("世界", "せかい")],
+    [("時間", "じかん")],
+    [("言葉", "ことば")],
+    [("気持", "きも"), ("ち", None)],
+    [("意味", "いみ")],
+    [("電車", "でんしゃ")],
+    [("学校", "がっこう")],
+    [("約束", "やくそく")],
+    [("記憶", "きおく")],
+    [("景色", "けしき")],
+    [("関係", "かんけい")],
+    [("経験", "けいけん")],
+    [("問題", "もんだい")],
+    [("物語", "ものがたり")],
+    [("未来", "みらい")],
+    [("魔法", "まほう")],
+]
+VERBS = [
+    [("成", "な"), ("り", None), ("立", "た"), ("つ", None)],
+    [("驚", "おどろ"), ("く", None)],
+    [("食", "く"), ("らう", None)],
+    [("諦", "あきら"), ("める", None)],
+    [("考", "かんが"), ("える", None)],
+    [("話", "はな"), ("し", None), ("合", "あ"), ("う", None)],
+    [("思", "おも"), ("い", None), ("出", "だ"), ("す", None)],
+    [("美", "うつく"), ("しい", None)],
+    [("懐", "なつ"), ("かしい", None)],
+    [("眩", "まぶ"), ("しい", None)],
+]
+# single kanji with their on'yomi, combined into (made up) compound words, so that
+# large collections still have mostly unique words
+KANJI = [
+    ("安", "あん"), ("意", "い"), ("運", "うん"), ("映", "えい"), ("音", "おん"), ("家", "か"),
+    ("会", "かい"), ("学", "がく"), ("感", "かん"), ("気", "き"), ("強", "きょう"), ("空", "くう"),
+    ("計", "けい"), ("研", "けん"), ("交", "こう"), ("国", "こく"), ("作", "さく"), ("産", "さん"),
+    ("試", "し"), ("時", "じ"), ("社", "しゃ"), ("手", "しゅ"), ("重", "じゅう"), ("出", "しゅつ"),
+    ("商", "しょう"), ("情", "じょう"), ("心", "しん"), ("人", "じん"), ("生", "せい"), ("成", "せい"),
+    ("説", "せつ"), ("戦", "せん"), ("想", "そう"), ("速", "そく"), ("体", "たい"), ("代", "だい"),
+    ("地", "ち"), ("着", "ちゃく"), ("調", "ちょう"), ("通", "つう"), ("定", "てい"), ("天", "てん"),
+    ("動", "どう"), ("特", "とく"), ("内", "ない"), ("日", "にち"), ("熱", "ねつ"), ("能", "のう"),
+    ("発", "はつ"), ("判", "はん"), ("表", "ひょう"), ("品", "ひん"), ("風", "ふう"), ("物", "ぶつ"),
+    ("文", "ぶん"), ("変", "へん"), ("方", "ほう"), ("本", "ほん"), ("万", "まん"), ("密", "みつ"),
+    ("名", "めい"), ("面", "めん"), ("問", "もん"), ("役", "やく"), ("有", "ゆう"), ("用", "よう"),
+    ("予", "よ"), ("理", "り"), ("力", "りょく"), ("流", "りゅう"), ("料", "りょう"), ("論", "ろん"),
+]
+KANA_WORDS = ["ねこ", "やっぱり", "ちょっと", "すごい", "まさか", "ぐっすり", "ふわふわ", "しっかり"]
+
+FILLER_BEFORE = ["それは", "あの時の", "彼女の", "俺たちの", "まるで", "本当に", "もう"]
+FILLER_AFTER = ["だった。", "じゃないか。", "なんだよね。", "かもしれない。", "を忘れない。", "です。"]
+
+# (dictionary, minimum, maximum) of the frequency lists used by the yomichan templates
+FREQUENCY_DICTIONARIES = [
+    ("JPDB", 1, 300_000),
+    ("Innocent Ranked", 1, 100_000),
+    ("Anime & Jdrama Freq:", 1, 200_000),
+    ("Novels", 1, 150_000),
+    ("VN Freq Percent", 1, 100),
+]
+PITCH_DICTIONARIES = ["NHK", "大辞泉"]
+CARD_TYPE_CHANCES = [
+    ("IsSentenceCard", 0.1),
+    ("IsClickCard", 0.05),
+    ("IsHoverCard", 0.05),
+    ("PASeparateWordCard", 0.02),
+]
+
+# positions and text formats (see autopa.md)
+PA_OVERRIDE_VALUES = ["0", "1", "2", "-1", "0,2", "<b>1</b>,3", "じ＼んせい", "しんちょう￣", "ち＼か・ちか＼"]
+SMALL_KANA = set("ゃゅょぁぃぅぇぉャュョァィゥェォ")
+HIRA2KATA = str.maketrans({chr(c): chr(c + 0x60) for c in range(ord("ぁ"), ord("ゖ") + 1)})
+
+
+def get_note_change(version: Version | None) -> NoteChange:
+    """
+    the NoteChange with the fields of the given version (the latest by default)
+    """
+    if version is None:
+        return NOTE_CHANGES[0]
+    for data in NOTE_CHANGES:
+        if data.version <= version:
+            return data
+    return NOTE_CHANGES[-1]
+
+
+def split_mora(kana: str) -> list[str]:
+    mora: list[str] = []
+    for c in kana:
+        if c in SMALL_KANA and mora:
+            mora[-1] += c
+        else:
+            mora.append(c)
+    return mora
+
+
+def format_furigana(segments: list[tuple[str, str | None]]) -> str:
+    """
+    the furigana syntax used by Anki and Yomichan, i.e. `成[な]り 立[た]つ`
+    """
+    result = ""
+    for text, reading in segments:
+        if reading is None:
+            result += text
+        else:
+            result += (" " if result else "") + f"{text}[{reading}]"
+    return result
+
+
+def format_pitch(kana: str, position: int, downstep: str) -> str:
+    """
+    the katakana reading with the pitch overline and downstep spans (as AJT Pitch Accent)
+    """
+    mora = split_mora(kana.translate(HIRA2KATA))
+    overline = '<span class="pitchoverline">{}</span>'
+    if position == 0:
+        return mora[0] + overline.format("".join(mora[1:]))
+    if position == 1:
+        return overline.format(mora[0]) + downstep + "".join(mora[1:])
+    return (
+        mora[0]
+        + overline.format("".join(mora[1:position]))
+        + downstep
+        + "".join(mora[position:])
+    )
+
+
+def format_frequencies(frequencies: list[tuple[str, str]], legacy: bool) -> str:
+    """
+    the FrequenciesStylized field, with the current or legacy (0.10.1.0) styling
+    (see freq_parser.EXAMPLE_LEGACY_HTML)
+    """
+    groups = []
+    for dictionary, number in frequencies:
+        dictionary = html.escape(dictionary, quote=True)
+        inner = dictionary
+        if legacy:
+            inner = f'<span class="frequencies__dictionary-inner2">{dictionary}</span>'
+        groups.append(
+            f'<div class="frequencies__group" data-details="{dictionary}">'
+            '<div class="frequencies__number">'
+            f'<span class="frequencies__number-inner">{number}</span></div>'
+            '<div class="frequencies__dictionary">'
+            f'<span class="frequencies__dictionary-inner">{inner}</span></div>'
+            "</div>"
+        )
+    if legacy:
+        return '<div class="frequencies">' + "".join(groups) + "</div>"
+    return "".join(groups)
+
+
+def format_pa_positions(positions: list[tuple[str, int]]) -> str:
+    return "".join(
+        f'<div class="pa-positions__group" data-details="{dictionary}">'
+        '<div class="pa-positions__dictionary">'
+        f'<div class="pa-positions__dictionary-inner">{dictionary}</div></div>'
+        '<ol><li><span style="display:inline;">'
+        f"<span>[</span><span>{position}</span><span>]</span></span></li></ol>"
+        "</div>"
+        for dictionary, position in positions
+    )
+
+
+def format_definition(rng: random.Random, word: str, dictionary: str) -> str:
+    lines = [
+        f"{word}の意味{i}。{rng.choice(FILLER_BEFORE)}{word}{rng.choice(FILLER_AFTER)}"
+        for i in range(rng.randint(1, 4))
+    ]
+    return (
+        '<span class="dict-group__tag-list"><span class="dict-group__tag dict-group__tag--dict">'
+        f'<span class="dict-group__tag-inner">{dictionary}</span></span></span>'
+        '<span class="dict-group__glossary">'
+        f'<span class="dict-group__glossary--first-line">{lines[0]}</span>'
+        '<span class="dict-group__glossary--first-line-break"><br></span>'
+        + "<br>".join(lines[1:])
+        + "</span>"
+    )
+
+
+def random_word(rng: random.Random) -> tuple[list[tuple[str, str | None]], bool]:
+    """
+    (segments, whether the word is written in kana only)
+    """
+    r = rng.random()
+    if r < 0.01:
+        return [(rng.choice(KANA_WORDS), None)], True
+    if r < 0.02:
+        return rng.choice(VERBS), False
+    if r < 0.03:
+        return rng.choice(NOUNS), False
+    kanji = rng.choices(KANJI, k=rng.choice([2, 2, 3, 3, 4]))
+    segments = [("".join(k for k, _ in kanji), "".join(r for _, r in kanji))]
+    if rng.random() < 0.15:
+        segments.append(rng.choice([("する", None), ("な", None), ("的", "てき")]))
+    return segments, False
+
+
+def generate_note(
+    rng: random.Random, index: int, fields: list[str], legacy_fraction: float = 0.0
+) -> tuple[dict[str, str], list[str]]:
+    """
+    (fields, tags) of a single note. Fields that aren't in the given fields are dropped.
+    """
+    segments, kana_only = random_word(rng)
+    word = "".join(text for text, _ in segments)
+    kana = "".join(reading or text for text, reading in segments)
+    mora = split_mora(kana)
+    legacy = rng.random() < legacy_fraction
+    tags = []
+
+    values: dict[str, str] = {"Key": word, "Word": word}
+
+    if kana_only:
+        values["WordReading"] = word
+    elif rng.random() < 0.02:
+        # readings that were exported without the furigana
+        values["WordReading"] = kana
+        tags.append("kanaonlyreading")
+    else:
+        values["WordReading"] = format_furigana(segments)
+    if rng.random() < 0.5:
+        values["WordReadingHiragana"] = kana
+
+    positions = sorted({rng.randint(0, len(mora)) for _ in range(rng.choice([1, 1, 1, 2]))})
+    if rng.random() < 0.8:
+        downstep = SPAN_DOWNSTEP_INNER
+        if legacy:
+            downstep = rng.choice([SPAN_DOWNSTEP_UCODE, SPAN_DOWNSTEP_ARROW, SPAN_DOWNSTEP_EMPTY])
+        pitch = "・".join(format_pitch(kana, p, downstep) for p in positions)
+        values["AJTWordPitch"] = pitch
+        values["WordPitch"] = pitch
+    if rng.random() < 0.9:
+        values["PAPositions"] = format_pa_positions(list(zip(PITCH_DICTIONARIES, positions)))
+        values["PAGraphs"] = f'<div class="pa-graphs">{len(mora)} mora: {positions}</div>'
+    elif rng.random() < 0.5:
+        values["PAGraphs"] = "No pitch accent data"
+    if rng.random() < 0.1:
+        values["PAOverride"] = rng.choice(PA_OVERRIDE_VALUES)
+    if rng.random() < 0.01:
+        values["PAOverrideText"] = f"{kana}（{rng.randint(0, 4)}）"
+
+    sentence = f"{rng.choice(FILLER_BEFORE)}<b>{word}</b>{rng.choice(FILLER_AFTER)}"
+    values["Sentence"] = sentence
+    if rng.random() < 0.3:
+        values["SentenceReading"] = sentence.replace(word, format_furigana(segments))
+
+    values["PrimaryDefinition"] = format_definition(rng, word, "明鏡国語辞典")
+    if rng.random() < 0.4:
+        values["SecondaryDefinition"] = format_definition(rng, word, "JMdict")
+    if rng.random() < 0.2:
+        values["ExtraDefinitions"] = format_definition(rng, word, "大辞林")
+    if rng.random() < 0.1:
+        values["UtilityDictionaries"] = format_definition(rng, word, "Kanjium")
+
+    if rng.random() < 0.95:
+        frequencies = []
+        count = rng.randint(1, len(FREQUENCY_DICTIONARIES))
+        for dictionary, low, high in rng.sample(FREQUENCY_DICTIONARIES, count):
+            number = str(int(low * (high / low) ** rng.random()))
+            if dictionary == "JPDB" and rng.random() < 0.2:
+                number += "㋕"
+            if legacy and dictionary == "VN Freq Percent":
+                dictionary = "VN Freq"  # renamed in 0.10.2.0
+            frequencies.append((dictionary, number))
+        values["FrequenciesStylized"] = format_frequencies(frequencies, legacy)
+        ranks = [int(n.rstrip("㋕")) for d, n in frequencies if not d.startswith("VN Freq")]
+        values["FrequencySort"] = str(min(ranks, default=0))
+
+    if rng.random() < 0.6:
+        values["Picture"] = f'<img src="jpmn_{index}.png">'
+    if rng.random() < 0.9:
+        values["WordAudio"] = f"[sound:{kana}_{index}.mp3]"
+    if rng.random() < 0.7:
+        values["SentenceAudio"] = f"[sound:sentence_{index}.mp3]"
+
+    for card_type, chance in CARD_TYPE_CHANCES:
+        if rng.random() < chance:
+            values[card_type] = "1"
+    if rng.random() < 0.05:
+        values["Comment"] = f"{word}について"
+
+    return {name: values.get(name, "") for name in fields}, tags
+
+
+def generate_notes(
+    num_notes: int,
+    seed: int = 0,
+    version: Version | None = None,
+    legacy_fraction: float = 0.0,
+) -> Iterator[tuple[int, dict[str, Any]]]:
+    """
+    (note id, note) pairs with the same structure as FakeCollection.notes
+    """
+    rng = random.Random(seed)
+    fields = get_note_change(version).fields
+    keys = set()
+    for i in range(num_notes):
+        # the same word is rarely mined twice
+        for _ in range(10):
+            note_fields, tags = generate_note(rng, i, fields, legacy_fraction)
+            if note_fields["Key"] not in keys:
+                break
+        keys.add(note_fields["Key"])
+        # about one note mined every 10 minutes
+        note_id = FIRST_NOTE_ID + i * 600_000 + rng.randrange(600_000)
+        yield note_id, {"modelName": MODEL_NAME, "fields": note_fields, "tags": tags, "mod": 0}
+
+
+def generate_collection(
+    num_notes: int,
+    seed: int = 0,
+    version: Version | None = None,
+    legacy_fraction: float = 0.0,
+) -> FakeCollection:
+    data = get_note_change(version)
+    collection = FakeCollection.empty_jpmn(".".join(map(str, data.version.ints)))
+    collection.models[MODEL_NAME]["fields"] = list(data.fields)
+    collection.notes.update(generate_notes(num_notes, seed, version, legacy_fraction))
+    return collection
+
+
+def write_fixture(
+    path: str,
+    num_notes: int,
+    seed: int = 0,
+    version: Version | None = None,
+    legacy_fraction: float = 0.0,
+):
+    """
+    writes the collection as json (see FakeCollection.load()), one note at a time
+    """
+    empty = generate_collection(0, seed, version).to_json()
+    utils.gen_dirs(path)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"profile": ' + json.dumps(empty["profile"]))
+        f.write(', "models": ' + json.dumps(empty["models"], ensure_ascii=False))
+        f.write(', "media": {}, "notes": {')
+        notes = generate_notes(num_notes, seed, version, legacy_fraction)
+        for i, (note_id, note) in enumerate(notes):
+            f.write((", " if i else "") + f'"{note_id}": ' + json.dumps(note, ensure_ascii=False))
+        f.write("}}\n")
+
+
+def write_apkg(
+    path: str,
+    num_notes: int,
+    seed: int = 0,
+    version: Version | None = None,
+    legacy_fraction: float = 0.0,
+):
+    """
+    writes the collection as an .apkg file. Requires the `anki` package (pip install anki).
+    """
+    try:
+        from anki.collection import Collection, ExportAnkiPackageOptions
+    except ImportError:
+        raise Exception("Writing an .apkg requires the anki package: pip install anki") from None
+
+    fake = generate_collection(0, seed, version)
+    model_data = fake.models[MODEL_NAME]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        col = Collection(os.path.join(tmp, "collection.anki2"))
+        try:
+            models = col.models
+            model = models.new(MODEL_NAME)
+            for name in model_data["fields"]:
+                models.add_field(model, models.new_field(name))
+            for name, sides in model_data["templates"].items():
+                template = models.new_template(name)
+                template["qfmt"] = sides["Front"]
+                template["afmt"] = sides["Back"]
+                models.add_template(model, template)
+            models.add(model)
+            model = models.by_name(MODEL_NAME)
+
+            deck_id = col.decks.id("JPMN Synthetic")
+            for _, data in generate_notes(num_notes, seed, version, legacy_fraction):
+                note = col.new_note(model)
+                for name, value in data["fields"].items():
+                    note[name] = value
+                note.tags = data["tags"]
+                col.add_note(note, deck_id)
+
+            utils.gen_dirs(path)
+            col.export_anki_package(
+                out_path=os.path.abspath(path),
+                options=ExportAnkiPackageOptions(
+                    with_scheduling=False, with_deck_configs=False, with_media=False, legacy=True
+                ),
+                limit=None,
+            )
+        finally:
+            col.close()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--version",
+        type=str,
+        default=None,
+        help="generates the notes with the fields of this version (i.e. 0.10.2.0)",
+    )
+    parser.add_argument(
+        "--legacy-fraction",
+        type=float,
+        default=0.0,
+        help="fraction of notes with the legacy frequency and pitch accent styling",
+    )
+    parser.add_argument("-o", "--output", type=str, default="build/collection.json")
+    parser.add_argument("--apkg", type=str, default=None, help="also writes the notes as an .apkg")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    version = None if args.version is None else Version.from_str(args.version)
+
+    write_fixture(args.output, args.notes, args.seed, version, args.legacy_fraction)
+    print(f"Wrote {args.notes} notes to {args.output}")
+    if args.apkg is not None:
+        write_apkg(args.apkg, args.notes, args.seed, version, args.legacy_fraction)
+        print(f"Wrote {args.notes} notes to {args.apkg}")
+
+
+if __name__ == "__main__":
+    main()
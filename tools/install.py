@@ -7,24 +7,41 @@ updateModelTemplates
 """
 
 import os
+import glob
+import json
 import base64
+import hashlib
 import argparse
 import datetime
+import threading
 import traceback
+import concurrent.futures
 
 from dataclasses import dataclass
 from typing import Any, Dict, List
 
 import utils
+import tracing
+import ankiconnect
 from utils import invoke
 
 import action_runner as ar
+from journal import open_journal
 
 
 FRONT_FILENAME = "front.html"
 BACK_FILENAME = "back.html"
 CSS_FILENAME = "style.css"
 TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+MEDIA_MANIFEST_FILENAME = "media-manifest.json"
+
+# number of media files sent to (or backed up from) Anki at the same time
+MEDIA_TRANSFER_WORKERS = 4
+# files are base64 encoded in blocks of this size when streamed to AnkiConnect
+# (must be a multiple of 3, so the encoded blocks can simply be concatenated)
+B64_ENCODE_BLOCK_SIZE = 3 * (1 << 16)
+# (must be a multiple of 4, for the same reason)
+B64_DECODE_BLOCK_SIZE = 4 * (1 << 16)
 
 
 @dataclass(frozen=True)
@@ -41,12 +58,6 @@ class NoteType:
     templates: List[CardTemplate]
 
 
-@dataclass(frozen=True)
-class MediaFile:
-    name: str
-    contents: str
-
-
 def add_args(parser: argparse.ArgumentParser):
     group = parser.add_argument_group(title="install")
     group.add_argument("--install-options", action="store_true")
@@ -79,6 +90,19 @@ def add_args(parser: argparse.ArgumentParser):
         "overwrites their note type.",
     )
 
+    group.add_argument(
+        "--plan",
+        action="store_true",
+        help="only shows the note changes that would be made when updating, with an estimate "
+        "of how long they would take. Nothing is modified.",
+    )
+
+    group.add_argument(
+        "--resume",
+        action="store_true",
+        help="continues the note changes of the previous update, if it was interrupted",
+    )
+
     group.add_argument(
         "--ignore-order",
         action="store_true",
@@ -102,6 +126,11 @@ class NoteUpdater:
         self.backup_folder = backup_folder
         self.note_config = note_config
 
+        # templates and css currently in Anki, fetched once (by either backup() or update()),
+        # unless given by probe_anki()
+        self._installed_templates: dict[str, dict[str, str]] | None = None
+        self._installed_css: str | None = None
+
     def read_css(self) -> str:
         input_path = os.path.join(
             self.input_folder, str(self.note_config("id").item()), CSS_FILENAME
@@ -109,6 +138,7 @@ class NoteUpdater:
         with open(input_path, encoding="utf-8") as f:
             return f.read()
 
+    @tracing.traced("install.backup_templates")
     def backup(self):
         """
         backs up as the following:
@@ -134,7 +164,7 @@ class NoteUpdater:
             with open(path, "w", encoding="utf-8") as f:
                 f.write(contents)
 
-        templates = invoke("modelTemplates", modelName=model_name)
+        templates = self.get_installed_templates()
         for card_name, values in templates.items():
             front = values["Front"]
             back = values["Back"]
@@ -143,7 +173,7 @@ class NoteUpdater:
             write_backup(folder, "front.html", front)
             write_backup(folder, "back.html", back)
 
-        css_contents = invoke("modelStyling", modelName=model_name)["css"]
+        css_contents = self.get_installed_css()
         folder = os.path.join(self.backup_folder, model_name)
         write_backup(folder, "style.css", css_contents)
 
@@ -192,15 +222,80 @@ class NoteUpdater:
     def format_styling(self, model: NoteType) -> Dict[str, Any]:
         return {"model": {"name": model.name, "css": model.css}}
 
+    def get_installed_templates(self) -> dict[str, dict[str, str]]:
+        """
+        {card name: {"Front": ..., "Back": ...}} of the note type in Anki
+        """
+        if self._installed_templates is None:
+            model_name = self.note_config("model-name").item()
+            self._installed_templates = invoke("modelTemplates", modelName=model_name)
+        return self._installed_templates
+
+    def get_installed_css(self) -> str:
+        if self._installed_css is None:
+            model_name = self.note_config("model-name").item()
+            self._installed_css = invoke("modelStyling", modelName=model_name)["css"]
+        return self._installed_css
+
+    def set_installed(self, templates: dict[str, dict[str, str]], css: str):
+        self._installed_templates = templates
+        self._installed_css = css
+
+    def clear_installed(self):
+        """
+        the templates and css are fetched from Anki again on next use
+        (i.e. after field changes, which also edit the templates)
+        """
+        self._installed_templates = None
+        self._installed_css = None
+
+    def get_changed_templates(self, model: NoteType) -> dict[str, dict[str, str]]:
+        """
+        the sides of each card template that differ from the ones in Anki
+        (AnkiConnect only replaces the templates and sides that are given)
+        """
+        installed = self.get_installed_templates()
+        changed = {}
+        for template in model.templates:
+            current = installed.get(template.name, {})
+            sides = {
+                side: contents
+                for side, contents in (("Front", template.front), ("Back", template.back))
+                if current.get(side) != contents
+            }
+            if sides:
+                changed[template.name] = sides
+        return changed
+
+    @tracing.traced("install.update_templates")
     def update(self):
+        """
+        only sends the templates and css that changed, as any model change
+        requires a full sync in Anki
+        """
         model = self.read_model()
-        if invoke("updateModelTemplates", **self.format_templates(model)) is None:
-            template_names = [t.name for t in model.templates]
-            print(
-                f"Updated {self.note_config('id').item()} templates {template_names} successfully."
-            )
-        if invoke("updateModelStyling", **self.format_styling(model)) is None:
-            print(f"Updated {self.note_config('id').item()} css successfully.")
+        note_id = self.note_config("id").item()
+
+        changed_templates = self.get_changed_templates(model)
+        if not changed_templates:
+            print(f"{note_id} templates are unchanged.")
+        else:
+            params = {"model": {"name": model.name, "templates": changed_templates}}
+            if invoke("updateModelTemplates", **params) is None:
+                changes = [
+                    f"{name} ({', '.join(sides).lower()})"
+                    for name, sides in changed_templates.items()
+                ]
+                print(f"Updated {note_id} templates {changes} successfully.")
+            for name, sides in changed_templates.items():
+                self.get_installed_templates().setdefault(name, {}).update(sides)
+
+        if self.get_installed_css() == model.css:
+            print(f"{note_id} css is unchanged.")
+        else:
+            if invoke("updateModelStyling", **self.format_styling(model)) is None:
+                print(f"Updated {note_id} css successfully.")
+            self._installed_css = model.css
 
 
 def b64_decode(contents):
@@ -217,24 +312,103 @@ def b64_encode(contents):
     return base64.b64encode(contents).decode("utf-8")
 
 
+def store_media_file_stream(
+    client: ankiconnect.AnkiConnectClient, file_name: str, path: str
+):
+    """
+    storeMediaFile, except the file is base64 encoded while it is being sent,
+    rather than building the entire request in memory first
+    """
+    head = json.dumps(
+        {
+            "action": "storeMediaFile",
+            "version": ankiconnect.ANKICONNECT_VERSION,
+            "params": {"filename": file_name, "data": ""},
+        }
+    )
+    # splits the request around the (empty) data string
+    head, tail = head.rsplit('""', 1)
+    head = (head + '"').encode("utf-8")
+    tail = ('"' + tail).encode("utf-8")
+
+    size = os.path.getsize(path)
+    length = len(head) + 4 * ((size + 2) // 3) + len(tail)
+
+    def body():
+        yield head
+        with open(path, mode="rb") as f:
+            for block in iter(lambda: f.read(B64_ENCODE_BLOCK_SIZE), b""):
+                yield base64.b64encode(block)
+        yield tail
+
+    return client.invoke_stream("storeMediaFile", body, length)
+
+
+class MediaManifest:
+    """
+    content hashes of the media files that were last installed, per Anki profile
+    """
+
+    def __init__(self, path: str, profile: str):
+        self.path = path
+        self.profile = profile
+        self.data: dict[str, dict[str, str]] = {}
+
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except ValueError:
+                print(f"Ignoring corrupted media manifest: {path}")
+
+    def get(self, file_name: str) -> str | None:
+        return self.data.get(self.profile, {}).get(file_name)
+
+    def set(self, file_name: str, file_hash: str):
+        self.data.setdefault(self.profile, {})[file_name] = file_hash
+
+    def save(self):
+        utils.gen_dirs(self.path)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 class MediaInstaller:
     """
     updates (and backs up, if specified) arbitrary media files
+
+    If a manifest is given, files whose contents are the same as the last installed
+    version are not sent again.
     """
 
-    def __init__(self, input_folder: str, static_folder: str, backup_folder: str):
+    def __init__(
+        self,
+        input_folder: str,
+        static_folder: str,
+        backup_folder: str,
+        manifest: MediaManifest | None = None,
+    ):
         self.input_folder = input_folder
         self.static_folder = static_folder
         self.backup_folder = backup_folder
+        self.manifest = manifest
 
-    def get_media_file(self, file_name, static=False) -> MediaFile:
-        input_folder = self.static_folder if static else self.input_folder
+        # names of the media files in Anki, fetched with one request on first use
+        self.anki_media_files: set[str] | None = None
+        # guards the above and the manifest, as files are installed concurrently
+        self._lock = threading.Lock()
 
-        with open(os.path.join(input_folder, file_name), mode="rb") as f:
-            contents = f.read()
-        return MediaFile(
-            name=file_name, contents=base64.b64encode(contents).decode("utf-8")
-        )
+    def get_media_path(self, file_name, static=False) -> str:
+        input_folder = self.static_folder if static else self.input_folder
+        return os.path.join(input_folder, file_name)
 
     def backup(self, file_name):
         # attempts to file from anki
@@ -244,50 +418,186 @@ class MediaInstaller:
             print(f"No backup is necessary: `{file_name}` doesn't exist")
             return
 
-        contents = base64.b64decode(contents_b64).decode("utf-8")
-
         backup_file_path = os.path.join(self.backup_folder, file_name)
         print(f"Backing up `{file_name}` -> `{os.path.relpath(backup_file_path)}` ...")
 
+        # decoded in blocks and written as is, so binary files (i.e. fonts)
+        # are backed up correctly without a second full copy in memory
         utils.gen_dirs(backup_file_path)
-        with open(backup_file_path, mode="w", encoding="utf-8") as f:
-            f.write(contents)
+        with open(backup_file_path, mode="wb") as f:
+            for i in range(0, len(contents_b64), B64_DECODE_BLOCK_SIZE):
+                f.write(base64.b64decode(contents_b64[i : i + B64_DECODE_BLOCK_SIZE]))
 
-    def format_media(self, media: MediaFile) -> Dict[str, Any]:
-        return {
-            "filename": media.name,
-            "data": media.contents,
-        }
+    def send_media(self, file_name: str, static=False):
+        path = self.get_media_path(file_name, static=static)
+        client = ankiconnect.get_client()
+
+        if client.is_local():
+            # AnkiConnect reads the file itself
+            result = invoke("storeMediaFile", filename=file_name, path=os.path.abspath(path))
+        else:
+            result = store_media_file_stream(client, file_name, path)
+
+        if result == file_name:
+            print(f"Updated '{file_name}' media file successfully.")
 
-    def send_media(self, media: MediaFile):
-        if invoke("storeMediaFile", **self.format_media(media)) == media.name:
-            print(f"Updated '{media.name}' media file successfully.")
+    @staticmethod
+    def get_media_files_pattern(file_names: list[str]) -> str | None:
+        """
+        pattern for getMediaFilesNames that matches all of the given files,
+        or None if there are no files
+        """
+        # AnkiConnect globs the media folder: only files that start with the same
+        # characters as the given files are listed, to not list the entire collection's media
+        first_chars = {name[0] for name in file_names if name}
+        if not first_chars:
+            return None
+        if all(c.isalnum() or c == "_" for c in first_chars):
+            return "[" + "".join(sorted(first_chars)) + "]*"
+        return "*"
+
+    @tracing.traced("install.fetch_media_files")
+    def fetch_media_files(self, file_names: list[str]):
+        """
+        gets which of the given files exist in Anki with a single request
+        """
+        pattern = self.get_media_files_pattern(file_names)
+        if pattern is None:
+            self.anki_media_files = set()
+            return
+        self.anki_media_files = set(invoke("getMediaFilesNames", pattern=pattern))
 
     def media_exists(self, file_name: str):
-        return bool(invoke("getMediaFilesNames", pattern=file_name))
+        if self.anki_media_files is None:
+            return bool(invoke("getMediaFilesNames", pattern=glob.escape(file_name)))
+        return file_name in self.anki_media_files
 
     def install_from_list(self, file_list, **kwargs):
-        for file in file_list:
-            self.install(file, **kwargs)
+        """
+        installs the files with at most MEDIA_TRANSFER_WORKERS transfers at a time
+        """
+        install = tracing.bind(self.install)
+        with concurrent.futures.ThreadPoolExecutor(MEDIA_TRANSFER_WORKERS) as executor:
+            futures = [executor.submit(install, file, **kwargs) for file in file_list]
+            for future in futures:
+                future.result()  # re-raises the first error
+
+    def install(self, file_name: str, static=False, backup=False, force=False):
+        """
+        - static: only installs the file if it doesn't exist
+        - force: sends the file even if it's the same as the last installed version
+        """
+        with tracing.span("install.media_file", file=file_name):
+            self._install(file_name, static, backup, force)
 
-    def install(self, file_name: str, static=False, backup=False):
-        if static:
+    def _install(self, file_name: str, static: bool, backup: bool, force: bool):
+        exists = self.media_exists(file_name)
+        if static and exists:
             # only adds if the media file doesn't already exist
-            if self.media_exists(file_name):
+            return
+
+        file_hash = None
+        if self.manifest is not None:
+            file_hash = hash_file(self.get_media_path(file_name, static=static))
+            with self._lock:
+                unchanged = self.manifest.get(file_name) == file_hash
+            if exists and not force and unchanged:
                 return
-        if backup and self.media_exists(file_name):
+
+        if backup and exists:
             self.backup(file_name)
 
-        media = self.get_media_file(file_name, static=static)
-        self.send_media(media)
+        self.send_media(file_name, static=static)
 
+        with self._lock:
+            if self.anki_media_files is not None:
+                self.anki_media_files.add(file_name)
+            if self.manifest is not None and file_hash is not None:
+                self.manifest.set(file_name, file_hash)
+                self.manifest.save()
 
-def main(args=None):
-    utils.assert_ankiconnect_running()
 
-    if args is None:
-        args = utils.get_args(utils.add_args, add_args)
+@tracing.traced("install.probe")
+def probe_anki(
+    note_updater: NoteUpdater, media_installer: MediaInstaller, media_files: list[str]
+) -> bool:
+    """
+    reads what the installer needs from Anki before changing anything (whether the note
+    is installed, its templates and css, and which of the media files exist),
+    with the independent calls sent at the same time.
+
+    returns whether the note is installed
+    """
+    model_name = note_updater.note_config("model-name").item()
+    calls = [
+        ("modelNames", {}),
+        ("modelTemplates", {"modelName": model_name}),
+        ("modelStyling", {"modelName": model_name}),
+    ]
+    pattern = MediaInstaller.get_media_files_pattern(media_files)
+    if pattern is not None:
+        calls.append(("getMediaFilesNames", {"pattern": pattern}))
+
+    # the template calls fail if the note isn't installed
+    results = ankiconnect.invoke_concurrently(calls, return_exceptions=True)
+    model_names, templates, styling, *media = results
+    for result in [model_names] + media:
+        if isinstance(result, BaseException):
+            raise result
+
+    media_installer.anki_media_files = set(media[0]) if media else set()
+
+    is_installed = model_name in model_names
+    if is_installed:
+        for result in (templates, styling):
+            if isinstance(result, BaseException):
+                raise result
+        note_updater.set_installed(templates, styling["css"])
+    return is_installed
+
+
+def get_media_manifest() -> MediaManifest:
+    path = os.path.join(utils.get_cache_folder(), MEDIA_MANIFEST_FILENAME)
+    return MediaManifest(path, utils.get_anki_profile())
+
 
+def push_changes(args, changed_files: list[str]):
+    """
+    sends only the given build outputs to Anki.
+
+    Unlike main(), this doesn't check the installed version, run note changes,
+    or make backups. It is meant to be called repeatedly while developing
+    (i.e. `main.py --watch`), after the note has been installed and updated normally.
+    """
+    note_config = utils.get_note_config()
+    root_folder = utils.get_root_folder()
+
+    note_folder = os.path.join(args.build_folder, note_config("id").item())
+    media_folder = os.path.join(args.build_folder, "media")
+    static_folder = os.path.join(root_folder, "media")
+    option_files = note_config("media-install", "options").list()
+
+    def is_inside(folder, path):
+        return os.path.abspath(path).startswith(os.path.abspath(folder) + os.sep)
+
+    if any(is_inside(note_folder, f) for f in changed_files):
+        NoteUpdater(args.build_folder, note_config).update()
+
+    media_installer = MediaInstaller(
+        media_folder, static_folder, backup_folder="", manifest=get_media_manifest()
+    )
+    file_names = []
+    for f in changed_files:
+        if not is_inside(media_folder, f) or not os.path.isfile(f):
+            continue
+        file_name = os.path.relpath(f, media_folder).replace(os.sep, "/")
+        if file_name in option_files and not args.install_options:
+            continue
+        file_names.append(file_name)
+    media_installer.install_from_list(file_names, static=False, backup=False)
+
+
+def install_note(args):
     note_config = utils.get_note_config()
     model_name = note_config("model-name").item()
 
@@ -304,9 +614,16 @@ def main(args=None):
     backup = not args.no_backup
 
     note_updater = NoteUpdater(search_folder, note_config, backup_folder)
-    media_installer = MediaInstaller(media_folder, static_folder, media_backup_folder)
-
-    is_installed = utils.note_is_installed(model_name)
+    media_installer = MediaInstaller(
+        media_folder, static_folder, media_backup_folder, manifest=get_media_manifest()
+    )
+    is_installed = probe_anki(
+        note_updater,
+        media_installer,
+        note_config("media-install", "static").list()
+        + note_config("media-install", "dynamic").list()
+        + note_config("media-install", "options").list(),
+    )
     action_runner = None
 
     if is_installed:
@@ -319,11 +636,30 @@ def main(args=None):
 
         # checks for note changes between versions
         if not args.dev_ignore_note_changes:
-            current_ver = ar.Version.from_str(utils.get_version_from_anki(args))
-            new_ver = ar.Version.from_str(utils.get_version(args))
-            action_runner = ar.ActionRunner(
-                current_ver, new_ver, in_order=(not args.ignore_order)
-            )  # also verifies field changes
+            with tracing.span("install.check_note_changes"):
+                current_ver_str = utils.get_version_from_anki(
+                    args, note_updater.get_installed_templates()
+                )
+                new_ver_str = utils.get_version(args)
+                current_ver = ar.Version.from_str(current_ver_str)
+                new_ver = ar.Version.from_str(new_ver_str)
+                # loaded first, as the fields are verified as they were left by the resumed run
+                note_changes_journal = open_journal(
+                    "install", {"from": current_ver_str, "to": new_ver_str}, resume=args.resume
+                )
+                action_runner = ar.ActionRunner(
+                    current_ver,
+                    new_ver,
+                    in_order=(not args.ignore_order),
+                    journal=note_changes_journal,
+                )  # also verifies field changes
+
+            if args.plan:
+                if action_runner.has_actions():
+                    action_runner.print_plan()
+                else:
+                    print("There are no note changes to make.")
+                return
 
             if action_runner.has_actions():
                 if not action_runner.warn():  # == false
@@ -334,6 +670,8 @@ def main(args=None):
                 # incompatable with the previous model (will raise an error after installing)
                 print("Running actions. This may take a while...")
                 action_runner.run()
+                note_changes_journal.finish()
+                note_updater.clear_installed()
 
         try:
             if backup:
@@ -348,8 +686,12 @@ def main(args=None):
         note_updater.update()
 
         for option_file in note_config("media-install", "options").list():
+            # --install-options always overwrites the options, as they may have been
+            # edited within Anki since the last install
             if args.install_options or not media_installer.media_exists(option_file):
-                media_installer.install(option_file, static=False, backup=backup)
+                media_installer.install(
+                    option_file, static=False, backup=backup, force=args.install_options
+                )
 
     else:
         print(f"Installing {model_name}...")
@@ -357,19 +699,32 @@ def main(args=None):
         install_path = os.path.join(
             root_folder, "all_versions", f"{version}-jpmn_example_cards.apkg"
         )
-        invoke("importPackage", path=install_path)
+        with tracing.span("install.import_package"):
+            invoke("importPackage", path=install_path)
 
-    media_installer.install_from_list(
-        note_config("media-install", "static").list(), static=True
-    )
+    with tracing.span("install.static_media"):
+        media_installer.install_from_list(
+            note_config("media-install", "static").list(), static=True
+        )
 
-    media_installer.install_from_list(
-        note_config("media-install", "dynamic").list(), static=False, backup=backup
-    )
+    with tracing.span("install.dynamic_media"):
+        media_installer.install_from_list(
+            note_config("media-install", "dynamic").list(), static=False, backup=backup
+        )
 
     if action_runner is not None and action_runner.has_actions():
         action_runner.post_message()
 
 
+def main(args=None):
+    utils.assert_ankiconnect_running()
+
+    if args is None:
+        args = utils.get_args(utils.add_args, add_args)
+
+    with tracing.run("install", args):
+        install_note(args)
+
+
 if __name__ == "__main__":
     main()
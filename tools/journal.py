@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+"""
+journal of the completed parts of a long running update, so that it can be
+resumed (with `--resume`) if Anki crashes or the connection drops midway through
+
+The journal is a json lines file in the cache folder:
+- the first line identifies the run (i.e. the versions being updated between),
+  so a journal is never resumed by a different run
+- every following line is written (and flushed to disk) once a chunk of notes
+  or an action is confirmed by AnkiConnect
+- the file is removed once the run finishes successfully
+"""
+
+import os
+import json
+
+from typing import IO, Any, Iterable
+
+import utils
+
+
+JOURNAL_FOLDER = "journal"
+
+
+class Journal:
+    def __init__(self, path: str, key: dict[str, Any], resume: bool = False):
+        self.path = path
+        self.key = key
+
+        self.completed_actions: set[int] = set()
+        self.completed_chunks: dict[str, set[int]] = {}
+
+        # prefix of the recorded steps, i.e. the action being ran, so the same batch
+        # update ran by different actions is recorded separately
+        self.context = ""
+
+        records = [{"key": key}]
+        if os.path.isfile(path):
+            records = self._load(resume) or records
+        elif resume:
+            print("Nothing to resume, starting from the beginning...")
+
+        # the file is only rewritten once something is recorded, so that loading the journal
+        # (i.e. to verify the fields before resuming) doesn't discard an unfinished run
+        self._records = records
+        self.file: IO[str] | None = None
+
+    def _load(self, resume: bool) -> list[dict[str, Any]] | None:
+        """
+        returns the records of the existing journal if it is resumed
+        """
+        records = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # the last line may be incomplete
+
+        if not records or records[0].get("key") != self.key:
+            if resume:
+                print("The journal is for a different run, starting from the beginning...")
+            return None
+        if not resume:
+            print(
+                f"An unfinished run was found ({os.path.relpath(self.path)}).\n"
+                "Use --resume to continue it. Starting from the beginning..."
+            )
+            return None
+
+        for record in records[1:]:
+            if "action" in record:
+                self.completed_actions.add(record["action"])
+            elif "step" in record:
+                self.completed_chunks.setdefault(record["step"], set()).update(record["notes"])
+
+        print(
+            f"Resuming from {os.path.relpath(self.path)}: {len(self.completed_actions)} actions "
+            f"and {sum(map(len, self.completed_chunks.values()))} notes were already updated."
+        )
+        return records
+
+    def _open(self):
+        # the valid records are rewritten, in case the last line was only partially written
+        utils.gen_dirs(self.path)
+        self.file = open(self.path, "w", encoding="utf-8")
+        for record in self._records:
+            self._write(record)
+
+    def _write(self, record: dict[str, Any]):
+        if self.file is None:
+            self._open()
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record_chunk(self, step: str, note_ids: Iterable[int]):
+        step = self.context + step
+        note_ids = list(note_ids)
+        self.completed_chunks.setdefault(step, set()).update(note_ids)
+        self._write({"step": step, "notes": note_ids})
+
+    def completed_notes(self, step: str) -> set[int]:
+        return self.completed_chunks.get(self.context + step, set())
+
+    def record_action(self, index: int):
+        self.completed_actions.add(index)
+        self._write({"action": index})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def finish(self):
+        """
+        the run completed: the journal is no longer needed
+        """
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def open_journal(name: str, key: dict[str, Any], resume: bool = False) -> Journal:
+    path = os.path.join(utils.get_cache_folder(), JOURNAL_FOLDER, f"{name}.jsonl")
+    return Journal(path, {**key, "profile": utils.get_anki_profile()}, resume=resume)
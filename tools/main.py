@@ -7,22 +7,126 @@ this is primarily used for development purposes,
 simply installing/updating the card should only require the ./install.py script
 """
 
+import os
+import time
+import argparse
+import traceback
+
 import make
 import install
 import utils
+import tracing
+
+
+POLL_INTERVAL = 0.1  # seconds between checking the watched folders for changes
+DEBOUNCE_TIME = 0.3  # seconds without any changes before rebuilding
+
+
+def add_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group(title="main")
+    group.add_argument(
+        "--watch",
+        action="store_true",
+        help="after building and installing, keeps rebuilding and pushing changed files "
+        "to Anki whenever the source, overrides or config files are edited",
+    )
+
+
+def get_watched_folders(args) -> list[str]:
+    root_folder = utils.get_root_folder()
+    config = utils.get_config(args)
+    return [
+        os.path.join(root_folder, "src"),
+        os.path.join(root_folder, config("templates-override-folder").item()),
+        # contains both the config file and the options file
+        os.path.join(root_folder, "config"),
+    ]
+
+
+def snapshot(folders: list[str]) -> dict[str, tuple[int, int]]:
+    """
+    maps each file under the folders to its (mtime, size)
+    """
+    result = {}
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # removed while walking
+                    continue
+                result[path] = (st.st_mtime_ns, st.st_size)
+    return result
+
+
+def wait_for_changes(folders: list[str], previous: dict[str, tuple[int, int]]):
+    """
+    blocks until files in the folders change, and then until no more changes have been
+    made for DEBOUNCE_TIME seconds (i.e. an editor saving multiple files).
+
+    returns the new snapshot
+    """
+    current = previous
+    while current == previous:
+        time.sleep(POLL_INTERVAL)
+        current = snapshot(folders)
+
+    last_change = time.monotonic()
+    while time.monotonic() - last_change < DEBOUNCE_TIME:
+        time.sleep(POLL_INTERVAL)
+        latest = snapshot(folders)
+        if latest != current:
+            current = latest
+            last_change = time.monotonic()
+
+    return current
+
+
+def watch(args):
+    """
+    rebuilds and pushes only the changed outputs until interrupted.
+    The version checks, note changes and backups were already done by the first install.
+    """
+    folders = get_watched_folders(args)
+    state = snapshot(folders)
+    print(f"Watching for changes in {', '.join(os.path.relpath(f) for f in folders)}...")
+
+    while True:
+        state = wait_for_changes(folders, state)
+        start = time.perf_counter()
+        try:
+            # each rebuild overwrites the trace of the previous one
+            with tracing.run("watch", args):
+                changed_files = make.main(args=args, reload_config=True)
+                if changed_files:
+                    install.push_changes(args, changed_files)
+        except Exception:
+            traceback.print_exc()
+            print("Build failed, waiting for the next change...")
+            continue
+
+        print(f"Rebuilt {len(changed_files)} file(s) in {time.perf_counter() - start:.2f}s")
 
 
 def main():
     utils.assert_ankiconnect_running()
 
-    args = utils.get_args(utils.add_args, make.add_args, install.add_args)
+    args = utils.get_args(utils.add_args, make.add_args, install.add_args, add_args)
 
     # defaults to install from the build folder
     args.from_build = True
     args.update = True
 
-    make.main(args=args)
-    install.main(args=args)
+    with tracing.run("main", args):
+        make.main(args=args)
+        install.main(args=args)
+
+    if args.watch:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
 
 
 if __name__ == "__main__":
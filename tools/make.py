@@ -6,24 +6,242 @@ from __future__ import annotations
 """
 
 import os
+import json
 import shutil
+import hashlib
 import argparse
+import threading
+import concurrent.futures
 from enum import Enum
+from dataclasses import dataclass
+from contextlib import contextmanager
 from distutils.dir_util import copy_tree
+from typing import Any, Iterator
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape, StrictUndefined, TemplateNotFound
+import jinja2
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape, StrictUndefined, TemplateNotFound
 
 import utils
+import tracing
+from sass_compiler import SassCompiler
 
 
 FRONT_FILENAME = "front.html"
 BACK_FILENAME = "back.html"
 CSS_FILENAME = "style.css"
+MANIFEST_FILENAME = ".build-manifest.json"
+JINJA_CACHE_FOLDER = ".jinja-cache"
 
 
 def add_args(parser: argparse.ArgumentParser):
     group = parser.add_argument_group(title="make")
     group.add_argument("--to-release", action="store_true", default=False)
+    group.add_argument(
+        "--full-rebuild",
+        action="store_true",
+        default=False,
+        help="regenerates every file, even if its inputs haven't changed since the last build",
+    )
+    group.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of files that can be generated at the same time "
+        "(defaults to the number of CPUs). Use 1 to generate files one after another.",
+    )
+
+
+def hash_bytes(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+def hash_data(data: Any) -> str:
+    return hash_bytes(json.dumps(data, sort_keys=True, default=str).encode("utf-8"))
+
+
+class BuildManifest:
+    """
+    records the inputs of every generated file, so files whose inputs haven't changed
+    can be skipped on the next build.
+
+    Each input is stored as path -> signature, where the signature is:
+    - `[mtime_ns, size, sha256]` for files (the hash is only recomputed if the stat changed)
+    - `["dir", sha256]` for directories (hash of the file listing, sizes and mtimes)
+    - `None` for paths that must not exist (i.e. a template that could be overridden)
+
+    The signature of generated files is also stored, in case they are overwritten later.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print(f"Ignoring corrupted build manifest: {path}")
+
+    @staticmethod
+    def signature(path: str, previous: Any = None) -> Any:
+        if os.path.isdir(path):
+            listing = []
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    st = os.stat(os.path.join(root, file))
+                    listing.append((os.path.relpath(os.path.join(root, file), path), st.st_size, st.st_mtime_ns))
+            listing.sort()
+            return ["dir", hash_data(listing)]
+
+        if not os.path.isfile(path):
+            return None
+
+        st = os.stat(path)
+        if (
+            isinstance(previous, list)
+            and len(previous) == 3
+            and previous[0] == st.st_mtime_ns
+            and previous[1] == st.st_size
+        ):
+            return previous
+
+        with open(path, "rb") as f:
+            return [st.st_mtime_ns, st.st_size, hash_bytes(f.read())]
+
+    @staticmethod
+    def same_signature(x: Any, y: Any) -> bool:
+        if isinstance(x, list) and isinstance(y, list) and len(x) == len(y) == 3:
+            return x[2] == y[2]  # only the contents matter for files
+        return x == y
+
+    def is_up_to_date(self, output_file: str, data_hash: str) -> bool:
+        with self._lock:
+            entry = self.entries.get(output_file)
+        if entry is None or entry["data"] != data_hash or not os.path.exists(output_file):
+            return False
+
+        # generated files can be overwritten by other steps (i.e. copying a folder over it)
+        if "output" in entry and not self.same_signature(
+            entry["output"], self.signature(output_file, entry["output"])
+        ):
+            return False
+
+        for path, previous in entry["inputs"].items():
+            current = self.signature(path, previous)
+            if not self.same_signature(previous, current):
+                return False
+        return True
+
+    def created_paths(self, output_file: str) -> list[str]:
+        """
+        inputs that didn't exist during the last build, but exist now
+        """
+        with self._lock:
+            entry = self.entries.get(output_file, {})
+        return [
+            path for path, sig in entry.get("inputs", {}).items()
+            if sig is None and os.path.exists(path)
+        ]
+
+    def record(self, output_file: str, data_hash: str, inputs: list[str]):
+        with self._lock:
+            previous = self.entries.get(output_file, {}).get("inputs", {})
+        entry = {
+            "data": data_hash,
+            "inputs": {path: self.signature(path, previous.get(path)) for path in inputs},
+        }
+        if os.path.isfile(output_file):
+            entry["output"] = self.signature(output_file)
+        with self._lock:
+            self.entries[output_file] = entry
+
+    def save(self):
+        utils.gen_dirs(self.path)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+class TrackingEnvironment(Environment):
+    """
+    jinja environment that records the name of every template loaded during a render,
+    including includes, imports and extends (even when the template is already cached)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tracking = threading.local()
+
+    @contextmanager
+    def track(self) -> Iterator[set[str]]:
+        names: set[str] = set()
+        self._tracking.names = names
+        try:
+            yield names
+        finally:
+            self._tracking.names = None
+
+    def get_template(self, name, parent=None, globals=None):
+        template = super().get_template(name, parent, globals)
+        names = getattr(self._tracking, "names", None)
+        if names is not None and template.name is not None:
+            names.add(template.name)
+        return template
+
+
+# environments are reused between builds in the same process (i.e. watch mode),
+# so templates that haven't changed don't have to be loaded and compiled again
+_environments: dict[tuple[tuple[str, ...], str | None], TrackingEnvironment] = {}
+_environments_lock = threading.Lock()
+
+
+def create_environment(
+    jinja_root_folders: list[str], bytecode_cache_folder: str | None = None
+) -> TrackingEnvironment:
+    bytecode_cache = None
+    if bytecode_cache_folder is not None:
+        # the cache is invalidated by jinja itself if the template source changes,
+        # but not if jinja itself is updated
+        cache_folder = os.path.join(bytecode_cache_folder, jinja2.__version__)
+        os.makedirs(cache_folder, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_folder)
+
+    env = TrackingEnvironment(
+        loader=FileSystemLoader(jinja_root_folders),
+        autoescape=select_autoescape(),
+        undefined=StrictUndefined,
+        extensions=["jinja2.ext.do"],
+        bytecode_cache=bytecode_cache,
+    )
+
+    filters = {
+        # https://eengstrom.github.io/musings/add-bitwise-operations-to-ansible-jinja2
+        "bitwise_and": lambda x, y: x & y,
+        "bitwise_or": lambda x, y: x | y,
+        "bitwise_xor": lambda x, y: x ^ y,
+        "bitwise_complement": lambda x: ~x,
+        "bitwise_shift_left": lambda x, y: x << y,
+        "bitwise_shift_right": lambda x, y: x >> y,
+    }
+    for k, v in filters.items():
+        env.filters[k] = v
+
+    return env
+
+
+def get_environment(
+    jinja_root_folders: list[str], bytecode_cache_folder: str | None = None
+) -> TrackingEnvironment:
+    """
+    returns the environment for the given folders, creating it if necessary
+    """
+    key = (tuple(jinja_root_folders), bytecode_cache_folder)
+    with _environments_lock:
+        if key not in _environments:
+            _environments[key] = create_environment(jinja_root_folders, bytecode_cache_folder)
+        return _environments[key]
 
 
 class GenerateType(Enum):
@@ -33,6 +251,58 @@ class GenerateType(Enum):
     CSS = 4  # two passes: first with jinja (to include css-folders), and the second with sass
 
 
+@dataclass(frozen=True)
+class GenerateTask:
+    type: GenerateType
+    input_file: str
+    output_file: str
+    release_output: str
+
+    def read_paths(self) -> list[str]:
+        """
+        filesystem paths read by this task (jinja inputs are template names, not paths)
+        """
+        if self.type == GenerateType.JINJA:
+            return []
+        if self.type == GenerateType.SASS:
+            # partials are found relative to the input file
+            return [self.input_file, os.path.dirname(self.input_file)]
+        return [self.input_file]
+
+
+def paths_overlap(path1: str, path2: str) -> bool:
+    """
+    true if the paths are the same, or if one path is inside the other
+    """
+    path1 = os.path.abspath(path1)
+    path2 = os.path.abspath(path2)
+    return (
+        path1 == path2
+        or path1.startswith(path2 + os.sep)
+        or path2.startswith(path1 + os.sep)
+    )
+
+
+def get_task_dependencies(tasks: list[GenerateTask]) -> list[set[int]]:
+    """
+    for each task, returns the indices of the previous tasks that must finish before it starts:
+    - tasks that read the output of a previous task (i.e. `input-dir: build`)
+    - tasks that write to the same place as a previous task (i.e. jinja writing into
+      a copied folder), so the last writer stays the same as when ran in order
+    """
+    deps = []
+    for j, task in enumerate(tasks):
+        task_deps = set()
+        for i in range(j):
+            prev = tasks[i]
+            if paths_overlap(prev.output_file, task.output_file) or any(
+                paths_overlap(prev.output_file, path) for path in task.read_paths()
+            ):
+                task_deps.add(i)
+        deps.append(task_deps)
+    return deps
+
+
 class TextContainer:
     card_types = ["main", "pa_sent", "pa_word", "cloze_deletion"]
     sides = ["front", "back"]
@@ -135,30 +405,21 @@ class Generator:
         jinja_root_folders: list[str],
         config: utils.Config,
         to_release: bool = False,
+        manifest: BuildManifest | None = None,
+        bytecode_cache_folder: str | None = None,
     ):
         self.jinja_root_folders = jinja_root_folders
-        self.loader = FileSystemLoader(jinja_root_folders)
-        self.env = Environment(
-            loader=self.loader,
-            autoescape=select_autoescape(),
-            undefined=StrictUndefined,
-            extensions=["jinja2.ext.do"],
-        )
-
-        filters = {
-            # https://eengstrom.github.io/musings/add-bitwise-operations-to-ansible-jinja2
-            "bitwise_and": lambda x, y: x & y,
-            "bitwise_or": lambda x, y: x | y,
-            "bitwise_xor": lambda x, y: x ^ y,
-            "bitwise_complement": lambda x: ~x,
-            "bitwise_shift_left": lambda x, y: x << y,
-            "bitwise_shift_right": lambda x, y: x >> y,
-        }
-        for k, v in filters.items():
-            self.env.filters[k] = v
+        self.manifest = manifest
+        self.env = get_environment(jinja_root_folders, bytecode_cache_folder)
+        self.loader = self.env.loader
 
         self.sass_path = config("sass-path").item()
+        self.sass = SassCompiler(self.sass_path)
         self.to_release = to_release
+        self.config = config
+
+        # paths checked by get_directories_with_file during the current render
+        self._checked_paths = threading.local()
 
         self.css_folders = config("compile-options", "css-folders").list()
 
@@ -179,6 +440,37 @@ class Generator:
     def set_data(self, key, value):
         self.data[key] = value
 
+    def get_data_hash(self, type: GenerateType) -> str:
+        """
+        hash of everything outside of the input files that can affect the output
+        """
+        if type == GenerateType.JINJA:
+            return hash_data([
+                type.name,
+                self.data.get("VERSION"),
+                self.data["NOTE_OPTS_JSON"],
+                self.data["NOTE_FILES"].item(),
+                self.data["COMPILE_OPTIONS"].item(),
+            ])
+        if type == GenerateType.SASS:
+            return hash_data([type.name, self.sass_path])
+        return hash_data([type.name])
+
+    def resolve_template_paths(self, name: str) -> list[str]:
+        """
+        returns every path the loader checks for the template, up to (and including)
+        the one that is actually used.
+        Paths before the used one don't exist, but would override the template if created.
+        """
+        pieces = name.split("/")
+        paths = []
+        for folder in self.jinja_root_folders:
+            path = os.path.join(folder, *pieces)
+            paths.append(path)
+            if os.path.isfile(path):
+                break
+        return paths
+
 
     def get_directories_with_file(self, file_name):
         """
@@ -216,6 +508,10 @@ class Generator:
         for f in self.css_folders:
             path = os.path.join(CSS_ROOT, f, file_name)
 
+            checked_paths = getattr(self._checked_paths, "paths", None)
+            if checked_paths is not None:
+                checked_paths.add(path)
+
             if os.path.isfile(path):
                 result.append(f)
 
@@ -240,45 +536,188 @@ class Generator:
         otherwise rooted at (repo root).
 
         output rooted at (repo root)
+
+        returns False if the file was skipped because its inputs haven't changed
+        since the last build (only if a manifest is used), and True otherwise
         """
 
+        if type == GenerateType.SASS:
+            task = GenerateTask(type, input_file, output_file, release_output)
+            return self.generate_sass([task])[0]
+
+        data_hash = self.get_data_hash(type)
+        if self.is_up_to_date(output_file, data_hash, release_output):
+            return False
+
         # creates directories if it doesn't exist
         utils.gen_dirs(output_file)
 
         if type == GenerateType.JINJA:
-            # the .replace() is a hack for the build to work on windows?
-            template = self.env.get_template(input_file.replace("\\", "/"))
-            result = template.render(self.data)
+            # jinja's cache only checks whether the loaded file itself changed, so it has
+            # to be cleared for newly created templates (i.e. overrides) to be found
+            if self.manifest is not None and self.manifest.created_paths(output_file):
+                self.env.cache.clear()
+
+            self._checked_paths.paths = set()
+            with self.env.track() as template_names, tracing.span("make.jinja", file=output_file):
+                # the .replace() is a hack for the build to work on windows?
+                template = self.env.get_template(input_file.replace("\\", "/"))
+                result = template.render(self.data)
+            inputs = list(self._checked_paths.paths)
+            self._checked_paths.paths = None
+            for name in template_names:
+                inputs.extend(self.resolve_template_paths(name))
+
+            # leaves the file untouched if nothing changed, so later steps that
+            # depend on it can be skipped
+            if not self.file_contents_equal(output_file, result):
+                with open(output_file, "w", encoding="utf-8") as file:
+                    file.write(result)
 
-            with open(output_file, "w", encoding="utf-8") as file:
-                file.write(result)
+        elif type == GenerateType.COPY:
+            with tracing.span("make.copy", file=output_file):
+                if os.path.isdir(input_file):
+                    copy_tree(input_file, output_file)
+                else:
+                    shutil.copy(input_file, output_file)
+            inputs = [input_file]
 
-        elif type == GenerateType.SASS:
-            command = f"{self.sass_path} {input_file} {output_file}"
-            error_code = os.system(command)
-            if error_code != 0:
-                print(f"attempted sass command: `{command}`")
-                raise Exception(f"sass failed with error code {error_code}")
+        self.finish(output_file, data_hash, inputs, release_output)
+        return True
 
-        elif type == GenerateType.COPY:
-            if os.path.isdir(input_file):
-                copy_tree(input_file, output_file)
-            else:
-                shutil.copy(input_file, output_file)
+    def generate_sass(self, tasks: list[GenerateTask]) -> list[bool]:
+        """
+        compiles all stylesheets with one sass invocation (skipping up to date ones).
+        Warnings are printed, and errors are raised as a SassCompileError.
 
+        returns the result of generate() for each task
+        """
+        data_hash = self.get_data_hash(GenerateType.SASS)
+        todo = [
+            t for t in tasks
+            if not self.is_up_to_date(t.output_file, data_hash, t.release_output)
+        ]
+
+        for t in todo:
+            utils.gen_dirs(t.output_file)
+        with tracing.span("make.sass", files=len(todo)):
+            warnings = self.sass.compile([(t.input_file, t.output_file) for t in todo])
+        for warning in warnings:
+            print(f"sass {warning}")
+
+        for t in todo:
+            # partials are found relative to the input file
+            inputs = [os.path.dirname(t.input_file) or "."]
+            self.finish(t.output_file, data_hash, inputs, t.release_output)
+
+        return [t in todo for t in tasks]
+
+    def is_up_to_date(self, output_file: str, data_hash: str, release_output: str) -> bool:
+        if self.manifest is not None and self.manifest.is_up_to_date(output_file, data_hash):
+            self.copy_to_release(output_file, release_output)
+            return True
+        return False
+
+    def finish(self, output_file: str, data_hash: str, inputs: list[str], release_output: str):
+        if self.manifest is not None:
+            self.manifest.record(output_file, data_hash, inputs)
+        self.copy_to_release(output_file, release_output)
+
+    def generate_all(self, tasks: list[GenerateTask], jobs: int = 1) -> list[bool]:
+        """
+        generates all tasks, running up to `jobs` independent tasks at the same time.
+        Tasks that depend on each other (see get_task_dependencies) keep their order.
+
+        Stylesheets are compiled together with one sass invocation: ready sass tasks
+        wait until either every other sass task is ready, or nothing else can run.
+
+        returns the result of generate() for each task
+        """
+        deps = get_task_dependencies(tasks)
+        results: list[bool | None] = [None] * len(tasks)
+        pending = set(range(len(tasks)))
+        running: dict[concurrent.futures.Future, list[int]] = {}
+
+        def is_ready(i):
+            return all(results[d] is not None for d in deps[i])
+
+        # the spans of the tasks are nested under the current span
+        generate = tracing.bind(self.generate)
+        generate_sass = tracing.bind(self.generate_sass)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while pending or running:
+                ready = [i for i in sorted(pending) if is_ready(i)]
+                ready_sass = [i for i in ready if tasks[i].type == GenerateType.SASS]
+
+                for i in ready:
+                    if tasks[i].type == GenerateType.SASS:
+                        continue
+                    t = tasks[i]
+                    future = executor.submit(
+                        generate, t.type, t.input_file, t.output_file, t.release_output
+                    )
+                    running[future] = [i]
+                    pending.remove(i)
+
+                all_sass_ready = all(
+                    i in ready_sass for i in pending if tasks[i].type == GenerateType.SASS
+                )
+                if ready_sass and (all_sass_ready or not running):
+                    future = executor.submit(generate_sass, [tasks[i] for i in ready_sass])
+                    running[future] = ready_sass
+                    pending.difference_update(ready_sass)
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    indices = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BaseException:
+                        for f in running:
+                            f.cancel()
+                        raise
+
+                    if len(indices) == 1 and isinstance(result, bool):
+                        results[indices[0]] = result
+                    else:
+                        for i, r in zip(indices, result):
+                            results[i] = r
+
+        return [bool(x) for x in results]
+
+    @staticmethod
+    def file_contents_equal(path: str, contents: str) -> bool:
+        if not os.path.isfile(path):
+            return False
+        with open(path, encoding="utf-8") as f:
+            return f.read() == contents
+
+    def copy_to_release(self, output_file: str, release_output: str):
         if self.to_release and release_output:
             utils.gen_dirs(release_output)
             shutil.copy(output_file, release_output)
 
 
-def main(args=None):
+def main(args=None, reload_config: bool = False) -> list[str]:
+    """
+    returns the output files that were (re)generated
+    """
 
     if args is None:
         args = utils.get_args(utils.add_args, add_args)
     if args.release:
         args.to_release = True
 
-    config = utils.get_config(args)
+    with tracing.run("make", args):
+        return build(args, reload_config)
+
+
+def build(args, reload_config: bool) -> list[str]:
+    with tracing.span("make.config"):
+        config = utils.get_config(args, reload=reload_config)
 
     root_folder = utils.get_root_folder()
     templates_folder = os.path.join(root_folder, "src")
@@ -289,14 +728,21 @@ def main(args=None):
 
     #TextContainer.enabled_modules = config("compile-options", "enabled-modules").list()
 
+    manifest = BuildManifest(os.path.join(args.build_folder, MANIFEST_FILENAME))
+    if args.full_rebuild:
+        manifest.entries.clear()
+
     generator = Generator(
         search_folders,
         config,
         to_release=args.to_release,
+        manifest=manifest,
+        bytecode_cache_folder=os.path.join(args.build_folder, JINJA_CACHE_FOLDER),
     )
     generator.set_data("VERSION", utils.get_version(args))
 
     note_config = utils.get_note_config()
+    tasks = []
 
     # generates for each card type
     note_model_id = note_config("id").item()
@@ -307,12 +753,12 @@ def main(args=None):
                 args.build_folder, note_model_id, card_model_id, file_name
             )
 
-            generator.generate(
+            tasks.append(GenerateTask(
                 GenerateType.JINJA,
                 input_file,
                 output_file,
                 os.path.join(root_folder, note_model_id, card_model_id, file_name),
-            )
+            ))
 
     type_map = {
         "scss": GenerateType.SASS,
@@ -344,7 +790,14 @@ def main(args=None):
                 root_folder, file_config("output-file").item()
             )
 
-        generator.generate(gen_type, input_file, output_file, release_output)
+        tasks.append(GenerateTask(gen_type, input_file, output_file, release_output))
+
+    with tracing.span("make.generate_all", tasks=len(tasks)):
+        results = generator.generate_all(tasks, jobs=args.jobs)
+
+    manifest.save()
+
+    return [t.output_file for t, generated in zip(tasks, results) if generated]
 
 
 if __name__ == "__main__":
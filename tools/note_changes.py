@@ -49,6 +49,9 @@ class Version:
     def __ne__(self, other):
         return not (self == other)
 
+    def __hash__(self):
+        return hash(self.ints)
+
     def __gt__(self, other):
         return not (self <= other)
 
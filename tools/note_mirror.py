@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+"""
+local read-through mirror of notes, so repeated batch scripts only transfer
+the notes that changed since the last run
+
+Notes are stored in a SQLite database in the cache folder, with their modification
+time. On each read, `notesModTime` (which only returns the ids and modification times)
+is used to find which mirrored notes are out of date, and only those are
+fetched again with `notesInfo`.
+"""
+
+import os
+import json
+import sqlite3
+
+from typing import Any, Iterable, Iterator
+
+import utils
+import ankiconnect
+from utils import invoke
+
+
+MIRROR_FILENAME = "note-mirror.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    profile TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    mod INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (profile, id)
+)
+"""
+
+
+def _chunks(items: list[Any], size: int) -> Iterator[list[Any]]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class NoteMirror:
+    """
+    mirror of `notesInfo` results for a single Anki profile
+    """
+
+    def __init__(self, path: str, profile: str):
+        self.path = path
+        self.profile = profile
+
+        if path != ":memory:":
+            utils.gen_dirs(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute(SCHEMA)
+
+        # set to False if AnkiConnect doesn't support `notesModTime`
+        self.supported = True
+
+        # number of notes read from the mirror / fetched from Anki, for reporting
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.db.close()
+
+    def get_mod_times(self, note_ids: list[int]) -> dict[int, int]:
+        result = invoke("notesModTime", notes=note_ids)
+        return {x["noteId"]: x["mod"] for x in result}
+
+    def get_local(self, note_ids: list[int]) -> dict[int, tuple[int, str]]:
+        """
+        {note id: (mod, json info)} of the mirrored notes
+        """
+        result = {}
+        # sqlite limits the number of parameters of a single query
+        for chunk in _chunks(note_ids, 500):
+            rows = self.db.execute(
+                "SELECT id, mod, info FROM notes WHERE profile = ? "
+                f"AND id IN ({','.join('?' * len(chunk))})",
+                [self.profile, *chunk],
+            )
+            for note_id, mod, info in rows:
+                result[note_id] = (mod, info)
+        return result
+
+    def store(self, infos: list[dict[str, Any]], mod_times: dict[int, int]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO notes (profile, id, mod, info) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    self.profile,
+                    info["noteId"],
+                    mod_times.get(info["noteId"], info.get("mod", 0)),
+                    json.dumps(info, ensure_ascii=False),
+                )
+                for info in infos
+            ],
+        )
+        self.db.commit()
+
+    def invalidate(self, note_ids: Iterable[int]):
+        """
+        forgets the given notes (i.e. after they were written to), as Anki's
+        modification times only have a precision of one second
+        """
+        self.db.executemany(
+            "DELETE FROM notes WHERE profile = ? AND id = ?",
+            [(self.profile, note_id) for note_id in note_ids],
+        )
+        self.db.commit()
+
+    def notes_info_chunk(self, note_ids: list[int]) -> list[dict[str, Any]]:
+        """
+        same as `notesInfo`, but only fetches the notes that aren't mirrored
+        or were modified since they were mirrored
+        """
+        if not self.supported:
+            return invoke("notesInfo", notes=note_ids)
+
+        try:
+            mod_times = self.get_mod_times(note_ids)
+        except OSError:
+            raise
+        except Exception as e:
+            # any other error (i.e. a timeout) is not a reason to stop using the mirror
+            if not str(e).startswith(ankiconnect.UNSUPPORTED_ACTION_ERROR):
+                raise
+            print("notesModTime is not supported by AnkiConnect, the note mirror is disabled.")
+            self.supported = False
+            return invoke("notesInfo", notes=note_ids)
+
+        local = self.get_local(note_ids)
+        stale = [
+            nid for nid in note_ids if nid not in local or local[nid][0] != mod_times.get(nid)
+        ]
+
+        fetched = {}
+        if stale:
+            infos = invoke("notesInfo", notes=stale)
+            self.store(infos, mod_times)
+            fetched = {info["noteId"]: info for info in infos}
+
+        self.hits += len(note_ids) - len(stale)
+        self.misses += len(stale)
+        return [
+            fetched[nid] if nid in fetched else json.loads(local[nid][1]) for nid in note_ids
+        ]
+
+    def notes_info(self, note_ids: list[int], size: int) -> Iterator[dict[str, Any]]:
+        for chunk in _chunks(note_ids, size):
+            yield from self.notes_info_chunk(chunk)
+
+    def report(self) -> str:
+        return f"Note mirror: {self.hits} notes read locally, {self.misses} fetched from Anki"
+
+
+def get_note_mirror() -> NoteMirror:
+    path = os.path.join(utils.get_cache_folder(), MIRROR_FILENAME)
+    return NoteMirror(path, utils.get_anki_profile())
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+"""
+compiles scss with dart-sass
+
+All stylesheets are compiled with a single invocation of dart-sass
+(`sass in1.scss:out1.css in2.scss:out2.css ...`), so the startup cost of the
+dart vm is only paid once per build.
+"""
+
+import os
+import re
+import shlex
+import subprocess
+
+from dataclasses import dataclass
+
+
+# dart-sass prints messages as follows:
+#
+#   Error: Undefined variable.
+#     ╷
+#   3 │ a { b: $c }
+#     │        ^^
+#     ╵
+#     tmp/scss/style.scss 3:8  root stylesheet
+rx_MESSAGE = re.compile(r"^(Error|Warning|DEPRECATION WARNING)(?: on line \d+.*?)?: (.*)$")
+rx_LOCATION = re.compile(r"^\s+(\S.*?) (\d+):(\d+)\s+(.*)$")
+
+
+@dataclass(frozen=True)
+class SassDiagnostic:
+    severity: str  # "error" or "warning"
+    message: str
+    file: str | None = None
+    line: int | None = None
+    column: int | None = None
+
+    def __str__(self):
+        location = ""
+        if self.file is not None:
+            location = f"{self.file}:{self.line}:{self.column}: "
+        return f"{location}{self.severity}: {self.message}"
+
+
+class SassCompileError(Exception):
+    def __init__(self, message: str, diagnostics: list[SassDiagnostic]):
+        self.diagnostics = diagnostics
+        details = "".join(f"\n - {d}" for d in diagnostics if d.severity == "error")
+        super().__init__(message + details)
+
+
+def parse_diagnostics(output: str) -> list[SassDiagnostic]:
+    """
+    parses the errors and warnings printed by dart-sass
+    """
+    diagnostics = []
+    current = None  # (severity, message) waiting for its location
+
+    def flush():
+        if current is not None:
+            diagnostics.append(SassDiagnostic(*current))
+
+    for line in output.splitlines():
+        match = rx_MESSAGE.match(line)
+        if match:
+            flush()
+            severity = "error" if match.group(1) == "Error" else "warning"
+            current = (severity, match.group(2).strip())
+            continue
+
+        if current is None:
+            continue
+
+        match = rx_LOCATION.match(line)
+        if match:
+            file, line_num, col, _ = match.groups()
+            diagnostics.append(SassDiagnostic(*current, file, int(line_num), int(col)))
+            current = None
+
+    flush()
+    return diagnostics
+
+
+class SassCompiler:
+    """
+    wrapper around the `sass-path` executable specified in the config
+    """
+
+    def __init__(self, sass_path: str):
+        self.sass_path = sass_path
+
+    def command(self, pairs: list[tuple[str, str]]) -> list[str]:
+        # relative paths avoid ambiguity between `:` separators and windows drive letters
+        args = [f"{os.path.relpath(i)}:{os.path.relpath(o)}" for i, o in pairs]
+        return shlex.split(self.sass_path, posix=(os.name != "nt")) + args
+
+    def compile(self, pairs: list[tuple[str, str]]) -> list[SassDiagnostic]:
+        """
+        compiles each (input scss, output css) pair in one sass invocation.
+
+        returns the warnings printed by sass, and raises SassCompileError
+        (containing all diagnostics) if compilation fails.
+        """
+        if not pairs:
+            return []
+
+        try:
+            result = subprocess.run(
+                self.command(pairs),
+                capture_output=True,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
+            )
+        except OSError:
+            # i.e. sass-path is a shell alias or a windows .bat/.cmd file
+            return self.compile_each(pairs)
+
+        diagnostics = parse_diagnostics(result.stderr)
+        if result.returncode == 0:
+            return diagnostics
+
+        if any(d.severity == "error" for d in diagnostics):
+            raise SassCompileError(
+                f"sass failed with error code {result.returncode}", diagnostics
+            )
+
+        # unknown failure (i.e. a sass implementation that doesn't support compiling
+        # multiple files at once): use the original one file per invocation method
+        return self.compile_each(pairs)
+
+    def compile_each(self, pairs: list[tuple[str, str]]) -> list[SassDiagnostic]:
+        for input_file, output_file in pairs:
+            command = f"{self.sass_path} {input_file} {output_file}"
+            error_code = os.system(command)
+            if error_code != 0:
+                print(f"attempted sass command: `{command}`")
+                raise SassCompileError(f"sass failed with error code {error_code}", [])
+        return []
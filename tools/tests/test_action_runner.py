@@ -1,7 +1,22 @@
+import random
+
 import pytest
 
-from tools.action_runner import Version, FieldEditSimulator, Verifier
+from tools.action_runner import (
+    Version,
+    FieldEditSimulator,
+    Verifier,
+    fuse_actions,
+    optimize_field_actions,
+)
+import tools.action_runner as action_runner
 import tools.note_changes as note_changes
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection, MODEL_NAME
+from tools.generate_collection import generate_collection
+from tools.journal import Journal
+
+# the same module as used by action_runner (rather than tools.action)
+action = note_changes.action
 
 
 def test_version_cmp():
@@ -84,3 +99,305 @@ class TestFieldEditSimulator:
         sim._delete_field("C")
         assert sim.simulated_fields == ["A", "B", "D", "E"]
 
+
+
+    def test_respace(self, sim):
+        # always inserting at the same place uses up the gap between the slots
+        for i in range(FieldEditSimulator.SLOT_GAP + 5):
+            sim._add_field(f"F{i}", 1)
+        expected = ["A"] + [f"F{i}" for i in reversed(range(FieldEditSimulator.SLOT_GAP + 5))]
+        assert sim.simulated_fields == expected + ["B", "C", "D", "E"]
+        assert sim.index("B") == len(expected)
+
+
+def test_simulator_matches_list():
+    # reference implementation of the operations on a plain list
+    rng = random.Random(0)
+    fields = [f"F{i}" for i in range(20)]
+    sim = FieldEditSimulator(fields)
+    expected = list(fields)
+
+    for i in range(2000):
+        op = rng.choice(["rename", "move", "add", "delete"])
+        name = rng.choice(expected)
+        index = rng.randrange(len(expected) + 1)
+        if op == "rename":
+            sim._rename_field(name, f"R{i}")
+            expected[expected.index(name)] = f"R{i}"
+        elif op == "move":
+            sim._move_field(name, index)
+            expected.remove(name)
+            expected.insert(index, name)
+        elif op == "add":
+            sim._add_field(f"N{i}", index)
+            expected.insert(index, f"N{i}")
+        elif len(expected) > 1:
+            sim._delete_field(name)
+            expected.remove(name)
+    assert sim.simulated_fields == expected
+
+
+def test_simulate_history():
+    sim = FieldEditSimulator(note_changes.NOTE_CHANGES[-1].fields)
+    history = sim.simulate_history(note_changes.NOTE_CHANGES)
+    for data in note_changes.NOTE_CHANGES:
+        assert history[data.version] == data.fields
+
+
+def test_naive_diff_list(capsys):
+    verifier = Verifier(["A"], ["A", "LongFieldName"])
+    simulated = ["A"]
+    verifier.naive_diff_list(simulated, verifier.new_fields, "Simulated", "Expected")
+
+    assert simulated == ["A"] and verifier.new_fields == ["A", "LongFieldName"]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[-1] == ">>> " + " " * len("Simulated") + " LongFieldName"
+
+
+def test_fuse_actions():
+    set_a = action.SetField("A", "1")
+    set_b = action.SetField("B", "1")
+    add_c = action.AddField("C", 0)
+    delete_a = action.DeleteField("A")
+    user = action.YomichanTemplatesChange()
+
+    # moved past unrelated field actions and user actions, and fused
+    fused = fuse_actions([set_a, add_c, user, set_b])
+    assert fused[:2] == [add_c, user]
+    assert isinstance(fused[2], action.BatchUpdate)
+    transforms = fused[2].transforms
+    assert [t.name for t in transforms] == [set_a.get_transform().name, set_b.get_transform().name]
+
+    # not moved past actions on the same fields
+    assert fuse_actions([set_a, delete_a, set_b]) == [set_a, delete_a, set_b]
+
+
+def test_fuse_note_changes():
+    actions = sum((data.actions for data in reversed(note_changes.NOTE_CHANGES)), start=[])
+    fused = fuse_actions(actions)
+
+    field_actions = (action.RenameField, action.MoveField, action.AddField, action.DeleteField)
+    assert [a for a in fused if isinstance(a, field_actions)] == [
+        a for a in actions if isinstance(a, field_actions)
+    ]
+    batch_updates = [a for a in actions if a.get_transform() is not None]
+    assert len([a for a in fused if isinstance(a, action.BatchUpdate)]) < len(batch_updates)
+
+
+def test_fused_transforms_fail_separately(monkeypatch):
+    downstep = action.BatchUpdate(
+        batch_func=action.batch.add_downstep_inner_span_tag,
+        description="",
+        ankiconnect_actions=set(),
+    )
+    silence = action.SetField("PASilence", "x")
+    fused = fuse_actions([downstep, silence])
+    assert len(fused) == 1
+
+    collection = FakeCollection.empty_jpmn()
+    # fails the assertion of add_downstep_inner_span_tag
+    collection.add_note(MODEL_NAME, {"Key": "a", "WordPitch": "&#42780;"})
+    with FakeAnkiConnect(collection) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+        fused[0].run()
+
+    # skipped on its own, without skipping the other transform
+    assert collection.notes[next(iter(collection.notes))]["fields"]["PASilence"] == "x"
+
+
+def test_fused_transforms_fail_on_error(monkeypatch):
+    def fail(fields):
+        raise ValueError(fields["Key"])
+
+    transform = action.batch.FieldTransform("fail", action.batch.JPMN_QUERY, ("Key",), (), fail)
+
+    def failing(fail_on_error):
+        return action.BatchUpdate(
+            batch_func=transform,
+            description="",
+            ankiconnect_actions=set(),
+            fail_on_error=fail_on_error,
+        )
+
+    silence = action.SetField("PASilence", "x")
+    assert fuse_actions([failing(False), failing(False)])[0].fail_on_error is False
+    assert fuse_actions([failing(False), silence])[0].fail_on_error is True
+    fused = fuse_actions([failing(True), failing(False)])
+    assert len(fused) == 1 and fused[0].fail_on_error
+
+    collection = FakeCollection.empty_jpmn()
+    collection.add_note(MODEL_NAME, {"Key": "a"})
+    with FakeAnkiConnect(collection) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+        # still raised, as if it wasn't fused
+        with pytest.raises(ValueError):
+            fused[0].run()
+        fuse_actions([failing(False), failing(False)])[0].run()
+
+
+def test_resume_after_field_actions(monkeypatch, tmp_path):
+    current_ver, new_ver = Version(0, 10, 2, 0), Version(0, 11, 0, 0)
+    collection = generate_collection(5, version=current_ver)
+    path = str(tmp_path / "journal.jsonl")
+
+    def interrupt(self, **kwargs):
+        raise KeyboardInterrupt()
+
+    with FakeAnkiConnect(collection) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+
+        # interrupted after the fields were added
+        with monkeypatch.context() as m:
+            m.setattr(action.BatchUpdate, "run", interrupt)
+            runner = action_runner.ActionRunner(current_ver, new_ver, journal=Journal(path, {}))
+            with pytest.raises(KeyboardInterrupt):
+                runner.run()
+            runner.journal.close()
+        assert "WordReadingHiragana" in collection.models[MODEL_NAME]["fields"]
+
+        journal = Journal(path, {}, resume=True)
+        assert journal.completed_actions
+        runner = action_runner.ActionRunner(current_ver, new_ver, journal=journal)
+        runner.run()
+        journal.close()
+
+    assert collection.models[MODEL_NAME]["fields"] == note_changes.NOTE_CHANGES[0].fields
+    assert all(n["fields"]["WordReadingHiragana"] for n in collection.notes.values())
+
+
+def simulate(fields, actions):
+    simulator = FieldEditSimulator(fields)
+    simulator.simulate(actions)
+    return simulator.simulated_fields
+
+
+@pytest.mark.parametrize(
+    "actions, expected",
+    [
+        # add then move -> add at the final index
+        (
+            [action.AddField("F", 5), action.MoveField("F", 1)],
+            [action.AddField("F", 1)],
+        ),
+        # chain of moves -> single move
+        (
+            [action.MoveField("A", 2), action.MoveField("A", 4), action.MoveField("A", 3)],
+            [action.MoveField("A", 3)],
+        ),
+        # chain of renames -> single rename
+        (
+            [action.RenameField("A", "X"), action.RenameField("X", "Y")],
+            [action.RenameField("A", "Y")],
+        ),
+        # add then delete -> nothing
+        ([action.AddField("F", 2), action.DeleteField("F")], []),
+    ],
+)
+def test_optimize_field_actions(actions, expected):
+    fields = ["A", "B", "C", "D", "E"]
+    assert optimize_field_actions(actions, fields) == expected
+    assert simulate(fields, expected) == simulate(fields, actions)
+
+
+def test_optimize_field_actions_barriers():
+    fields = ["A", "B", "C"]
+    set_x = action.SetField("X", "1")
+    user = action.YomichanTemplatesChange()
+
+    # the batch update may use the intermediate field
+    actions = [action.RenameField("A", "X"), set_x, action.RenameField("X", "Y")]
+    assert optimize_field_actions(actions, fields) == actions
+
+    # user actions don't edit the cards
+    optimized = optimize_field_actions(
+        [action.RenameField("A", "X"), user, action.RenameField("X", "Y")], fields
+    )
+    assert optimized == [user, action.RenameField("A", "Y")]
+
+
+def test_optimize_field_actions_fallback():
+    fields = ["A", "B", "C"]
+
+    # swapping names can't be done without the temporary name
+    swap = [
+        action.RenameField("A", "T"),
+        action.RenameField("B", "A"),
+        action.RenameField("T", "B"),
+    ]
+    assert optimize_field_actions(swap, fields) == swap
+
+    # deleting then adding a field clears it, so it must not be removed
+    clear = [action.DeleteField("B"), action.AddField("B", 1)]
+    assert optimize_field_actions(clear, fields) == clear
+
+
+def test_optimize_note_changes():
+    original_fields = note_changes.NOTE_CHANGES[-1].fields
+    actions = fuse_actions(
+        sum((data.actions for data in reversed(note_changes.NOTE_CHANGES)), start=[])
+    )
+    optimized = optimize_field_actions(actions, original_fields)
+
+    field_actions = (action.RenameField, action.MoveField, action.AddField, action.DeleteField)
+    assert len([a for a in optimized if isinstance(a, field_actions)]) < len(
+        [a for a in actions if isinstance(a, field_actions)]
+    )
+    assert simulate(original_fields, optimized) == note_changes.NOTE_CHANGES[0].fields
+
+    # the other actions are ran in the same order
+    assert [a for a in optimized if not isinstance(a, field_actions)] == [
+        a for a in actions if not isinstance(a, field_actions)
+    ]
+
+
+class ReadOnlyAnki:
+    def __init__(self, notes):
+        self.notes = notes
+
+    def __call__(self, action, **params):
+        if action == "findNotes":
+            return list(self.notes)
+        if action == "notesInfo":
+            return [
+                {"noteId": nid, "fields": {k: {"value": v} for k, v in self.notes[nid].items()}}
+                for nid in params["notes"]
+            ]
+        raise AssertionError(f"the planner must not call {action}")
+
+
+def test_planner(monkeypatch):
+    notes = {i: {"A": "x" if i <= 3 else ""} for i in range(1, 12)}
+    monkeypatch.setattr(action_runner.utils, "invoke", ReadOnlyAnki(notes))
+
+    planner = action_runner.ActionPlanner(chunk_size=5)
+    set_a = action.SetField("A", "x")
+    add_b = action.AddField("B", 0)
+    user = action.YomichanTemplatesChange()
+    steps = planner.plan([set_a, add_b, user])
+
+    assert [s.description for s in steps] == [add_b.description, set_a.description]
+    assert steps[0].calls == 1
+    assert steps[1].notes == 11
+    # findNotes + 3 notesInfo + 2 multi (for the 8 notes that change)
+    assert steps[1].calls == 6
+    assert steps[1].bytes_sent > 0 and steps[1].bytes_received > 0
+    assert "Estimated total: 7 AnkiConnect calls" in action_runner.format_plan(steps)
+
+
+def test_planner_fused(monkeypatch):
+    notes = {i: {"A": "x" if i <= 3 else "", "C": ""} for i in range(1, 12)}
+    monkeypatch.setattr(action_runner.utils, "invoke", ReadOnlyAnki(notes))
+
+    planner = action_runner.ActionPlanner(chunk_size=5)
+    set_a = action.SetField("A", "x")
+    add_b = action.AddField("B", 0)
+    set_c = action.SetField("C", "y")
+    steps = planner.plan([set_a, add_b, set_c])
+
+    assert [s.description for s in steps] == [
+        add_b.description,
+        f"{set_a.description}\n{set_c.description}",
+    ]
+    # 2 findNotes + 3 notesInfo + 3 multi (for the 11 notes that change), in a single pass
+    assert steps[1].calls == 8
+    assert steps[1].exact
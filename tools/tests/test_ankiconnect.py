@@ -0,0 +1,216 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import tools.ankiconnect as ankiconnect
+from tools.ankiconnect import AnkiConnectClient, AsyncAnkiConnectClient
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.ports.add(self.client_address[1])
+        self.server.requests.append(data["action"])
+        time.sleep(data["params"].get("sleep", 0))
+
+        if self.server.drop_next:
+            # closed after receiving the request, without a response
+            self.server.drop_next = False
+            self.close_connection = True
+            return
+
+        if data["action"] == "fail":
+            response = {"result": None, "error": "failed"}
+        else:
+            response = {"result": [data["action"], data["params"]], "error": None}
+
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.keep_alive:
+            self.send_header("Connection", "keep-alive")
+        else:
+            # like AnkiConnect: closes the connection, without a `Connection: close` header
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    server.ports = set()
+    server.requests = []
+    server.keep_alive = True
+    server.drop_next = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    client = AnkiConnectClient(f"http://127.0.0.1:{server.server_address[1]}")
+    yield client
+    client.close()
+
+
+def test_invoke(client):
+    assert client.invoke("findNotes", query="a") == ["findNotes", {"query": "a"}]
+
+
+def test_invoke_stream(client):
+    body = [b'{"action": "storeMediaFile", ', b'"params": {"data": "abc"}, "version": 6}']
+
+    result = client.invoke_stream("storeMediaFile", lambda: iter(body), sum(map(len, body)))
+    assert result == ["storeMediaFile", {"data": "abc"}]
+    assert client.stats["storeMediaFile"].bytes_sent == sum(map(len, body))
+
+
+def test_error(client):
+    with pytest.raises(Exception, match="failed"):
+        client.invoke("fail")
+
+
+def test_connection_is_reused(client, server):
+    for _ in range(5):
+        client.invoke("version")
+    assert len(server.ports) == 1
+
+
+def test_connection_closed_by_server(client, server):
+    server.keep_alive = False
+    for _ in range(3):
+        client.invoke("version")
+    # nothing was sent on a closed connection, and nothing was sent twice
+    assert len(server.ports) == 3
+    assert server.requests == ["version"] * 3
+
+
+def test_only_read_only_actions_are_retried(client, server):
+    client.invoke("version")
+    server.drop_next = True
+    assert client.invoke("findNotes", query="") == ["findNotes", {"query": ""}]
+    assert server.requests.count("findNotes") == 2
+
+    client.invoke("version")
+    server.drop_next = True
+    with pytest.raises(ConnectionError):
+        client.invoke("addNote", note={})
+    # AnkiConnect may have added the note already
+    assert server.requests.count("addNote") == 1
+
+
+def test_stats(client):
+    client.invoke("version")
+    client.invoke("version")
+    client.invoke("findNotes", query="")
+    assert client.stats["version"].calls == 2
+    assert client.stats["findNotes"].calls == 1
+    assert client.total_calls() == 3
+    assert "findNotes" in client.report()
+
+
+def test_async_invoke(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def invoke_all():
+        async with AsyncAnkiConnectClient(url) as client:
+            results = await asyncio.gather(
+                client.invoke("findNotes", query="a"),
+                client.invoke("findNotes", query="a"),  # coalesced with the above
+                client.invoke("addTags", notes=[1], tags="a"),
+                client.invoke("addTags", notes=[1], tags="a"),  # not read-only
+                client.invoke("fail"),
+                return_exceptions=True,
+            )
+            return results, client.coalesced
+
+    results, coalesced = asyncio.run(invoke_all())
+    assert results[0] == results[1] == ["findNotes", {"query": "a"}]
+    assert results[0] is not results[1]
+    assert results[2] == ["addTags", {"notes": [1], "tags": "a"}]
+    assert isinstance(results[4], Exception)
+    assert coalesced == 1
+    assert sorted(server.requests) == ["addTags", "addTags", "fail", "findNotes"]
+
+
+@pytest.mark.parametrize("max_concurrency, connections", [(1, 1), (4, 4)])
+def test_async_concurrency(server, max_concurrency, connections):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def invoke_all():
+        async with AsyncAnkiConnectClient(url, max_concurrency) as client:
+            calls = [client.invoke("notesInfo", notes=[i], sleep=0.05) for i in range(4)]
+            return await asyncio.gather(*calls)
+
+    results = asyncio.run(invoke_all())
+    assert [r[1]["notes"] for r in results] == [[0], [1], [2], [3]]
+    assert len(server.ports) == connections
+
+
+def test_async_connection_closed_by_server(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.keep_alive = False
+
+    async def invoke_all():
+        async with AsyncAnkiConnectClient(url) as client:
+            for _ in range(3):
+                await client.invoke("version")
+
+    asyncio.run(invoke_all())
+    assert len(server.ports) == 3
+    assert server.requests == ["version"] * 3
+
+
+def test_async_only_read_only_actions_are_retried(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def invoke_all():
+        async with AsyncAnkiConnectClient(url) as client:
+            await client.invoke("version")
+            server.drop_next = True
+            assert await client.invoke("findNotes", query="") == ["findNotes", {"query": ""}]
+
+            await client.invoke("version")
+            server.drop_next = True
+            with pytest.raises(ConnectionError):
+                await client.invoke("addNote", note={})
+
+    asyncio.run(invoke_all())
+    assert server.requests.count("findNotes") == 2
+    assert server.requests.count("addNote") == 1
+
+
+def test_invoke_concurrently(monkeypatch):
+    with FakeAnkiConnect(FakeCollection.empty_jpmn(), latency=0.1) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+
+        start = time.perf_counter()
+        results = ankiconnect.invoke_concurrently(
+            [("version", {}), ("modelNames", {}), ("modelStyling", {"modelName": "x"})],
+            return_exceptions=True,
+        )
+        # sent at the same time, rather than one after the other
+        assert time.perf_counter() - start < 0.25
+
+        assert results[:2] == [6, ["JP Mining Note"]]
+        assert isinstance(results[2], Exception)
+        with pytest.raises(Exception):
+            ankiconnect.invoke_concurrently([("version", {}), ("modelStyling", {"modelName": "x"})])
+
+        # recorded by the shared client
+        assert ankiconnect.get_client().stats["modelNames"].calls == 1
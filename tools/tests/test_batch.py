@@ -0,0 +1,381 @@
+import pytest
+
+import tools.batch as batch
+import tools.note_changes as note_changes
+import tools.note_mirror as note_mirror
+from tools.journal import Journal
+
+# the same module as used by the note changes (rather than tools.action)
+action = note_changes.action
+
+
+class FakeAnki:
+    """
+    minimal stand-in for `invoke`, with notes stored as {id: {field: value}}
+    """
+
+    def __init__(self, notes):
+        self.notes = notes
+        self.mod = {nid: 1 for nid in notes}
+        self.calls = []
+
+    def __call__(self, action, **params):
+        self.calls.append((action, params))
+
+        if action == "findNotes":
+            return list(self.notes.keys())
+
+        if action == "notesModTime":
+            return [{"noteId": nid, "mod": self.mod[nid]} for nid in params["notes"]]
+
+        if action == "notesInfo":
+            return [
+                {
+                    "noteId": nid,
+                    "mod": self.mod[nid],
+                    "fields": {
+                        k: {"value": v, "order": i}
+                        for i, (k, v) in enumerate(self.notes[nid].items())
+                    },
+                }
+                for nid in params["notes"]
+            ]
+
+        if action == "multi":
+            for a in params["actions"]:
+                assert a["action"] == "updateNoteFields"
+                note = a["params"]["note"]
+                self.notes[note["id"]].update(note["fields"])
+                self.mod[note["id"]] += 1
+            return [None] * len(params["actions"])
+
+        raise NotImplementedError(action)
+
+    def count(self, action):
+        return sum(1 for a, _ in self.calls if a == action)
+
+    def fetched(self):
+        """
+        ids of all notes fetched with notesInfo
+        """
+        return [nid for a, p in self.calls if a == "notesInfo" for nid in p["notes"]]
+
+
+@pytest.fixture
+def anki(monkeypatch):
+    notes = {
+        i: {"Key": str(i), "WordReading": "成[な]り 立[た]つ", "WordReadingHiragana": ""}
+        for i in range(1, 12)
+    }
+    anki = FakeAnki(notes)
+    monkeypatch.setattr(batch, "invoke", anki)
+    monkeypatch.setattr(batch, "chunk_size", 5)
+    return anki
+
+
+def test_chunks():
+    assert list(batch._chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batch._chunks([], 3)) == []
+
+
+def test_set_field_is_chunked(anki):
+    assert batch.set_field("WordReadingHiragana", "x") == 11
+    assert anki.count("multi") == 3
+    assert all(n["WordReadingHiragana"] == "x" for n in anki.notes.values())
+
+
+def test_notes_info_is_chunked(anki):
+    batch.fill_word_reading_hiragana_field()
+    assert anki.count("notesInfo") == 3
+    assert anki.count("multi") == 3
+    assert all(n["WordReadingHiragana"] == "なりたつ" for n in anki.notes.values())
+
+
+@pytest.fixture
+def mirror(anki, monkeypatch, tmp_path):
+    monkeypatch.setattr(note_mirror, "invoke", anki)
+    mirror = note_mirror.NoteMirror(str(tmp_path / "mirror.sqlite3"), "profile")
+    monkeypatch.setattr(batch, "mirror", mirror)
+    yield mirror
+    mirror.close()
+
+
+def test_mirror_only_fetches_modified_notes(anki, mirror):
+    assert len(list(batch.iter_notes_info(list(anki.notes)))) == 11
+    assert len(anki.fetched()) == 11
+
+    anki.notes[3]["Key"] = "edited"
+    anki.mod[3] += 1
+    infos = list(batch.iter_notes_info(list(anki.notes)))
+    assert anki.fetched()[11:] == [3]
+    assert infos[2]["fields"]["Key"]["value"] == "edited"
+    assert [info["noteId"] for info in infos] == list(anki.notes)
+
+
+def test_mirror_is_refreshed_after_updates(anki, mirror):
+    batch.fill_word_reading_hiragana_field()
+    assert len(anki.fetched()) == 11
+
+    infos = list(batch.iter_notes_info(list(anki.notes)))
+    assert len(anki.fetched()) == 22
+    assert all(i["fields"]["WordReadingHiragana"]["value"] == "なりたつ" for i in infos)
+
+    list(batch.iter_notes_info(list(anki.notes)))
+    assert len(anki.fetched()) == 22
+    assert mirror.hits == 11
+
+
+def test_mirror_persists(anki, mirror, tmp_path):
+    list(batch.iter_notes_info(list(anki.notes)))
+    other = note_mirror.NoteMirror(mirror.path, "profile")
+    other.notes_info_chunk(list(anki.notes))
+    assert other.hits == 11
+
+    # mirrors are separate per profile
+    other = note_mirror.NoteMirror(mirror.path, "other profile")
+    other.notes_info_chunk(list(anki.notes))
+    assert other.misses == 11
+
+
+def test_mirror_is_disabled_if_unsupported(anki, mirror, monkeypatch):
+    def invoke(action, **params):
+        if action == "notesModTime":
+            raise Exception("unsupported action")
+        return anki(action, **params)
+
+    monkeypatch.setattr(note_mirror, "invoke", invoke)
+    assert len(list(batch.iter_notes_info(list(anki.notes)))) == 11
+    assert not mirror.supported
+
+
+def test_mirror_errors_are_raised(anki, mirror, monkeypatch):
+    def invoke(action, **params):
+        if action == "notesModTime":
+            raise Exception("timed out")
+        return anki(action, **params)
+
+    monkeypatch.setattr(note_mirror, "invoke", invoke)
+    with pytest.raises(Exception, match="timed out"):
+        list(batch.iter_notes_info(list(anki.notes)))
+    assert mirror.supported
+
+
+def test_unchanged_notes_are_skipped(anki, capsys):
+    anki.notes[1]["WordReadingHiragana"] = "x"
+    assert batch.set_field("WordReadingHiragana", "x") == 10
+
+    assert batch.set_field("WordReadingHiragana", "x") == 0
+    assert anki.count("multi") == 2
+    assert "Skipped 11 notes" in capsys.readouterr().out
+
+
+def test_diff_update_action():
+    info = {"noteId": 1, "fields": {"A": {"value": "a"}, "B": {"value": "b"}}}
+    assert batch.diff_update_action(info, {"A": "a"}) is None
+
+    action = batch.diff_update_action(info, {"A": "a", "B": "c"})
+    assert action == batch.update_note_fields_action(1, {"B": "c"})
+
+
+def test_transforms_are_fused(anki):
+    anki.notes[2]["WordReading"] = "ア"
+    transforms = [
+        batch.fill_word_reading_hiragana_field,
+        batch.set_field_transform("Key", "x"),
+    ]
+    assert batch.run_transforms(transforms) == 11
+    assert anki.count("findNotes") == 2
+    assert anki.count("notesInfo") == 3
+    assert anki.count("multi") == 3
+    assert anki.notes[2] == {"Key": "x", "WordReading": "ア", "WordReadingHiragana": "あ"}
+
+
+def test_transforms_see_previous_results(anki):
+    fill_hiragana = batch.FieldTransform(
+        "fill_hiragana",
+        batch.JPMN_QUERY,
+        reads=("WordReading",),
+        writes=("WordReadingHiragana",),
+        func=batch.fill_word_reading_hiragana_field.func,
+    )
+    transforms = [batch.set_field_transform("WordReading", "読[よ]む"), fill_hiragana]
+    batch.run_transforms(transforms)
+    assert anki.count("notesInfo") == 3
+    assert all(n["WordReadingHiragana"] == "よむ" for n in anki.notes.values())
+
+
+def test_group_transforms():
+    a = batch.set_field_transform("WordReading", "")
+    b = batch.set_field_transform("Key", "")
+    # searches the WordReading field, which is written by `a`
+    c = batch.fill_word_reading_hiragana_field
+    assert batch.group_transforms([a, b, c]) == [[a, b], [c]]
+    assert batch.group_transforms([c, a, b]) == [[c, a, b]]
+
+
+def test_transform_assertions_are_kept():
+    with pytest.raises(AssertionError):
+        batch.add_downstep_inner_span_tag.apply(
+            {"Key": "x", "WordPitch": '<span class="downstep">&#42780;</span>&#42780;'}
+        )
+
+
+DOWNSTEP = '<span class="downstep">&#42780;</span>'
+
+
+@pytest.fixture
+def pitch_anki(anki, monkeypatch):
+    for i, note in anki.notes.items():
+        note["WordPitch"] = f"{i}{DOWNSTEP}"
+    return anki
+
+
+def test_downstep_transform(pitch_anki):
+    assert batch.add_downstep_inner_span_tag() == 11
+    assert [n["WordPitch"] for n in pitch_anki.notes.values()] == [
+        f"{i}{batch.SPAN_DOWNSTEP_INNER}" for i in pitch_anki.notes
+    ]
+
+
+def test_downstep_transform_assertions(pitch_anki):
+    pitch_anki.notes[7]["WordPitch"] += "&#42780;"
+    with pytest.raises(AssertionError) as e:
+        batch.add_downstep_inner_span_tag()
+    assert e.value.args[0][0] == "7"
+
+
+@pytest.mark.parametrize("bad_note, raises", [(2, False), (7, True)])
+def test_failed_batch_update(pitch_anki, monkeypatch, bad_note, raises):
+    monkeypatch.setattr(action.batch, "invoke", pitch_anki)
+    monkeypatch.setattr(action.batch, "chunk_size", 5)
+    pitch_anki.notes[bad_note]["WordPitch"] += "&#42780;"
+    update = action.BatchUpdate(
+        batch_func=action.batch.add_downstep_inner_span_tag,
+        description="",
+        ankiconnect_actions=set(),
+    )
+
+    if raises:
+        # the first chunk was already written: the error must not be skipped
+        with pytest.raises(AssertionError):
+            update.run()
+        assert pitch_anki.count("multi") == 1
+    else:
+        update.run()
+        assert pitch_anki.count("multi") == 0
+
+
+READINGS = [
+    "成[な]り 立[た]つ",
+    "カタカナ",
+    "&nbsp;見[み]せ 物[もの]",
+    "ジャンプ 台[だい]",
+    "",
+    "a\nb[c]",
+    "[x]",
+]
+
+
+def test_kata2hira():
+    assert batch._kata2hira("カタカナ・ヴ") == "かたかな・ゔ"
+    assert batch._kata2hira("カタカナ", ignore="カ") == "カたカな"
+    assert batch._kata2hira_table(frozenset("カ")) is batch._kata2hira_table(frozenset("カ"))
+
+
+def test_readings_to_hiragana():
+    expected = [batch._kata2hira(batch._get_kana_from_plain_reading(r)) for r in READINGS]
+    assert batch.readings_to_hiragana(READINGS) == expected
+    assert batch.readings_to_hiragana(READINGS + ["\x00"]) == expected + ["\x00"]
+
+    results = batch.fill_word_reading_hiragana_field.apply_many(
+        [{"WordReading": r} for r in READINGS]
+    )
+    assert [r["WordReadingHiragana"] for r in results] == expected
+
+
+class CrashingAnki(FakeAnki):
+    def __init__(self, notes, crash_after):
+        super().__init__(notes)
+        self.crash_after = crash_after
+
+    def __call__(self, action, **params):
+        if action == "multi":
+            if self.crash_after == 0:
+                raise ConnectionResetError()
+            self.crash_after -= 1
+        return super().__call__(action, **params)
+
+
+def test_resume_after_crash(monkeypatch, tmp_path):
+    notes = {i: {"Word": "言葉", "WordReading": "ことば"} for i in range(1, 12)}
+    anki = CrashingAnki(notes, crash_after=1)
+    monkeypatch.setattr(batch, "invoke", anki)
+    monkeypatch.setattr(batch, "chunk_size", 5)
+
+    path = str(tmp_path / "journal.jsonl")
+    monkeypatch.setattr(batch, "journal", Journal(path, {}))
+    with pytest.raises(ConnectionResetError):
+        batch.quick_fix_convert_kana_only_reading_all_notes()
+    batch.journal.close()
+
+    anki.crash_after = -1
+    monkeypatch.setattr(batch, "journal", Journal(path, {}, resume=True))
+    batch.quick_fix_convert_kana_only_reading_all_notes()
+    # applied exactly once to every note
+    assert all(n["WordReading"] == "言葉[ことば]" for n in anki.notes.values())
+
+
+def test_report_changes(monkeypatch, capsys):
+    notes = {i: {"Word": "言葉", "WordReading": "ことば"} for i in range(1, 12)}
+    monkeypatch.setattr(batch, "invoke", FakeAnki(notes))
+    monkeypatch.setattr(batch, "chunk_size", 5)
+
+    # the transform itself has no side effects
+    batch.quick_fix_convert_kana_only_reading_all_notes.apply(notes[1])
+    assert capsys.readouterr().out == ""
+
+    batch.quick_fix_convert_kana_only_reading_all_notes()
+    lines = capsys.readouterr().out.splitlines()
+    # listed once, after the pass
+    start = lines.index(" - quick_fix_convert_kana_only_reading_all_notes: 11 notes")
+    assert lines[start + 1 :] == [f"     {i}: 言葉[ことば]" for i in notes]
+
+
+class FailingAnki(FakeAnki):
+    """
+    reports an error for the given notes within `multi`, like AnkiConnect
+    """
+
+    def __init__(self, notes, failing):
+        super().__init__(notes)
+        self.failing = failing
+
+    def __call__(self, action, **params):
+        if action != "multi":
+            return super().__call__(action, **params)
+        results = []
+        for a in params["actions"]:
+            if a["params"]["note"]["id"] in self.failing:
+                results.append({"result": None, "error": "note was not found"})
+            else:
+                super().__call__(action, actions=[a])
+                results.append({"result": None, "error": None})
+        return results
+
+
+def test_multi_errors(monkeypatch, tmp_path):
+    notes = {i: {"Word": "言葉", "WordReading": "ことば"} for i in range(1, 12)}
+    anki = FailingAnki(notes, failing={7})
+    monkeypatch.setattr(batch, "invoke", anki)
+    monkeypatch.setattr(batch, "chunk_size", 5)
+
+    path = str(tmp_path / "journal.jsonl")
+    monkeypatch.setattr(batch, "journal", Journal(path, {}))
+    with pytest.raises(Exception, match="Failed to update 1 notes"):
+        batch.quick_fix_convert_kana_only_reading_all_notes()
+    batch.journal.close()
+
+    # the failed note is not recorded as completed
+    journal = Journal(path, {}, resume=True)
+    (completed,) = journal.completed_chunks.values()
+    assert completed == {1, 2, 3, 4, 5, 6, 8, 9, 10}
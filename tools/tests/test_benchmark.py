@@ -0,0 +1,41 @@
+import tools.benchmark as benchmark
+
+
+def test_cases_run():
+    results = benchmark.run_benchmarks(
+        ["batch.fill_word_reading_hiragana_field", "action_runner", "install.media"],
+        sizes=[20],
+        repeat=1,
+    )
+    assert [r.key for r in results] == [
+        "batch.fill_word_reading_hiragana_field[20]",
+        "action_runner.plan[20]",
+        "action_runner.run[20]",
+        "install.media[10]",
+        "install.media[100]",
+    ]
+    for result in results:
+        assert result.error is None, result.error
+        assert len(result.times) == 1
+
+
+def test_errors_are_recorded():
+    def setup(context):
+        raise RuntimeError("sass is not installed")
+
+    case = benchmark.BenchmarkCase("failing", setup, sizes=None)
+    result = benchmark.run_case(case, None)
+    assert result.error == "RuntimeError: sass is not installed"
+    assert "failing" not in benchmark.results_to_json([result])["results"]
+
+
+def test_compare():
+    baseline = benchmark.results_to_json(
+        [benchmark.BenchmarkResult("a", 10, [1.0]), benchmark.BenchmarkResult("b", 10, [1.0])]
+    )
+    results = [
+        benchmark.BenchmarkResult("a", 10, [1.1, 1.5]),
+        benchmark.BenchmarkResult("b", 10, [2.0]),
+        benchmark.BenchmarkResult("c", 10, [5.0]),  # new case
+    ]
+    assert benchmark.compare(results, baseline) == ["b[10]"]
@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+import tools.batch as batch
+import tools.note_changes as note_changes
+from tools.ankiconnect import AnkiConnectClient
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection, MODEL_NAME
+
+# the same module as used by the tools (rather than tools.action)
+action = note_changes.action
+
+
+@pytest.fixture
+def collection():
+    collection = FakeCollection.empty_jpmn()
+    collection.add_note(MODEL_NAME, {"Key": "a", "Word": "成り立つ", "WordReading": "成[な]り 立[た]つ"})
+    collection.add_note(MODEL_NAME, {"Key": "b", "Word": "犬", "WordReading": "犬[いぬ]"}, tags=["t"])
+    collection.add_note(MODEL_NAME, {"Key": "c", "Word": "ねこ"})
+    return collection
+
+
+@pytest.fixture
+def server(collection, monkeypatch):
+    with FakeAnkiConnect(collection) as server:
+        # used by utils.invoke()
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = AnkiConnectClient(server.url)
+    yield client
+    client.close()
+
+
+@pytest.mark.parametrize(
+    "query, keys",
+    [
+        (r'"note:JP Mining Note"', ["a", "b", "c"]),
+        (r'"note:JP Mining Note" -WordReading:', ["a", "b"]),
+        (r"WordReading:", ["c"]),
+        (r'"WordReading:*[な]*"', ["a"]),
+        (r"tag:t OR Key:c", ["b", "c"]),
+        (r'"Word:犬" OR "Word:ね_"', ["b", "c"]),
+        (r"ねこ", ["c"]),
+    ],
+)
+def test_find_notes(client, collection, query, keys):
+    ids = client.invoke("findNotes", query=query)
+    assert sorted(collection.notes[nid]["fields"]["Key"] for nid in ids) == keys
+
+
+def test_batch_transform(server, collection):
+    assert batch.fill_word_reading_hiragana_field() == 2
+
+    readings = [n["fields"]["WordReadingHiragana"] for n in collection.notes.values()]
+    assert readings == ["なりたつ", "いぬ", ""]
+    assert server.calls["multi"] == 1
+
+
+def test_field_actions(server, collection, client):
+    action.RenameField("Word", "Word2").run()
+    action.MoveField("Word2", 0).run()
+    action.AddField("NewField", 1).run()
+    action.DeleteField("Key").run()
+
+    fields = client.invoke("modelFieldNames", modelName=MODEL_NAME)
+    assert fields[:2] == ["Word2", "NewField"] and "Key" not in fields
+
+    info = client.invoke("notesInfo", notes=list(collection.notes)[:1])[0]
+    assert list(info["fields"]) == fields
+    assert info["fields"]["Word2"] == {"value": "成り立つ", "order": 0}
+
+
+def test_media(client):
+    assert client.invoke("retrieveMediaFile", filename="_a.css") is False
+    client.invoke("storeMediaFile", filename="_a.css", data="YWJj")
+    assert client.invoke("retrieveMediaFile", filename="_a.css") == "YWJj"
+    assert client.invoke("getMediaFilesNames", pattern="_*.css") == ["_a.css"]
+
+
+def test_errors(client):
+    with pytest.raises(Exception, match="unsupported action"):
+        client.invoke("notAnAction")
+    with pytest.raises(Exception, match="field already exists"):
+        client.invoke("modelFieldAdd", modelName=MODEL_NAME, fieldName="Key", index=0)
+
+
+def test_latency(collection):
+    with FakeAnkiConnect(collection, latency=0.05) as server:
+        client = AnkiConnectClient(server.url)
+        start = time.perf_counter()
+        client.invoke("version")
+        assert time.perf_counter() - start >= 0.05
+        client.close()
+
+
+@pytest.mark.parametrize("keep_alive", [False, True])
+def test_keep_alive(collection, keep_alive):
+    with FakeAnkiConnect(collection, keep_alive=keep_alive) as server:
+        client = AnkiConnectClient(server.url)
+        for _ in range(3):
+            assert client.invoke("version") == 6
+        # connections are only kept for reuse if the server keeps them open
+        assert len(client._idle) == (1 if keep_alive else 0)
+        client.close()
+
+
+def test_multi_latency(collection):
+    with FakeAnkiConnect(collection, latency=0.05) as server:
+        client = AnkiConnectClient(server.url)
+        start = time.perf_counter()
+        client.invoke("multi", actions=[{"action": "version"}] * 10)
+        # added once per request, rather than per action
+        assert time.perf_counter() - start < 0.25
+        assert server.calls == {"multi": 1}
+        assert server.multi_calls == {"version": 10}
+        client.close()
+
+
+def test_json_round_trip(tmp_path):
+    collection = FakeCollection.synthetic(10, seed=1)
+    collection.media["a.txt"] = b"abc"
+    collection.dump(str(tmp_path / "collection.json"))
+
+    loaded = FakeCollection.load(str(tmp_path / "collection.json"))
+    assert loaded.notes == collection.notes
+    assert loaded.models == collection.models
+    assert loaded.media == collection.media
+    assert FakeCollection.synthetic(10, seed=1).notes == collection.notes
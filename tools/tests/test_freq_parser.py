@@ -0,0 +1,59 @@
+import pytest
+
+from tools.freq_parser import (
+    EXAMPLE_LEGACY_HTML,
+    Frequency,
+    parse_frequencies,
+    parse_frequencies_slow,
+    min_frequency,
+    standardize_legacy_html,
+    _min_frequency_bs4,
+)
+
+IGNORED = ["VN Freq Percent"]
+
+
+def test_parse_frequencies():
+    freqs = parse_frequencies(EXAMPLE_LEGACY_HTML)
+    assert freqs[0] == Frequency("Anime & Jdrama Freq:", "6155")
+    assert freqs[3] == Frequency("JPDB", "37625㋕")
+    assert [f.value() for f in freqs] == [6155, 3863, 8418, 37625, 927]
+    assert parse_frequencies_slow(EXAMPLE_LEGACY_HTML) == freqs
+
+
+def test_min_frequency():
+    assert min_frequency(EXAMPLE_LEGACY_HTML, IGNORED) == 3863
+    assert min_frequency(EXAMPLE_LEGACY_HTML, IGNORED + ["Innocent Ranked"]) == 6155
+    assert min_frequency('<div class="frequencies"></div>', IGNORED) == 0
+
+
+def test_standardized_html():
+    # the current styling (without the wrapping div) is also supported
+    standardized = standardize_legacy_html(EXAMPLE_LEGACY_HTML)
+    assert not standardized.startswith('<div class="frequencies">')
+    assert "frequencies__dictionary-inner2" not in standardized
+    assert parse_frequencies(standardized) == parse_frequencies(EXAMPLE_LEGACY_HTML)
+
+
+def test_unexpected_html_uses_html_parser():
+    edited = EXAMPLE_LEGACY_HTML.replace(
+        '<span class="frequencies__number-inner">3863</span>',
+        '<span class="frequencies__number-inner"><b>3,863</b></span>',
+    )
+    assert min_frequency(edited, IGNORED) == 3863
+    assert parse_frequencies(edited) == parse_frequencies_slow(edited)
+
+
+@pytest.mark.parametrize("void_tag", ["<br>", "<br/>", "<img src=x>", "<wbr>"])
+def test_void_elements(void_tag):
+    # void elements have no end tag, so they must not change the depth of the groups
+    edited = EXAMPLE_LEGACY_HTML.replace(">6155</span>", f">6155{void_tag}</span>")
+    assert min_frequency(edited, IGNORED) == 3863
+    assert parse_frequencies_slow(edited) == parse_frequencies_slow(EXAMPLE_LEGACY_HTML)
+
+
+def test_same_as_bs4():
+    pytest.importorskip("bs4")
+    assert min_frequency(EXAMPLE_LEGACY_HTML, IGNORED) == _min_frequency_bs4(
+        EXAMPLE_LEGACY_HTML, IGNORED
+    )
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import tools.batch as batch
+import tools.note_changes as note_changes
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection, MODEL_NAME
+from tools.generate_collection import Version, generate_collection, write_fixture, write_apkg
+
+
+def test_deterministic():
+    assert generate_collection(50, seed=1).notes == generate_collection(50, seed=1).notes
+    assert generate_collection(50, seed=1).notes != generate_collection(50, seed=2).notes
+
+
+def test_fields():
+    collection = generate_collection(200)
+    assert collection.models[MODEL_NAME]["fields"] == note_changes.NOTE_CHANGES[0].fields
+
+    notes = list(collection.notes.values())
+    for note in notes:
+        assert list(note["fields"]) == note_changes.NOTE_CHANGES[0].fields
+    assert len({n["fields"]["Key"] for n in notes}) == len(notes)
+
+    # the optional fields are filled in some notes, but not all of them
+    for field in ("AJTWordPitch", "PAOverride", "FrequenciesStylized", "WordReadingHiragana"):
+        assert 0 < sum(bool(n["fields"][field]) for n in notes) < len(notes), field
+
+
+def test_older_version():
+    collection = generate_collection(50, version=Version(0, 9, 0, 0))
+    fields = collection.models[MODEL_NAME]["fields"]
+    assert "WordPitch" in fields and "AJTWordPitch" not in fields
+    assert all(list(n["fields"]) == fields for n in collection.notes.values())
+
+
+def test_fixture(tmp_path):
+    path = str(tmp_path / "collection.json")
+    write_fixture(path, 100, seed=3)
+
+    with open(path, encoding="utf-8") as f:
+        json.load(f)  # valid json
+    assert FakeCollection.load(path).notes == generate_collection(100, seed=3).notes
+
+
+def test_apkg_requires_anki(tmp_path):
+    try:
+        import anki  # noqa: F401
+    except ImportError:
+        with pytest.raises(Exception, match="pip install anki"):
+            write_apkg(str(tmp_path / "collection.apkg"), 10)
+    else:
+        pytest.skip("anki is installed")
+
+
+def test_batch_transforms(monkeypatch):
+    collection = generate_collection(300, version=Version(0, 10, 0, 0), legacy_fraction=0.5)
+    with FakeAnkiConnect(collection) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+        batch.run_transforms([batch.standardize_frequencies_styling, batch.add_sort_freq_legacy])
+
+    for note in collection.notes.values():
+        assert "frequencies__dictionary-inner2" not in note["fields"]["FrequenciesStylized"]
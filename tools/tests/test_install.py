@@ -0,0 +1,224 @@
+import json
+import base64
+import fnmatch
+
+import pytest
+
+import tools.install as install
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection
+
+
+class FakeAnkiMedia:
+    def __init__(self):
+        self.media = {}
+        self.calls = []
+
+    def __call__(self, action, **params):
+        self.calls.append(action)
+        if action == "getMediaFilesNames":
+            return fnmatch.filter(self.media.keys(), params["pattern"])
+        if action == "storeMediaFile":
+            if "path" in params:
+                with open(params["path"], "rb") as f:
+                    self.media[params["filename"]] = f.read()
+            else:
+                self.media[params["filename"]] = base64.b64decode(params["data"])
+            return params["filename"]
+        if action == "retrieveMediaFile":
+            data = self.media.get(params["filename"])
+            return False if data is None else base64.b64encode(data).decode("utf-8")
+        raise NotImplementedError(action)
+
+
+@pytest.fixture
+def anki(monkeypatch):
+    anki = FakeAnkiMedia()
+    monkeypatch.setattr(install, "invoke", anki)
+    return anki
+
+
+@pytest.fixture
+def media_folder(tmp_path):
+    folder = tmp_path / "media"
+    folder.mkdir()
+    (folder / "_field.css").write_text("a {}")
+    (folder / "_editor.css").write_text("b {}")
+    return folder
+
+
+def make_installer(tmp_path, media_folder):
+    manifest = install.MediaManifest(str(tmp_path / "manifest.json"), "profile")
+    installer = install.MediaInstaller(
+        str(media_folder), str(media_folder), str(tmp_path / "backup"), manifest=manifest
+    )
+    installer.fetch_media_files(["_field.css", "_editor.css"])
+    return installer
+
+
+def test_unchanged_files_are_not_sent(anki, tmp_path, media_folder):
+    installer = make_installer(tmp_path, media_folder)
+    installer.install_from_list(["_field.css", "_editor.css"])
+    assert anki.calls.count("storeMediaFile") == 2
+
+    installer = make_installer(tmp_path, media_folder)
+    installer.install_from_list(["_field.css", "_editor.css"])
+    assert anki.calls.count("storeMediaFile") == 2
+    assert anki.calls.count("getMediaFilesNames") == 2  # one listing per installer
+
+
+def test_changed_files_are_sent(anki, tmp_path, media_folder):
+    make_installer(tmp_path, media_folder).install_from_list(["_field.css", "_editor.css"])
+    (media_folder / "_field.css").write_text("c {}")
+
+    make_installer(tmp_path, media_folder).install_from_list(["_field.css", "_editor.css"])
+    assert anki.calls.count("storeMediaFile") == 3
+    assert anki.media["_field.css"] == b"c {}"
+
+
+def test_missing_files_are_sent(anki, tmp_path, media_folder):
+    make_installer(tmp_path, media_folder).install_from_list(["_field.css"])
+    del anki.media["_field.css"]
+
+    make_installer(tmp_path, media_folder).install_from_list(["_field.css"])
+    assert anki.calls.count("storeMediaFile") == 2
+
+
+def test_force(anki, tmp_path, media_folder):
+    make_installer(tmp_path, media_folder).install("_field.css")
+    make_installer(tmp_path, media_folder).install("_field.css", force=True)
+    assert anki.calls.count("storeMediaFile") == 2
+
+
+def test_static_files_are_not_replaced(anki, tmp_path, media_folder):
+    anki.media["_field.css"] = b"user edited"
+    make_installer(tmp_path, media_folder).install("_field.css", static=True)
+    assert anki.media["_field.css"] == b"user edited"
+
+
+def test_backup_is_binary(anki, tmp_path, media_folder):
+    font = bytes(range(256)) * 1000
+    anki.media["_font.woff2"] = font
+    installer = make_installer(tmp_path, media_folder)
+    installer.backup("_font.woff2")
+    assert (tmp_path / "backup" / "_font.woff2").read_bytes() == font
+
+
+def test_install_from_list_is_concurrent(anki, tmp_path, media_folder):
+    names = [f"_file{i}.css" for i in range(20)]
+    for name in names:
+        (media_folder / name).write_text(name)
+    installer = make_installer(tmp_path, media_folder)
+    installer.install_from_list(names)
+    assert all(anki.media[name] == name.encode() for name in names)
+    assert set(names) <= set(installer.manifest.data["profile"])
+
+
+class StreamClient:
+    def invoke_stream(self, action, body, length):
+        data = b"".join(body())
+        assert len(data) == length
+        return json.loads(data)
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 1000, install.B64_ENCODE_BLOCK_SIZE + 1])
+def test_store_media_file_stream(tmp_path, size):
+    path = tmp_path / "file.bin"
+    path.write_bytes(bytes(i % 256 for i in range(size)))
+
+    request = install.store_media_file_stream(StreamClient(), 'a "b".bin', str(path))
+    assert request["action"] == "storeMediaFile"
+    assert request["params"]["filename"] == 'a "b".bin'
+    assert base64.b64decode(request["params"]["data"]) == path.read_bytes()
+
+
+class FakeAnkiModel:
+    def __init__(self, templates, css):
+        self.templates = templates
+        self.css = css
+        self.calls = []
+
+    def __call__(self, action, **params):
+        self.calls.append((action, params))
+        if action == "modelTemplates":
+            return {k: dict(v) for k, v in self.templates.items()}
+        if action == "modelStyling":
+            return {"css": self.css}
+        if action == "updateModelTemplates":
+            for name, sides in params["model"]["templates"].items():
+                self.templates[name].update(sides)
+            return None
+        if action == "updateModelStyling":
+            self.css = params["model"]["css"]
+            return None
+        raise NotImplementedError(action)
+
+    def actions(self):
+        return [a for a, _ in self.calls]
+
+
+@pytest.fixture
+def note_updater(tmp_path):
+    note_config = install.utils.get_note_config()
+    note_id = note_config("id").item()
+    for template_id in note_config("templates").dict().keys():
+        folder = tmp_path / note_id / template_id
+        folder.mkdir(parents=True)
+        (folder / install.FRONT_FILENAME).write_text(f"{template_id} front")
+        (folder / install.BACK_FILENAME).write_text(f"{template_id} back")
+    (tmp_path / note_id / install.CSS_FILENAME).write_text("css")
+    return install.NoteUpdater(str(tmp_path), note_config)
+
+
+def installed_model(note_updater):
+    model = note_updater.read_model()
+    return {t.name: {"Front": t.front, "Back": t.back} for t in model.templates}, model.css
+
+
+def test_unchanged_model_is_not_updated(monkeypatch, note_updater):
+    anki = FakeAnkiModel(*installed_model(note_updater))
+    monkeypatch.setattr(install, "invoke", anki)
+    note_updater.update()
+    assert anki.actions() == ["modelTemplates", "modelStyling"]
+
+
+def test_only_changed_sides_are_updated(monkeypatch, note_updater):
+    templates, css = installed_model(note_updater)
+    name = next(iter(templates))
+    new_back = templates[name]["Back"]
+    templates[name]["Back"] = "old back"
+    anki = FakeAnkiModel(templates, css)
+    monkeypatch.setattr(install, "invoke", anki)
+
+    note_updater.update()
+    updates = [p for a, p in anki.calls if a == "updateModelTemplates"]
+    assert [u["model"]["templates"] for u in updates] == [{name: {"Back": new_back}}]
+    assert "updateModelStyling" not in anki.actions()
+
+    # the fetched templates are kept up to date
+    note_updater.update()
+    assert anki.actions().count("updateModelTemplates") == 1
+
+
+@pytest.mark.parametrize("installed", [True, False])
+def test_probe_anki(monkeypatch, note_updater, tmp_path, media_folder, installed):
+    collection = FakeCollection.empty_jpmn() if installed else FakeCollection()
+    collection.media["_field.css"] = b"a {}"
+    if installed:
+        templates, css = installed_model(note_updater)
+        name = next(iter(templates))
+        new_back = templates[name]["Back"]
+        templates[name]["Back"] = "old back"
+        collection.models["JP Mining Note"].update(templates=templates, css=css)
+    installer = install.MediaInstaller(str(media_folder), str(media_folder), "")
+
+    with FakeAnkiConnect(collection) as server:
+        monkeypatch.setenv("ANKICONNECT_URL", server.url)
+        media_files = ["_field.css", "_editor.css"]
+        assert install.probe_anki(note_updater, installer, media_files) == installed
+        assert installer.anki_media_files == {"_field.css"}
+        if installed:
+            # already fetched, so updating only sends the changes
+            note_updater.update()
+            assert server.calls["modelTemplates"] == server.calls["modelStyling"] == 1
+            assert server.calls["updateModelTemplates"] == 1
+            assert templates[name]["Back"] == new_back
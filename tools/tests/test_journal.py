@@ -0,0 +1,53 @@
+from tools.journal import Journal
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path, {"from": "1", "to": "2"})
+    journal.record_action(0)
+    journal.context = "1:"
+    journal.record_chunk("step", [1, 2, 3])
+    journal.close()
+
+    journal = Journal(path, {"from": "1", "to": "2"}, resume=True)
+    assert journal.completed_actions == {0}
+    assert journal.completed_notes("step") == set()
+    journal.context = "1:"
+    assert journal.completed_notes("step") == {1, 2, 3}
+
+    journal.finish()
+    assert not (tmp_path / "journal.jsonl").exists()
+
+
+def test_not_resumed(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    Journal(path, {"from": "1"}).record_action(0)
+
+    # different run
+    assert not Journal(path, {"from": "2"}, resume=True).completed_actions
+    # without --resume
+    Journal(path, {"from": "2"}).record_action(0)
+    assert not Journal(path, {"from": "2"}).completed_actions
+
+
+def test_partial_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = Journal(str(path), {})
+    journal.record_action(0)
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"act')
+
+    journal = Journal(str(path), {}, resume=True)
+    journal.record_action(1)
+    journal.close()
+    assert Journal(str(path), {}, resume=True).completed_actions == {0, 1}
+
+
+def test_load_without_writing(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    Journal(path, {}).record_action(0)
+
+    # nothing is rewritten until something is recorded
+    Journal(path, {}).close()
+    assert Journal(path, {}, resume=True).completed_actions == {0}
@@ -0,0 +1,140 @@
+import os
+
+import jinja2
+import pytest
+
+from tools.make import (
+    Generator,
+    GenerateType,
+    GenerateTask,
+    BuildManifest,
+    create_environment,
+    get_task_dependencies,
+)
+import tools.utils as utils
+
+
+def write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def folders(tmp_path):
+    overrides = str(tmp_path / "overrides")
+    src = str(tmp_path / "src")
+    os.makedirs(overrides)
+    write(os.path.join(src, "page.html"), '{% include "partial.html" %}')
+    write(os.path.join(src, "partial.html"), "hello")
+    return overrides, src
+
+
+def make_gen(folders, manifest_path):
+    root_folder = utils.get_root_folder()
+    config_path = os.path.join(root_folder, "config", "example_config.py")
+    config = utils.get_config_from_path(config_path)
+    return Generator(list(folders), config, manifest=BuildManifest(manifest_path))
+
+
+def test_skips_unchanged(folders, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    output = str(tmp_path / "build" / "page.html")
+
+    gen = make_gen(folders, manifest_path)
+    assert gen.generate(GenerateType.JINJA, "page.html", output, "")
+    assert not gen.generate(GenerateType.JINJA, "page.html", output, "")
+
+    # the manifest persists between builds
+    gen.manifest.save()
+    gen = make_gen(folders, manifest_path)
+    assert not gen.generate(GenerateType.JINJA, "page.html", output, "")
+
+
+def test_rebuilds_on_included_change(folders, tmp_path):
+    _, src = folders
+    output = str(tmp_path / "build" / "page.html")
+    gen = make_gen(folders, str(tmp_path / "manifest.json"))
+
+    gen.generate(GenerateType.JINJA, "page.html", output, "")
+    write(os.path.join(src, "partial.html"), "world")
+    assert gen.generate(GenerateType.JINJA, "page.html", output, "")
+    with open(output) as f:
+        assert f.read() == "world"
+
+
+def test_rebuilds_on_new_override(folders, tmp_path):
+    overrides, _ = folders
+    output = str(tmp_path / "build" / "page.html")
+    gen = make_gen(folders, str(tmp_path / "manifest.json"))
+
+    gen.generate(GenerateType.JINJA, "page.html", output, "")
+    write(os.path.join(overrides, "partial.html"), "overridden")
+    assert gen.generate(GenerateType.JINJA, "page.html", output, "")
+    with open(output) as f:
+        assert f.read() == "overridden"
+
+
+def test_rebuilds_on_config_change(folders, tmp_path):
+    output = str(tmp_path / "build" / "page.html")
+    gen = make_gen(folders, str(tmp_path / "manifest.json"))
+
+    gen.generate(GenerateType.JINJA, "page.html", output, "")
+    gen.data["COMPILE_OPTIONS"].dict()["keybinds-enabled"] = False
+    assert gen.generate(GenerateType.JINJA, "page.html", output, "")
+
+
+def test_rebuilds_on_overwritten_output(folders, tmp_path):
+    output = str(tmp_path / "build" / "page.html")
+    gen = make_gen(folders, str(tmp_path / "manifest.json"))
+
+    gen.generate(GenerateType.JINJA, "page.html", output, "")
+    write(output, "something else")
+    assert gen.generate(GenerateType.JINJA, "page.html", output, "")
+
+
+def test_task_dependencies():
+    tasks = [
+        GenerateTask(GenerateType.JINJA, "a/front.html", "build/a/front.html", ""),
+        GenerateTask(GenerateType.COPY, "src/scss", "build/tmp/scss", ""),
+        GenerateTask(GenerateType.JINJA, "scss/style.scss", "build/tmp/scss/style.scss", ""),
+        GenerateTask(GenerateType.SASS, "build/tmp/scss/style.scss", "build/style.css", ""),
+        GenerateTask(GenerateType.JINJA, "scss/field.scss", "build/tmp/scss/field.scss", ""),
+        GenerateTask(GenerateType.SASS, "build/tmp/scss/field.scss", "build/field.css", ""),
+    ]
+    assert get_task_dependencies(tasks) == [set(), set(), {1}, {1, 2}, {1}, {1, 2, 4}]
+
+
+def test_generate_all_parallel(folders, tmp_path):
+    _, src = folders
+    for i in range(6):
+        write(os.path.join(src, f"page{i}.html"), f'{i}{{% include "partial.html" %}}')
+
+    gen = make_gen(folders, str(tmp_path / "manifest.json"))
+    tasks = [
+        GenerateTask(GenerateType.JINJA, f"page{i}.html", str(tmp_path / "build" / f"page{i}.html"), "")
+        for i in range(6)
+    ]
+    assert gen.generate_all(tasks, jobs=4) == [True] * 6
+    assert gen.generate_all(tasks, jobs=4) == [False] * 6
+
+    for i in range(6):
+        with open(tmp_path / "build" / f"page{i}.html") as f:
+            assert f.read() == f"{i}hello"
+
+
+def test_environment_is_shared(folders, tmp_path):
+    gen1 = make_gen(folders, str(tmp_path / "manifest.json"))
+    gen2 = make_gen(folders, str(tmp_path / "manifest.json"))
+    assert gen1.env is gen2.env
+
+
+def test_bytecode_cache(folders, tmp_path):
+    cache_folder = str(tmp_path / "cache")
+    env = create_environment(list(folders), cache_folder)
+    env.get_template("page.html")
+
+    # a fresh environment loads the template from the bytecode cache
+    env = create_environment(list(folders), cache_folder)
+    assert env.get_template("page.html").render() == "hello"
+    assert os.listdir(os.path.join(cache_folder, jinja2.__version__))
@@ -0,0 +1,41 @@
+from tools.sass_compiler import SassDiagnostic, parse_diagnostics
+
+
+def test_parse_error():
+    output = """Error: Undefined variable.
+  ╷
+3 │ a { b: $c }
+  │        ^^
+  ╵
+  tmp/scss/style.scss 3:8  root stylesheet
+"""
+    assert parse_diagnostics(output) == [
+        SassDiagnostic("error", "Undefined variable.", "tmp/scss/style.scss", 3, 8)
+    ]
+
+
+def test_parse_warning_and_error():
+    output = """DEPRECATION WARNING: Using / for division is deprecated.
+    ╷
+ 10 │ a { b: 1/2 }
+    │        ^^^
+    ╵
+    tmp/scss/field.scss 10:8  root stylesheet
+
+Error: expected "}".
+  ╷
+5 │ a {
+  │    ^
+  ╵
+  tmp/scss/editor.scss 5:4  root stylesheet
+"""
+    assert parse_diagnostics(output) == [
+        SassDiagnostic("warning", "Using / for division is deprecated.", "tmp/scss/field.scss", 10, 8),
+        SassDiagnostic("error", 'expected "}".', "tmp/scss/editor.scss", 5, 4),
+    ]
+
+
+def test_parse_without_location():
+    assert parse_diagnostics("Error: Cannot open file.") == [
+        SassDiagnostic("error", "Cannot open file.")
+    ]
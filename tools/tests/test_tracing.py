@@ -0,0 +1,91 @@
+import json
+import argparse
+import threading
+
+import pytest
+
+import tools.ankiconnect as ankiconnect
+from tools.fake_ankiconnect import FakeAnkiConnect, FakeCollection
+
+# the same module as used by the tools (rather than tools.tracing)
+tracing = ankiconnect.tracing
+
+
+def test_nested_spans():
+    tracer = tracing.Tracer()
+    with tracer.span("a"):
+        with tracer.span("b", file="x"):
+            pass
+        with tracer.span("b"):
+            pass
+    with tracer.span("b"):
+        pass
+
+    data = tracer.to_json()
+    assert {path: s["calls"] for path, s in data["spans"].items()} == {"a/b": 2, "a": 1, "b": 1}
+
+    events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+    a = next(e for e in events if e["name"] == "a")
+    for b in events[:2]:
+        # nested spans are contained within their parent
+        assert a["ts"] <= b["ts"] and b["ts"] + b["dur"] <= a["ts"] + a["dur"]
+    assert events[0]["args"] == {"file": "x"}
+
+
+def test_bind():
+    tracer = tracing.Tracer()
+
+    def run():
+        with tracer.span("b"):
+            pass
+
+    with tracer.span("a"):
+        thread = threading.Thread(target=tracer.bind(run))
+        thread.start()
+        thread.join()
+
+    assert set(tracer.spans) == {"a", "a/b"}
+    assert len(tracer.threads) == 2
+
+
+def test_disabled():
+    tracer = tracing.Tracer()
+    tracer.enabled = False
+    with tracer.span("a"):
+        tracer.count("c")
+    assert tracer.to_json()["traceEvents"] == []
+
+
+def test_ankiconnect_counters():
+    with FakeAnkiConnect(FakeCollection.empty_jpmn()) as server:
+        client = ankiconnect.AnkiConnectClient(server.url)
+        tracing.tracer.reset()
+        with tracing.span("probe"):
+            client.invoke("version")
+            client.invoke("version")
+        client.close()
+
+    assert tracing.tracer.counters["ankiconnect.calls"] == 2
+    assert tracing.tracer.counters["ankiconnect.bytes_sent"] > 0
+    assert tracing.tracer.spans["probe/ankiconnect.version"].calls == 2
+
+
+def test_run_writes_trace(tmp_path):
+    path = tmp_path / "trace.json"
+    args = argparse.Namespace(trace=str(path), profile="cprofile")
+
+    with pytest.raises(ValueError):
+        with tracing.run("outer", args):
+            with tracing.run("inner", argparse.Namespace(trace=str(tmp_path / "inner.json"))):
+                tracing.count("things", 3)
+            raise ValueError()
+
+    # written even though the run failed, and only by the outermost run
+    data = json.loads(path.read_text())
+    assert not (tmp_path / "inner.json").exists()
+    assert (tmp_path / "trace.prof").exists()
+    assert set(data["spans"]) == {"outer", "outer/inner"}
+    assert data["counters"] == {"things": 3}
+    lines = tracing.format_summary(data).splitlines()
+    assert lines[1].split()[:2] == ["outer", "1"]
+    assert lines[2].startswith("      inner ")
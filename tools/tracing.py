@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+"""
+named timing spans and counters for the tools, written as a Chrome trace at the end of each run
+
+Spans nest (per thread), and every AnkiConnect call is recorded as its own span,
+along with counters of the number of calls and bytes sent / received.
+The trace can be opened with chrome://tracing or https://ui.perfetto.dev,
+and also contains the total time spent per span path, which can be printed with:
+
+    python3 tracing.py ../.cache/trace/install.json
+
+Usage within the tools:
+
+    with tracing.span("install.backup"):
+        ...
+
+    @tracing.traced("make.sass")
+    def compile(...):
+        ...
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import functools
+import contextlib
+
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Iterator
+
+
+TRACE_FOLDER = "trace"
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+@dataclass
+class SpanStats:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+class Tracer:
+    """
+    collects the spans and counters of the current run. Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.perf_counter()
+            self.events: list[dict[str, Any]] = []
+            self.counters: dict[str, float] = {}
+            self.spans: dict[str, SpanStats] = {}  # "/".join(names of the nested spans) -> stats
+            self.threads: dict[int, str] = {}
+
+    def _stack(self) -> list[str]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _timestamp(self, t: float) -> float:
+        # chrome traces use microseconds
+        return (t - self.start) * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        """
+        times the block. The args are shown with the span in the trace viewer.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        stack.append(name)
+        path = "/".join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self._add(name, path, start, time.perf_counter() - start, args)
+
+    def add_span(self, name: str, start: float, seconds: float, **args):
+        """
+        records a span that was timed elsewhere, as a child of the current span.
+        `start` is a time.perf_counter() value.
+        """
+        if self.enabled:
+            self._add(name, "/".join(self._stack() + [name]), start, seconds, args)
+
+    def bind(self, func: Callable) -> Callable:
+        """
+        returns the function, with its spans nested under the current span
+        when called from another thread (i.e. submitted to a thread pool)
+        """
+        parent = list(self._stack())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(self._local, "stack", None)
+            self._local.stack = list(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = previous
+
+        return wrapper
+
+    def _add(self, name: str, path: str, start: float, seconds: float, args: dict[str, Any]):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",  # complete event: has both a start and a duration
+            "ts": self._timestamp(start),
+            "dur": seconds * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+
+        with self._lock:
+            self.events.append(event)
+            stats = self.spans.setdefault(path, SpanStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            self.threads.setdefault(thread.ident or 0, thread.name)
+
+    def count(self, name: str, value: float = 1):
+        """
+        adds to a counter. Counters are graphed over time in the trace viewer.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            total = self.counters[name] = self.counters.get(name, 0) + value
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "C",
+                    "ts": self._timestamp(now),
+                    "pid": os.getpid(),
+                    "args": {name: total},
+                }
+            )
+
+    def to_json(self, name: str = "") -> dict[str, Any]:
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+                for tid, thread_name in self.threads.items()
+            ]
+            return {
+                "traceEvents": metadata + list(self.events),
+                "displayTimeUnit": "ms",
+                "otherData": {"name": name, "argv": sys.argv},
+                "counters": dict(self.counters),
+                "spans": {path: asdict(stats) for path, stats in self.spans.items()},
+            }
+
+    def write(self, path: str, name: str = ""):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(name), f)
+
+
+tracer = Tracer()
+
+
+def span(name: str, **args):
+    return tracer.span(name, **args)
+
+
+def count(name: str, value: float = 1):
+    tracer.count(name, value)
+
+
+def bind(func: Callable) -> Callable:
+    return tracer.bind(func)
+
+
+def traced(name: str | None = None):
+    """
+    decorator version of span(), named after the function by default
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_args(parser: argparse.ArgumentParser | argparse._ArgumentGroup):
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="where the timing trace of the run is written "
+        f"(default: .cache/{TRACE_FOLDER}/(script name).json)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        choices=PROFILERS,
+        default=None,
+        help="also profiles the run, and writes the profile next to the trace "
+        "(.prof for cprofile, which can be read with `python3 -m pstats`, "
+        "or .html for pyinstrument)",
+    )
+
+
+def get_trace_path(name: str) -> str:
+    import utils  # utils -> ankiconnect -> tracing
+
+    return os.path.join(utils.get_cache_folder(), TRACE_FOLDER, f"{name}.json")
+
+
+@contextlib.contextmanager
+def profiling(profiler: str | None, path: str) -> Iterator[None]:
+    """
+    profiles the block with the given profiler (only the calling thread is profiled),
+    and writes the result to the path
+    """
+    if profiler is None:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if profiler == "cprofile":
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+            print(f"Wrote the profile to {os.path.relpath(path)}")
+
+    elif profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise Exception(
+                "Profiling with pyinstrument requires the pyinstrument package: "
+                "pip install pyinstrument"
+            ) from None
+
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profile.output_html())
+            print(f"Wrote the profile to {os.path.relpath(path)}")
+
+    else:
+        raise ValueError(f"unknown profiler: {profiler}")
+
+
+_run_depth = 0
+
+
+@contextlib.contextmanager
+def run(name: str, args: argparse.Namespace | None = None) -> Iterator[None]:
+    """
+    traces a whole run of a tool (i.e. make.main()) as a span of the given name.
+
+    At the end of the outermost run, the trace is written to `--trace`
+    (or .cache/trace/(name).json), even if the run failed.
+    Runs within another run (i.e. make.main() from main.py) only add their span.
+    """
+    global _run_depth
+
+    outermost = _run_depth == 0
+    if not outermost or not tracer.enabled:
+        with tracer.span(name):
+            yield
+        return
+
+    tracer.reset()
+    path = getattr(args, "trace", None) or get_trace_path(name)
+    profiler = getattr(args, "profile", None)
+    profile_path = os.path.splitext(path)[0] + (".prof" if profiler == "cprofile" else ".html")
+
+    _run_depth += 1
+    try:
+        with profiling(profiler, profile_path), tracer.span(name):
+            yield
+    finally:
+        _run_depth -= 1
+        tracer.write(path, name)
+        print(f"Wrote the trace to {os.path.relpath(path)}")
+
+
+def format_summary(data: dict[str, Any]) -> str:
+    """
+    returns a table of the time spent per span path of a written trace,
+    with nested spans indented under their parent
+    """
+    spans = data["spans"]
+    lines = [f"    {'span':<64} {'calls':>7} {'total (s)':>10}"]
+    for path in sorted(spans, key=lambda p: p.split("/")):
+        stats = spans[path]
+        depth = path.count("/")
+        label = "  " * depth + path.rsplit("/", 1)[-1]
+        lines.append(f"    {label:<64} {stats['calls']:>7} {stats['seconds']:>10.3f}")
+    for counter, value in sorted(data["counters"].items()):
+        lines.append(f"    {counter:<64} {value:>18,.0f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str, help="trace written by one of the tools")
+    args = parser.parse_args()
+
+    with open(args.trace, encoding="utf-8") as f:
+        data = json.load(f)
+    print(format_summary(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,13 @@ import shutil
 import os.path
 import argparse
 import importlib.util
-import urllib.request
-import urllib.error
 
 from pathlib import Path
 from typing import TYPE_CHECKING, Callable, Any, Iterable
 
 import note_files
+import tracing
+import ankiconnect
 
 
 if TYPE_CHECKING:
@@ -67,6 +67,8 @@ def add_args(parser: argparse.ArgumentParser):
         help="(dev option) custom output version to be used instead of version.txt"
     )
 
+    tracing.add_args(group)
+
 
 def get_args(*args: Callable[[argparse.ArgumentParser], None]) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -215,25 +217,14 @@ def import_source_file(fname: str, modname: str) -> "types.ModuleType":
 
 # taken from https://github.com/FooSoft/anki-connect#python
 def request(action: str, **params):
-    return {"action": action, "params": params, "version": 6}
+    return ankiconnect.request(action, **params)
 
 
 def invoke(action: str, **params):
-    requestJson = json.dumps(request(action, **params)).encode("utf-8")
-    response = json.load(
-        urllib.request.urlopen(
-            urllib.request.Request("http://localhost:8765", requestJson)
-        )
-    )
-    if len(response) != 2:
-        raise Exception("response has an unexpected number of fields")
-    if "error" not in response:
-        raise Exception("response is missing required error field")
-    if "result" not in response:
-        raise Exception("response is missing required result field")
-    if response["error"] is not None:
-        raise Exception(response["error"])
-    return response["result"]
+    """
+    calls AnkiConnect through the shared keep-alive client (see ankiconnect.py)
+    """
+    return ankiconnect.invoke(action, **params)
 
 
 def get_config_data_from_path(file_path: str) -> dict[str, Any]:
@@ -290,20 +281,23 @@ def note_is_installed(note_name) -> bool:
     return note_name in result
 
 
-def get_version_from_anki(args) -> str:
+def get_version_from_anki(args, templates: dict[str, dict[str, str]] | None = None) -> str:
     """
     gets version of the jp mining note from the installed note in anki
+    (or from its already fetched templates)
     """
 
     if args.dev_input_version is not None:
         return args.dev_input_version
 
-    nf_config = get_note_config()
-
-    result = invoke(
-        "modelTemplates",
-        modelName=nf_config("model-name").item(),
-    )
+    if templates is not None:
+        result = templates
+    else:
+        nf_config = get_note_config()
+        result = invoke(
+            "modelTemplates",
+            modelName=nf_config("model-name").item(),
+        )
 
     assert result.keys()
 
@@ -315,13 +309,15 @@ def get_version_from_anki(args) -> str:
     return match.group(1)
 
 
-def get_config(args: argparse.Namespace) -> Config:
+def get_config(args: argparse.Namespace, reload: bool = False) -> Config:
     """
     creates the config file from the example config if it doesn't exist
+
+    the config is only read once, unless `reload` is set (i.e. the config file has changed)
     """
     global cached_config  # lazy fix
 
-    if cached_config is not None:
+    if cached_config is not None and not reload:
         return cached_config
 
     file_path = args.config_file
@@ -373,10 +369,31 @@ def get_root_folder() -> str:
     return root_folder
 
 
+def get_cache_folder() -> str:
+    """
+    folder for local state kept between runs (i.e. manifests of what was installed).
+    Everything in this folder can be safely deleted.
+    """
+
+    return os.path.join(get_root_folder(), ".cache")
+
+
+def get_anki_profile() -> str:
+    """
+    name of the currently opened Anki profile, used to keep local state per profile
+    """
+
+    try:
+        return invoke("getActiveProfile")
+    except Exception:
+        # older versions of AnkiConnect
+        return "default"
+
+
 def assert_ankiconnect_running():
     try:
         invoke("version")
-    except urllib.error.URLError as e:
+    except OSError as e:
         raise Exception(
             "Ankiconnect is not running. Is Anki open, and is Ankiconnect installed and enabled?"
         )